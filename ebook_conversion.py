@@ -9,14 +9,30 @@ All implementations rely on temp disk space and will spool to disk.
 import logging
 import os
 import shutil
+import signal
 import sys
 import tempfile
+import threading
 
 
 log = logging.getLogger(__name__)
 logging.basicConfig()  # TODO include timestamp - and maybe function name/line numbers in log
 log.setLevel(level=logging.DEBUG)  # Debug hack!
 
+class ConversionTimeout(Exception):
+    """Conversion did not complete within the allowed time"""
+
+
+# Output formats the converter writes sequentially (append-only), a partially written output file
+# is a prefix of the final one so it can be served while conversion is still in progress - see supports_streaming().
+# Only list a format once its converter is shown to write incrementally. Calibre builds TXT (and every other
+# output) in memory and writes it in one go at the end, so it has none
+streaming_formats = ()
+
+def supports_streaming(ebook_format):
+    return ebook_format.lower() in streaming_formats
+
+
 try:
     import KindleUnpack  # https://github.com/clach04/KindleUnpack
     import KindleUnpack.lib.kindleunpack
@@ -59,10 +75,11 @@ if unpack_book:
     def convert_version():
         return 'KindleUnpack_' + getattr(KindleUnpack, '__version__', '??')
 
-    def convert(original_filename, new_filename):
+    def convert(original_filename, new_filename, timeout=None):
         # Faster than calibre but limited to kindle (azw3) to epub
         # TODO capture stdout/stderr? At the moment stdout/stderr is allowed to be emitted
         # NOTE uses temp disk spacel can be controlled via TMPDIR, TEMP or TMP environment variables
+        # NOTE timeout is ignored, in-process conversions can not be killed - see webook_cache.ConversionScheduler
         log.info('KindleUnpack in-process conversion, see stdout/stderr for status')
         log.debug('%r -> %r', original_filename, new_filename)
         if not new_filename.lower().endswith('.epub'):  # TODO epub2 and epub3?
@@ -83,17 +100,17 @@ elif calibre:
     def convert_version():
         return 'calibre_' + calibre.__version__
 
-    def convert(original_filename, new_filename):
+    def convert(original_filename, new_filename, timeout=None):
         # This is not a fast operation, examples;
         #                   700Kb azw3 can take almost 30 secs to convertion into mobi
         # (same)    700Kb azw3 can take almost 10 secs to convertion into epub
         # TODO capture stdout/stderr? At the moment stdout/stderr is allowed to be emitted
+        # NOTE timeout is ignored, in-process conversions can not be killed - see webook_cache.ConversionScheduler
         log.info('in-process conversion, see stdout/stderr for status')
         result = calibre_ebook_convert(['dummy', original_filename, new_filename])
         return result  # or the new_filename?
 else:
     # calibre external ebook-convert binary/exe/script
-
     calibre__version__ = '???'
     ebook_convert_exe = os.environ.get('CALIBRE_EBOOK_CONVERT_EXE', 'ebook-convert')
     # set CALIBRE_EBOOK_CONVERT_EXE=C:\Users\clach04\Calibre Portable\Calibre\ebook-convert.exe
@@ -115,10 +132,43 @@ else:
     def convert_version():
         return 'calibre-ebook-convert_' + calibre__version__
 
-    def convert(original_filename, new_filename):
+    def kill_process(process, killed_event=None):
+        """Kill process and any children it started (Calibre uses worker processes)
+        """
+        if killed_event:
+            killed_event.set()
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(process.pid, signal.SIGKILL)  # posix only
+            else:
+                process.kill()
+        except OSError:
+            pass  # already gone
+
+    def convert(original_filename, new_filename, timeout=None):
+        """timeout - optional number of seconds, the conversion (and any child processes) is killed and ConversionTimeout raised if exceeded
+        """
         log.info('external-process conversion, this may take some time with no status updates')
-        process = subprocess.Popen([ebook_convert_exe, original_filename, new_filename], stdout=subprocess.PIPE)  # call ebook-convert as a subprocess
-        process.wait()  # wait until it finishes it work
-        ebook_convert_exe_convert_stdout, ebook_convert_exe_convert_stderr = process.communicate()  # get output
+        popen_kwargs = {}
+        if hasattr(os, 'setsid'):
+            # new session (and process group), so children can be killed too
+            if sys.version_info >= (3, 2):
+                popen_kwargs['start_new_session'] = True  # setsid() without running Python in the child, preexec_fn is unsafe with threads
+            else:
+                popen_kwargs['preexec_fn'] = os.setsid  # py2
+        process = subprocess.Popen([ebook_convert_exe, original_filename, new_filename], stdout=subprocess.PIPE, **popen_kwargs)  # call ebook-convert as a subprocess
+        timer = None
+        killed_event = threading.Event()
+        if timeout:
+            timer = threading.Timer(timeout, kill_process, (process, killed_event))
+            timer.daemon = True
+            timer.start()
+        try:
+            ebook_convert_exe_convert_stdout, ebook_convert_exe_convert_stderr = process.communicate()  # wait until it finishes, get output
+        finally:
+            if timer:
+                timer.cancel()
         log.debug('ebook_convert_exe_convert_stderr %r', ebook_convert_exe_convert_stderr)
         log.debug('ebook_convert_exe_convert_stdout %r', ebook_convert_exe_convert_stdout)
+        if killed_event.is_set():
+            raise ConversionTimeout('conversion of %r killed after %r secs' % (original_filename, timeout))
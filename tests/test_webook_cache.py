@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for webook_cache, conversion cache LRU, single-flight conversion and feed cache
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import webook_cache
+
+
+class FakeConverter(object):
+    """convert_function for ConversionCache, writes size bytes. Optionally blocks until released
+    """
+    def __init__(self, size=100, block=False):
+        self.size = size
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def __call__(self, original_filename, new_filename, timeout=None):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(10)
+        f = open(new_filename, 'wb')
+        f.write(b'x' * self.size)
+        f.close()
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.sources = []
+        for number in range(3):
+            filename = os.path.join(self.temp_dir, 'book%d.txt' % number)
+            f = open(filename, 'wb')
+            f.write(b'book')
+            f.close()
+            self.sources.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_cache(self, converter, max_bytes=1000):
+        return webook_cache.ConversionCache(self.cache_dir, max_bytes=max_bytes, convert_function=converter, version_function=lambda: 'test')
+
+
+class TestConversionCache(CacheTestCase):
+    def test_hit(self):
+        converter = FakeConverter()
+        cache = self.make_cache(converter)
+        result = cache.convert(self.sources[0], 'epub')
+        self.assertEqual(cache.convert(self.sources[0], 'EPUB'), result)
+        self.assertEqual(converter.calls, 1)
+        self.assertTrue(result.endswith('.epub'))
+        self.assertEqual(os.path.getsize(result), 100)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries'], stats['total_bytes']), (1, 1, 1, 100))
+
+    def test_lru_eviction(self):
+        converter = FakeConverter(size=400)
+        cache = self.make_cache(converter, max_bytes=1000)
+        first = cache.convert(self.sources[0], 'epub')
+        second = cache.convert(self.sources[1], 'epub')
+        cache.convert(self.sources[0], 'epub')  # first is now most recently used
+        third = cache.convert(self.sources[2], 'epub')
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['total_bytes'], 800)
+
+    def test_oversized_entry_kept(self):
+        cache = self.make_cache(FakeConverter(size=2000), max_bytes=1000)
+        result = cache.convert(self.sources[0], 'epub')
+        self.assertTrue(os.path.exists(result))
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def test_reload(self):
+        cache = self.make_cache(FakeConverter())
+        result = cache.convert(self.sources[0], 'epub')
+        stale_temp_filename = cache.temp_filename('stale', 'epub')
+        open(stale_temp_filename, 'wb').close()
+        converter = FakeConverter()
+        cache = self.make_cache(converter)
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertFalse(os.path.exists(stale_temp_filename))
+        self.assertEqual(cache.convert(self.sources[0], 'epub'), result)
+        self.assertEqual(converter.calls, 0)
+
+    def test_source_change_invalidates(self):
+        converter = FakeConverter()
+        cache = self.make_cache(converter)
+        cache.convert(self.sources[0], 'epub')
+        os.utime(self.sources[0], (0, 1000000000))
+        cache.convert(self.sources[0], 'epub')
+        self.assertEqual(converter.calls, 2)
+
+    def test_no_output(self):
+        cache = self.make_cache(lambda original_filename, new_filename, timeout=None: None)
+        self.assertRaises(webook_cache.ConversionError, cache.convert, self.sources[0], 'epub')
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class TestConversionCoordinator(CacheTestCase):
+    def test_single_flight(self):
+        converter = FakeConverter(block=True)
+        scheduler = webook_cache.ConversionScheduler(max_workers=2, max_queue=4, timeout=10)
+        coordinator = webook_cache.ConversionCoordinator(self.make_cache(converter), scheduler)
+        results = []
+
+        def request():
+            results.append(coordinator.convert(self.sources[0], 'epub'))
+
+        threads = [threading.Thread(target=request) for number in range(3)]
+        threads[0].start()
+        self.assertTrue(converter.started.wait(10))
+        for thread in threads[1:]:
+            thread.start()
+        while coordinator.stats()['coalesced'] < 2:
+            threading.Event().wait(0.01)
+        converter.release.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(converter.calls, 1)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(coordinator.stats()['in_flight'], 0)
+
+    def test_timeout_keeps_conversion_in_flight(self):
+        converter = FakeConverter(block=True)
+        scheduler = webook_cache.ConversionScheduler(max_workers=1, max_queue=1, timeout=10)
+        coordinator = webook_cache.ConversionCoordinator(self.make_cache(converter), scheduler)
+        coordinator.wait_timeout = lambda: 0.05
+        self.assertRaises(webook_cache.ConversionTimeout, coordinator.convert, self.sources[0], 'epub')
+        self.assertEqual(coordinator.stats()['in_flight'], 1)
+        job = coordinator.start(self.sources[0], 'epub')  # joins the running conversion
+        converter.release.set()
+        self.assertTrue(job.event.wait(10))
+        self.assertEqual(job.error, None)
+        self.assertEqual(converter.calls, 1)
+        self.assertEqual(coordinator.stats()['in_flight'], 0)
+        self.assertEqual(coordinator.stats()['timed_out'], 1)
+
+    def test_error_shared(self):
+        def converter(original_filename, new_filename, timeout=None):
+            raise webook_cache.ConversionError('failed')
+
+        coordinator = webook_cache.ConversionCoordinator(self.make_cache(converter))
+        self.assertRaises(webook_cache.ConversionError, coordinator.convert, self.sources[0], 'epub')
+        self.assertEqual(coordinator.stats()['in_flight'], 0)
+
+
+class TestFeedCache(unittest.TestCase):
+    def test_lookup_and_validator(self):
+        cache = webook_cache.FeedCache(max_bytes=100)
+        self.assertEqual(cache.lookup('key', 'v1'), None)
+        cache.store('key', 'v1', b'body')
+        self.assertEqual(cache.lookup('key', 'v1'), b'body')
+        self.assertEqual(cache.lookup('key', 'v2'), None)  # stale, and dropped
+        self.assertEqual(cache.lookup('key', 'v1'), None)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['invalidations'], stats['total_bytes']), (1, 3, 1, 0))
+
+    def test_eviction(self):
+        cache = webook_cache.FeedCache(max_bytes=10)
+        cache.store('a', 1, b'aaaa')
+        cache.store('b', 1, b'bbbb')
+        cache.lookup('a', 1)
+        cache.store('c', 1, b'cccc')
+        self.assertEqual(cache.lookup('b', 1), None)
+        self.assertEqual(cache.lookup('a', 1), b'aaaa')
+        self.assertEqual(cache.lookup('c', 1), b'cccc')
+        cache.store('big', 1, b'x' * 11)
+        self.assertEqual(cache.lookup('big', 1), None)
+
+    def test_tee(self):
+        cache = webook_cache.FeedCache(max_bytes=10)
+        self.assertEqual(list(cache.tee('key', 1, [b'ab', b'cd'])), [b'ab', b'cd'])
+        self.assertEqual(cache.lookup('key', 1), b'abcd')
+
+    def test_tee_incomplete_or_too_big(self):
+        cache = webook_cache.FeedCache(max_bytes=10)
+        body = cache.tee('partial', 1, [b'ab', b'cd'])
+        next(iter(body))
+        body.close()  # client went away
+        self.assertEqual(cache.lookup('partial', 1), None)
+        self.assertEqual(list(cache.tee('big', 1, [b'x' * 6, b'y' * 6])), [b'x' * 6, b'y' * 6])
+        self.assertEqual(cache.lookup('big', 1), None)
+
+    def test_disabled(self):
+        cache = webook_cache.FeedCache(max_bytes=0)
+        chunks = [b'ab']
+        self.assertTrue(cache.tee('key', 1, chunks) is chunks)
+
+
+if __name__ == '__main__':
+    unittest.main()
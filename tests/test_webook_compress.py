@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for webook_compress, content-coding negotiation and ETag variants
+
+    python -m unittest discover -s tests
+"""
+
+import gzip
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import webook_compress
+
+
+class TestChooseEncoding(unittest.TestCase):
+    def test_none(self):
+        self.assertEqual(webook_compress.choose_encoding(None), None)
+        self.assertEqual(webook_compress.choose_encoding(''), None)
+        self.assertEqual(webook_compress.choose_encoding('identity'), None)
+        self.assertEqual(webook_compress.choose_encoding('br'), None)
+
+    def test_gzip(self):
+        self.assertEqual(webook_compress.choose_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(webook_compress.choose_encoding('GZIP'), 'gzip')
+        self.assertEqual(webook_compress.choose_encoding('x-gzip'), 'gzip')
+
+    def test_q_values(self):
+        self.assertEqual(webook_compress.choose_encoding('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(webook_compress.choose_encoding('gzip;q=0'), None)
+        self.assertEqual(webook_compress.choose_encoding('gzip;q=bad, deflate;q=0.1'), 'deflate')
+
+    def test_wildcard(self):
+        self.assertEqual(webook_compress.choose_encoding('*'), 'gzip')
+        self.assertEqual(webook_compress.choose_encoding('*, gzip;q=0'), 'deflate')
+        self.assertEqual(webook_compress.choose_encoding('*;q=0'), None)
+
+
+class TestEtags(unittest.TestCase):
+    def test_encoded_etag(self):
+        self.assertEqual(webook_compress.encoded_etag('"abc"', 'gzip'), '"abc-gzip"')
+        self.assertEqual(webook_compress.encoded_etag('W/"abc"', 'gzip'), 'W/"abc-gzip"')
+        self.assertEqual(webook_compress.encoded_etag('"abc-gzip"', 'gzip'), '"abc-gzip"')  # not suffixed twice
+
+    def test_strip_round_trip(self):
+        self.assertEqual(webook_compress.strip_etag_suffixes('"abc-gzip", W/"def-deflate", "ghi"'), '"abc", W/"def", "ghi"')
+        for encoding in webook_compress.ENCODINGS:
+            self.assertEqual(webook_compress.strip_etag_suffixes(webook_compress.encoded_etag('"abc"', encoding)), '"abc"')
+
+
+class TestCompress(unittest.TestCase):
+    def test_gzip_round_trip(self):
+        data = b'<feed>' + b'<entry/>' * 100 + b'</feed>'
+        compressed = webook_compress.compress(data, 'gzip')
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed)).read(), data)
+
+    def test_is_compressible(self):
+        self.assertTrue(webook_compress.is_compressible('application/atom+xml;profile=opds-catalog'))
+        self.assertTrue(webook_compress.is_compressible('text/html; charset=utf-8'))
+        self.assertFalse(webook_compress.is_compressible('application/epub+zip'))
+        self.assertFalse(webook_compress.is_compressible(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for webook_feed, escaping and templates
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import webook_core
+import webook_feed
+
+
+class TestXmlEscape(unittest.TestCase):
+    def test_escape(self):
+        self.assertEqual(webook_feed.xml_escape(u'a & b <c> "d"'), u'a &#38; b &#60;c&#62; &#34;d&#34;')
+
+    def test_ampersand_first(self):
+        self.assertEqual(webook_feed.xml_escape(u'&lt;'), u'&#38;lt;')
+
+    def test_unchanged(self):
+        self.assertEqual(webook_feed.xml_escape(u"plain 'text'"), u"plain 'text'")
+
+
+class TestTemplate(unittest.TestCase):
+    def test_render(self):
+        template = webook_feed.Template(u'<a href="{href}">{title}</a> {title}')
+        self.assertEqual(template.slots, ('href', 'title'))
+        self.assertEqual(template.render({'href': u'/x', 'title': u'T'}), u'<a href="/x">T</a> T')
+
+    def test_literal_percent_and_braces(self):
+        template = webook_feed.Template(u'100% {{literal}} {value}')
+        self.assertEqual(template.render({'value': u'%s'}), u'100% {literal} %s')
+
+    def test_matches_str_format(self):
+        template_string = u'<entry><title>{title}</title><id>{entry_id}</id></entry>'
+        values = {'title': u'T', 'entry_id': u'1'}
+        self.assertEqual(webook_feed.Template(template_string).render(values), template_string.format(**values))
+
+    def test_unsupported_fields(self):
+        for template_string in (u'{}', u'{name!r}', u'{name:>10}'):
+            self.assertRaises(ValueError, webook_feed.Template, template_string)
+
+    def test_book_entry_values_cover_slots(self):
+        metadata = webook_core.BootMeta(u'A & <B>.epub', file_octet_size=1024, directory=os.path.abspath('books'))
+        values = webook_feed.book_entry_values(metadata, u'dir/A & <B>.epub', thumbnail_href=u'/thumbnail/dir/A%20%26%20%3CB%3E.epub', thumbnail_type=None)
+        self.assertEqual(sorted(values), sorted(webook_feed.BOOK_ENTRY.slots))
+        rendered = webook_feed.BOOK_ENTRY.render(values)
+        self.assertIn(u'<title>A &#38; &#60;B&#62;</title>', rendered)
+        self.assertIn(u'href="/file/dir/A%20%26%20%3CB%3E.epub"', rendered)
+        self.assertIn(u'<link rel="http://opds-spec.org/image/thumbnail"', rendered)  # type attribute omitted, not known
+        self.assertNotIn(u'& ', rendered)
+
+
+if __name__ == '__main__':
+    unittest.main()
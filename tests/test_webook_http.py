@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for webook_http, range parsing and conditional requests
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import webook_http
+
+
+class StartResponse(object):
+    def __init__(self):
+        self.status = None
+        self.headers = None
+
+    def __call__(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = headers
+
+
+class TestParseRangeHeader(unittest.TestCase):
+    def test_missing(self):
+        self.assertEqual(webook_http.parse_range_header(None, 1000), None)
+        self.assertEqual(webook_http.parse_range_header('', 1000), None)
+
+    def test_single(self):
+        self.assertEqual(webook_http.parse_range_header('bytes=0-499', 1000), [(0, 499)])
+
+    def test_open_ended(self):
+        self.assertEqual(webook_http.parse_range_header('bytes=500-', 1000), [(500, 999)])
+
+    def test_suffix(self):
+        self.assertEqual(webook_http.parse_range_header('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(webook_http.parse_range_header('bytes=-5000', 1000), [(0, 999)])
+
+    def test_end_clamped(self):
+        self.assertEqual(webook_http.parse_range_header('bytes=900-5000', 1000), [(900, 999)])
+
+    def test_multiple(self):
+        self.assertEqual(webook_http.parse_range_header('bytes=0-0, -1', 1000), [(0, 0), (999, 999)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(webook_http.parse_range_header('bytes=1000-', 1000), [])
+        self.assertEqual(webook_http.parse_range_header('bytes=-0', 1000), [])
+        self.assertEqual(webook_http.parse_range_header('bytes=0-10', 0), [])
+
+    def test_unsatisfiable_ranges_dropped(self):
+        self.assertEqual(webook_http.parse_range_header('bytes=2000-3000,0-9', 1000), [(0, 9)])
+
+    def test_invalid_ignored(self):
+        for header_value in ('items=0-10', 'bytes=', 'bytes=10', 'bytes=10-5', 'bytes=a-b', 'bytes=-x'):
+            self.assertEqual(webook_http.parse_range_header(header_value, 1000), None, header_value)
+
+    def test_too_many_ranges_ignored(self):
+        header_value = 'bytes=' + ','.join('%d-%d' % (n, n) for n in range(webook_http.MAX_RANGES + 1))
+        self.assertEqual(webook_http.parse_range_header(header_value, 1000), None)
+
+
+class TestEtags(unittest.TestCase):
+    def test_make_etag_stable(self):
+        etag = webook_http.make_etag('a', 1, 2.0)
+        self.assertEqual(etag, webook_http.make_etag('a', 1, 2.0))
+        self.assertNotEqual(etag, webook_http.make_etag('a', 1, 3.0))
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+
+    def test_parse_etags(self):
+        self.assertEqual(webook_http.parse_etags('"a", W/"b" ,*'), ['"a"', '"b"', '*'])
+
+    def test_etag_matches_weak_comparison(self):
+        self.assertTrue(webook_http.etag_matches('W/"a"', '"a"'))
+        self.assertTrue(webook_http.etag_matches('"a"', 'W/"a"'))
+        self.assertTrue(webook_http.etag_matches('"x", "a"', '"a"'))
+        self.assertTrue(webook_http.etag_matches('*', '"a"'))
+        self.assertFalse(webook_http.etag_matches('"b"', '"a"'))
+
+    def test_if_range_strong_comparison(self):
+        last_modified = 1000000000
+        self.assertTrue(webook_http.if_range_matches('"a"', '"a"', last_modified))
+        self.assertFalse(webook_http.if_range_matches('W/"a"', '"a"', last_modified))
+        self.assertFalse(webook_http.if_range_matches('"b"', '"a"', last_modified))
+        http_date = webook_http.header_format_date_time(last_modified)
+        self.assertTrue(webook_http.if_range_matches(http_date, '"a"', last_modified))
+        self.assertFalse(webook_http.if_range_matches(http_date, '"a"', last_modified + 1))
+
+    def test_http_date_round_trip(self):
+        timestamp = 1234567890
+        self.assertEqual(webook_http.parse_http_date(webook_http.header_format_date_time(timestamp)), timestamp)
+        self.assertEqual(webook_http.parse_http_date('not a date'), None)
+
+
+class TestNotModified(unittest.TestCase):
+    etag = '"abc"'
+    last_modified = 1000000000
+
+    def check(self, environ):
+        start_response = StartResponse()
+        headers = [('Content-Type', 'text/plain'), ('Cache-Control', 'no-cache')]
+        result = webook_http.not_modified_response(environ, start_response, headers, self.etag, self.last_modified)
+        return result, start_response, headers
+
+    def test_unconditional(self):
+        result, start_response, headers = self.check({'REQUEST_METHOD': 'GET'})
+        self.assertEqual(result, None)
+        self.assertEqual(start_response.status, None)
+        self.assertIn(('ETag', self.etag), headers)
+        self.assertIn(('Last-Modified', webook_http.header_format_date_time(self.last_modified)), headers)
+
+    def test_if_none_match(self):
+        result, start_response, headers = self.check({'REQUEST_METHOD': 'GET', 'HTTP_IF_NONE_MATCH': 'W/"abc"'})
+        self.assertEqual(result, [])
+        self.assertTrue(start_response.status.startswith('304'))
+        header_names = [name.lower() for name, value in start_response.headers]
+        self.assertEqual(sorted(header_names), ['cache-control', 'etag', 'last-modified'])  # no Content-Type
+        self.assertEqual(header_names.count('etag'), 1)
+
+    def test_if_none_match_takes_precedence(self):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'HTTP_IF_NONE_MATCH': '"other"',
+            'HTTP_IF_MODIFIED_SINCE': webook_http.header_format_date_time(self.last_modified),
+        }
+        result, start_response, headers = self.check(environ)
+        self.assertEqual(result, None)
+
+    def test_if_modified_since(self):
+        http_date = webook_http.header_format_date_time(self.last_modified)
+        result, start_response, headers = self.check({'REQUEST_METHOD': 'HEAD', 'HTTP_IF_MODIFIED_SINCE': http_date})
+        self.assertEqual(result, [])
+        older_date = webook_http.header_format_date_time(self.last_modified - 1)
+        result, start_response, headers = self.check({'REQUEST_METHOD': 'GET', 'HTTP_IF_MODIFIED_SINCE': older_date})
+        self.assertEqual(result, None)
+
+    def test_only_get_and_head(self):
+        result, start_response, headers = self.check({'REQUEST_METHOD': 'POST', 'HTTP_IF_NONE_MATCH': self.etag})
+        self.assertEqual(result, None)
+
+
+class TestMultipartRanges(unittest.TestCase):
+    def test_body_matches_content_length(self):
+        import io
+        data = b'0123456789' * 10
+        ranges = [(0, 4), (95, 99)]
+        body = webook_http.MultipartRangesWrapper(io.BytesIO(data), ranges, len(data), 'text/plain', 'BOUNDARY')
+        content = b''.join(body)
+        body.close()
+        self.assertEqual(len(content), body.content_length())
+        self.assertIn(b'Content-Range: bytes 0-4/100\r\n\r\n01234\r\n', content)
+        self.assertIn(b'Content-Range: bytes 95-99/100\r\n\r\n56789\r\n--BOUNDARY--\r\n', content)
+
+
+if __name__ == '__main__':
+    unittest.main()
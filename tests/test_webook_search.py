@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for webook_search, tokenizing and ranking
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from webook_index import IndexEntry
+import webook_search
+
+
+def entry(path, is_dir=False):
+    path = path.replace('/', os.sep)
+    return IndexEntry(path, path.lower(), 0 if is_dir else 1024, 1000000000.0, is_dir)
+
+
+class TestTokenize(unittest.TestCase):
+    def test_fold(self):
+        self.assertEqual(webook_search.fold(u'Cervántes'), u'cervantes')
+        self.assertEqual(webook_search.fold(u'Doyle'), u'doyle')
+
+    def test_separators(self):
+        self.assertEqual(webook_search.tokenize(u'Doyle, Arthur_Conan - 01.Study-in-Scarlet.epub'),
+                         [u'doyle', u'arthur', u'conan', u'01', u'study', u'in', u'scarlet', u'epub'])
+
+    def test_document_tokens_weights(self):
+        tokens = webook_search.document_tokens(os.path.join(u'Doyle', u'Study.epub'), False, title=u'A Study', author=u'Arthur Doyle')
+        self.assertEqual(tokens[u'study'], webook_search.TITLE_WEIGHT)
+        self.assertEqual(tokens[u'doyle'], webook_search.AUTHOR_WEIGHT)  # highest weight wins, author over directory
+        self.assertEqual(tokens[u'epub'], webook_search.EXTENSION_WEIGHT)
+
+    def test_trigrams(self):
+        self.assertEqual(webook_search.trigrams(u'ab'), set([u'  a', u' ab', u'ab ']))
+
+
+class TestTokenIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = webook_search.TokenIndex()
+        self.index.sync([
+            entry('Doyle', is_dir=True),
+            entry('Doyle/Study in Scarlet.epub'),
+            entry('Doyle/Hound of the Baskervilles.epub'),
+            entry('Misc/Scarlet Letter.txt'),
+            entry('Misc/Sherlock Doyle Companion.pdf'),
+        ])
+
+    def search(self, query, limit=None):
+        return [path.replace(os.sep, '/') for path in self.index.search(query, limit=limit)]
+
+    def test_all_words_must_match(self):
+        self.assertEqual(self.search(u'scarlet study'), ['Doyle/Study in Scarlet.epub'])
+        self.assertEqual(self.search(u'scarlet hound'), [])
+        self.assertEqual(self.search(u'nothing'), [])
+        self.assertEqual(self.search(u' ,. '), [])
+
+    def test_ranking(self):
+        # title matches rank above directory matches, ties in path order
+        self.assertEqual(self.search(u'doyle'), [
+            'Doyle',
+            'Misc/Sherlock Doyle Companion.pdf',
+            'Doyle/Hound of the Baskervilles.epub',
+            'Doyle/Study in Scarlet.epub',
+        ])
+
+    def test_exact_over_prefix(self):
+        self.index.update(entry('Misc/Scarletina.epub'))
+        self.assertEqual(self.search(u'scarlet'), [
+            'Doyle/Study in Scarlet.epub',
+            'Misc/Scarlet Letter.txt',
+            'Misc/Scarletina.epub',
+        ])
+
+    def test_prefix_and_case(self):
+        self.assertEqual(self.search(u'SHERL'), ['Misc/Sherlock Doyle Companion.pdf'])
+        self.assertEqual(self.search(u'baskerv'), ['Doyle/Hound of the Baskervilles.epub'])
+
+    def test_limit(self):
+        self.assertEqual(self.search(u'doyle', limit=2), ['Doyle', 'Misc/Sherlock Doyle Companion.pdf'])
+
+    def test_metadata(self):
+        metadata = {os.path.join('Misc', 'Scarlet Letter.txt'): (u'The Scarlet Letter', u'Nathaniel Hawthorne')}
+        index = webook_search.TokenIndex(metadata_function=lambda index_entry: metadata.get(index_entry.path, (None, None)))
+        index.sync([entry('Misc/Scarlet Letter.txt'), entry('Doyle/Study in Scarlet.epub')])
+        self.assertEqual(index.search(u'hawthorne'), [os.path.join('Misc', 'Scarlet Letter.txt')])
+
+    def test_remove(self):
+        self.index.index_changed([], [entry('Misc/Sherlock Doyle Companion.pdf')])
+        self.assertEqual(self.search(u'sherlock'), [])
+        self.assertNotIn(u'sherlock', self.index.vocabulary)
+        self.assertEqual(len(self.index), 4)
+
+    def test_sync_removes_stale(self):
+        self.index.sync([entry('Doyle/Study in Scarlet.epub')])
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.search(u'scarlet'), ['Doyle/Study in Scarlet.epub'])
+
+    def test_fuzzy(self):
+        self.assertEqual([path.replace(os.sep, '/') for path in self.index.fuzzy_search(u'baskervile')], ['Doyle/Hound of the Baskervilles.epub'])
+        self.assertEqual(self.index.fuzzy_search(u'xyzzy'), [])
+
+    def test_accents(self):
+        self.index.update(entry(u'Cervántes/Don Quixote.epub'))
+        self.assertEqual(self.search(u'cervantes'), [u'Cervántes/Don Quixote.epub'])
+
+
+if __name__ == '__main__':
+    unittest.main()
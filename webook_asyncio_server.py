@@ -0,0 +1,392 @@
+"""Python stdlib asyncio based HTTP/1.1 server for webook_server (WSGI), Python 3.7+
+
+Connections live on the event loop, a client (e.g. KOReader holding a
+keep-alive connection open while the user reads) costs a socket and a
+coroutine rather than a thread.
+
+    Event loop - connections, request parsing, keep-alive, writing responses.
+        Already rendered bodies (lists of bytes, e.g. cached feeds and static
+        documents) are written directly. Files (webook_http.FileRangeWrapper)
+        are sent with loop.sendfile(), zero-copy where supported.
+    Executor (thread pool) - calling the WSGI application and iterating
+        generated bodies, as these stat/list directories and may wait for
+        conversions (the application is a regular, blocking, WSGI app).
+
+So a 30 second conversion occupies one executor thread, other clients
+continue to be served.
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import logging
+import sys
+import time
+
+from urllib.parse import unquote
+
+from webook_http import FileRangeWrapper, header_format_date_time
+
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+DEFAULT_THREADS = 16  # executor threads, i.e. requests being processed at once (not connections)
+KEEPALIVE_TIMEOUT = 75  # seconds, idle keep-alive connections are closed after this
+REQUEST_LINE_LIMIT = 65536  # bytes, same as wsgiref
+MAX_HEADERS = 100
+MAX_BLANK_LINES = 8  # CRLFs tolerated before a request line, e.g. left over after a POST body
+MAX_REQUEST_BODY = 1024 * 1024  # bytes, the application only needs GET (and small forms)
+SERVER_SOFTWARE = 'webook_asyncio/0.1 Python/%s' % sys.version.split()[0]
+
+STATUS_BAD_REQUEST = '400 BAD REQUEST'
+STATUS_LENGTH_REQUIRED = '411 LENGTH REQUIRED'
+STATUS_PAYLOAD_TOO_LARGE = '413 PAYLOAD TOO LARGE'
+STATUS_URI_TOO_LONG = '414 URI TOO LONG'
+STATUS_HEADERS_TOO_LARGE = '431 REQUEST HEADER FIELDS TOO LARGE'
+STATUS_INTERNAL_SERVER_ERROR = '500 INTERNAL SERVER ERROR'
+
+
+class BadRequest(Exception):
+    """Request could not be parsed, args are (status, reason)"""
+
+
+class WSGIResponse(object):
+    """Result of calling the WSGI application (in the executor); status, headers, and body iterable.
+    first_chunks are body chunks already read from the iterable, to get start_response() called for generators
+    """
+    def __init__(self):
+        self.status = None
+        self.headers = None
+        self.result = None
+        self.iterator = None
+        self.first_chunks = []
+        self.exhausted = False
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.status is not None and self.first_chunks:
+                    raise exc_info[1].with_traceback(exc_info[2])  # too late, headers sent
+            finally:
+                exc_info = None
+        elif self.status is not None:
+            raise AssertionError('start_response() already called')
+        self.status = status
+        self.headers = list(headers)
+        return self.write
+
+    def write(self, data):
+        """Legacy WSGI write() callable, buffered until the application returns"""
+        self.first_chunks.append(data)
+
+    def call(self, application, environ):
+        """Call application, and iterate the body until start_response() is called (or the body is exhausted)
+        """
+        self.result = application(environ, self.start_response)
+        if isinstance(self.result, (list, tuple)) or isinstance(self.result, FileRangeWrapper):
+            return self  # nothing to iterate in the executor
+        self.iterator = iter(self.result)
+        while self.status is None:
+            try:
+                self.first_chunks.append(next(self.iterator))
+            except StopIteration:
+                self.exhausted = True
+                break
+        return self
+
+    def next_chunk(self):
+        """Returns next body chunk, None once exhausted. Called in executor"""
+        for chunk in self.iterator:
+            if chunk:
+                return chunk
+        return None
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+
+def header_value(headers, name):
+    name = name.lower()
+    for header_name, value in headers:
+        if header_name.lower() == name:
+            return value
+    return None
+
+
+class AsyncioWSGIServer(object):
+    def __init__(self, application, host, port, threads=DEFAULT_THREADS, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        """threads - executor threads for the application, i.e. the number of requests processed at once
+        """
+        self.application = application
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='webook-asyncio')
+        self.server = None
+        self.connections = 0
+        self.requests = 0
+
+    def base_environ(self):
+        return {
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SCRIPT_NAME': '',
+            'SERVER_SOFTWARE': SERVER_SOFTWARE,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileRangeWrapper,
+        }
+
+    async def read_request(self, reader, peername):
+        """Returns (environ, request_line) or None if the client closed the connection (or went idle). Raises BadRequest
+        """
+        blank_lines = 0
+        while True:
+            try:
+                request_line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+            except (asyncio.TimeoutError, ConnectionError):
+                return None
+            except (asyncio.LimitOverrunError, ValueError):
+                raise BadRequest(STATUS_URI_TOO_LONG, 'request line too long')
+            if not request_line:
+                return None  # closed
+            if len(request_line) > REQUEST_LINE_LIMIT:
+                raise BadRequest(STATUS_URI_TOO_LONG, 'request line too long')
+            request_line = request_line.decode('iso-8859-1').rstrip('\r\n')
+            if request_line:
+                break
+            blank_lines += 1  # tolerate (a few) blank lines between requests (RFC 7230 3.5)
+            if blank_lines > MAX_BLANK_LINES:
+                raise BadRequest(STATUS_BAD_REQUEST, 'too many blank lines before request line')
+        parts = request_line.split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise BadRequest(STATUS_BAD_REQUEST, 'bad request line %r' % request_line)
+        method, target, protocol = parts
+
+        environ = self.base_environ()
+        headers_read = 0
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+            except (asyncio.LimitOverrunError, ValueError):
+                raise BadRequest(STATUS_HEADERS_TOO_LARGE, 'header line too long')
+            if line in (b'\r\n', b'\n', b''):
+                break
+            headers_read += 1
+            if headers_read > MAX_HEADERS:
+                raise BadRequest(STATUS_HEADERS_TOO_LARGE, 'too many headers')
+            name, sep, value = line.decode('iso-8859-1').partition(':')
+            if not sep:
+                raise BadRequest(STATUS_BAD_REQUEST, 'bad header line %r' % line)
+            name = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+                key = name
+            else:
+                key = 'HTTP_' + name
+            if key in environ:
+                environ[key] += ',' + value  # repeated header
+            else:
+                environ[key] = value
+
+        if environ.get('HTTP_TRANSFER_ENCODING'):
+            raise BadRequest(STATUS_LENGTH_REQUIRED, 'chunked request bodies not supported')
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise BadRequest(STATUS_BAD_REQUEST, 'bad Content-Length')
+        if content_length > MAX_REQUEST_BODY:
+            raise BadRequest(STATUS_PAYLOAD_TOO_LARGE, 'request body too large')
+        body = await reader.readexactly(content_length) if content_length > 0 else b''
+
+        path, _, query = target.partition('?')
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': unquote(path, 'iso-8859-1'),
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': peername[0] if peername else '',
+            'wsgi.input': io.BytesIO(body),
+        })
+        environ.setdefault('CONTENT_TYPE', 'text/plain')
+        return environ, request_line
+
+    def keep_alive(self, environ):
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        peername = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader, peername)
+                except BadRequest as info:
+                    status, reason = info.args
+                    log.info('%s bad request: %s', peername, reason)
+                    await self.send_simple(writer, status, reason, keep_alive=False)
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                environ, request_line = request
+                keep_alive = self.keep_alive(environ)
+                self.requests += 1
+                try:
+                    keep_alive = await self.handle_request(environ, request_line, writer, keep_alive)
+                except (ConnectionError, asyncio.CancelledError):
+                    break
+                if not keep_alive:
+                    break
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def send_simple(self, writer, status, message, keep_alive=True):
+        body = message.encode('utf-8', 'replace')
+        headers = [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))]
+        try:
+            writer.write(self.response_head('HTTP/1.1', status, headers, keep_alive) + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def response_head(self, protocol, status, headers, keep_alive):
+        lines = ['HTTP/1.1 ' + status]
+        if header_value(headers, 'date') is None:
+            lines.append('Date: ' + header_format_date_time(time.time()))
+        if header_value(headers, 'server') is None:
+            lines.append('Server: ' + SERVER_SOFTWARE)
+        for name, value in headers:
+            lines.append('%s: %s' % (name, value))
+        if not keep_alive:
+            lines.append('Connection: close')
+        elif protocol == 'HTTP/1.0':
+            lines.append('Connection: keep-alive')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+
+    async def handle_request(self, environ, request_line, writer, keep_alive):
+        """Serve a single request, returns True if the connection can be kept open for the next request
+        """
+        loop = asyncio.get_event_loop()
+        protocol = environ['SERVER_PROTOCOL']
+        start_time = time.time()
+        try:
+            response = await loop.run_in_executor(self.executor, WSGIResponse().call, self.application, environ)
+        except Exception:
+            log.exception('application error %r', request_line)
+            await self.send_simple(writer, STATUS_INTERNAL_SERVER_ERROR, 'Internal Server Error', keep_alive=keep_alive)
+            return keep_alive
+        if response.status is None:
+            log.error('application did not call start_response() %r', request_line)
+            await loop.run_in_executor(self.executor, response.close)
+            await self.send_simple(writer, STATUS_INTERNAL_SERVER_ERROR, 'Internal Server Error', keep_alive=keep_alive)
+            return keep_alive
+
+        headers = response.headers
+        result = response.result
+        head_only = environ['REQUEST_METHOD'] == 'HEAD'
+        chunked = False
+        if header_value(headers, 'content-length') is None and not response.status.startswith(('1', '204', '304')):
+            if isinstance(result, (list, tuple)):
+                headers.append(('Content-Length', str(sum(len(chunk) for chunk in response.first_chunks) + sum(len(chunk) for chunk in result))))
+            elif protocol == 'HTTP/1.1':
+                headers.append(('Transfer-Encoding', 'chunked'))
+                chunked = True
+            else:
+                keep_alive = False  # HTTP/1.0 client, body ends when connection closes
+
+        bytes_sent = 0
+        try:
+            writer.write(self.response_head(protocol, response.status, headers, keep_alive))
+            if not head_only:
+                bytes_sent = await self.write_body(loop, writer, response, chunked)
+            await writer.drain()
+        except Exception as info:
+            if not isinstance(info, ConnectionError):
+                log.exception('error sending response %r', request_line)
+            keep_alive = False  # headers already sent, only option is to drop the connection
+        finally:
+            if isinstance(result, (list, tuple)) or isinstance(result, FileRangeWrapper):
+                response.close()  # quick, no need for executor
+            else:
+                await loop.run_in_executor(self.executor, response.close)  # generators may do work in finally
+        log.info('%s "%s" %s %d %0.3fs', environ.get('REMOTE_ADDR'), request_line, response.status.split(' ', 1)[0], bytes_sent, time.time() - start_time)
+        return keep_alive
+
+    async def write_body(self, loop, writer, response, chunked):
+        """Write response body, returns number of (body) bytes sent
+        """
+        bytes_sent = 0
+
+        def write(data):
+            if chunked:
+                writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                writer.write(data)
+
+        for chunk in response.first_chunks:
+            if chunk:
+                write(chunk)
+                bytes_sent += len(chunk)
+        result = response.result
+
+        if isinstance(result, FileRangeWrapper) and not chunked and hasattr(loop, 'sendfile'):
+            await writer.drain()  # headers (and anything buffered) before the file
+            bytes_sent += await loop.sendfile(writer.transport, result.filelike, result.offset, result.length)  # falls back to read/write if zero-copy is not possible
+        elif isinstance(result, (list, tuple)) or (isinstance(result, FileRangeWrapper) and not chunked):
+            for chunk in result:  # already in memory, or file blocks (page cache reads)
+                if chunk:
+                    write(chunk)
+                    bytes_sent += len(chunk)
+                    await writer.drain()
+        elif not response.exhausted:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, response.next_chunk)
+                if chunk is None:
+                    break
+                write(chunk)
+                bytes_sent += len(chunk)
+                await writer.drain()  # back pressure, slow clients do not buffer the entire body
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        return bytes_sent
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=REQUEST_LINE_LIMIT + 2, reuse_address=True)
+        return self.server
+
+    def serve_forever(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.start())
+        try:
+            loop.run_forever()
+        finally:
+            self.server.close()
+            loop.run_until_complete(self.server.wait_closed())
+            self.executor.shutdown(wait=False)
+            loop.close()
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            'requests': self.requests,
+        }
+
+
+def make_server(host, port, app, threads=DEFAULT_THREADS):
+    """Create a new asyncio WSGI server listening on `host` and `port` for `app`, call serve_forever() to run"""
+    return AsyncioWSGIServer(app, host, port, threads=threads)
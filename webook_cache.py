@@ -0,0 +1,583 @@
+"""On-disk caching for webook_server
+
+ConversionCache - content-addressed cache of converted ebooks, keyed by
+source path, size, mtime, target format and conversion tool version.
+Bounded by a byte budget with least-recently-used eviction. Survives
+restarts, the cache directory is re-scanned on startup and file atimes
+are used to record last access. File mtimes are left as the time of
+conversion, so (path, size, mtime) of a cached file identifies its bytes,
+e.g. for ETags.
+
+ConversionCoordinator - single-flight wrapper around ConversionCache, only
+one conversion per (source, format) is in progress at any one time and
+concurrent requests for the same conversion wait for and share the result.
+Conversions can also be started without waiting, and for formats the
+converter writes append-only the output followed as it is written, see
+follow_conversion().
+
+ConversionScheduler - fixed size pool of conversion worker threads with a
+bounded queue, rejects new work once full (rather than starting an
+unbounded number of conversions) and applies a per-job timeout.
+
+FeedCache - in-memory cache of rendered (encoded) catalog responses, e.g.
+directory listings, with a validator (e.g. directory mtime) that invalidates
+an entry when it no longer matches. Bounded by a byte budget with
+least-recently-used eviction.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    # py2
+    import Queue as queue
+
+import ebook_conversion
+
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+DEFAULT_CONVERSION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_CONVERSION_WORKERS = 2
+DEFAULT_CONVERSION_QUEUE_SIZE = 8
+DEFAULT_CONVERSION_TIMEOUT = 5 * 60  # seconds
+TEMP_FILENAME_MARKER = '.tmp.'
+DEFAULT_FEED_CACHE_MAX_BYTES = 16 * 1024 * 1024
+FOLLOW_POLL_INTERVAL = 0.25  # seconds, how often output of a conversion in progress is checked for more data
+FOLLOW_BLOCK_SIZE = 64 * 1024  # bytes
+
+
+class ConversionError(Exception):
+    """Conversion did not produce an output file"""
+
+
+class ConversionQueueFull(Exception):
+    """Too many conversions pending, try again later"""
+
+
+ConversionTimeout = ebook_conversion.ConversionTimeout
+
+
+def remove_stale_temp_files(cache_dir):
+    """Remove partial conversions (temp files) left in cache_dir by a previous run
+    """
+    try:
+        filenames = os.listdir(cache_dir)
+    except OSError:
+        return  # missing, nothing to remove
+    for filename in filenames:
+        if TEMP_FILENAME_MARKER in filename:
+            full_path = os.path.join(cache_dir, filename)
+            log.info('removing stale conversion %r', full_path)
+            try:
+                os.remove(full_path)
+            except OSError:
+                pass
+
+
+class ConversionCache(object):
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CONVERSION_CACHE_MAX_BYTES, convert_function=None, version_function=None, remove_stale=True):
+        """cache_dir - directory to store converted files in, created if missing
+        max_bytes - byte budget, least recently used files are removed once exceeded
+        convert_function - convert(original_filename, new_filename, timeout=None), defaults to ebook_conversion.convert
+        version_function - defaults to ebook_conversion.convert_version, part of cache key so upgrading the conversion tool invalidates old entries
+        remove_stale - remove temp files found on load(). False if other processes share cache_dir, their temp files are conversions in progress
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.convert_function = convert_function or ebook_conversion.convert
+        self.version_function = version_function or ebook_conversion.convert_version
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # cache filename -> size in bytes, oldest (least recently used) first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load(remove_stale=remove_stale)
+
+    def load(self, remove_stale=True):
+        """Scan cache_dir (e.g. after restart) and rebuild LRU order from file atimes
+        remove_stale - remove temp files, partial conversions from a previous run
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        if remove_stale:
+            remove_stale_temp_files(self.cache_dir)
+        found = []
+        for filename in os.listdir(self.cache_dir):
+            full_path = os.path.join(self.cache_dir, filename)
+            if TEMP_FILENAME_MARKER in filename:
+                continue  # conversion in progress (or stale, see remove_stale)
+            try:
+                stat_result = os.stat(full_path)
+            except OSError:
+                continue
+            found.append((stat_result.st_atime, filename, stat_result.st_size))
+        found.sort()
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+            for atime, filename, size in found:
+                self.entries[filename] = size
+                self.total_bytes += size
+            self._evict()
+        log.info('conversion cache %r %d entries, %d bytes', self.cache_dir, len(self.entries), self.total_bytes)
+
+    def cache_key(self, source_filename, ebook_format):
+        """Returns string, hex digest of source path, size, mtime, target format and conversion version
+        """
+        source_filename = os.path.abspath(source_filename)
+        stat_result = os.stat(source_filename)
+        key_tuple = (source_filename, stat_result.st_size, int(stat_result.st_mtime), ebook_format.lower(), self.version_function())
+        return hashlib.sha1(repr(key_tuple).encode('utf-8')).hexdigest()
+
+    def cache_filename(self, key, ebook_format):
+        return key + '.' + ebook_format.lower()
+
+    def lookup(self, key, ebook_format):
+        """Returns full path to cached conversion or None if not cached
+        """
+        filename = self.cache_filename(key, ebook_format)
+        full_path = os.path.join(self.cache_dir, filename)
+        with self.lock:
+            size = self.entries.pop(filename, None)
+            if size is None:
+                self.misses += 1
+                return None
+            if not os.path.exists(full_path):
+                # removed behind our back
+                self.total_bytes -= size
+                self.misses += 1
+                return None
+            self.entries[filename] = size  # now most recently used
+            self.hits += 1
+        try:
+            os.utime(full_path, (time.time(), os.stat(full_path).st_mtime))  # record last access (atime), for LRU order after restart. mtime is kept
+        except OSError:
+            pass
+        return full_path
+
+    def temp_filename(self, key, ebook_format):
+        """Unique (per call) filename for conversion output, ending in the target format extension as conversion tools use it to pick the output format
+        """
+        return os.path.join(self.cache_dir, key + TEMP_FILENAME_MARKER + uuid.uuid4().hex + '.' + ebook_format.lower())
+
+    def store(self, key, ebook_format, temp_filename):
+        """Move completed conversion temp_filename into the cache, returns full path of cached file
+        """
+        filename = self.cache_filename(key, ebook_format)
+        full_path = os.path.join(self.cache_dir, filename)
+        size = os.path.getsize(temp_filename)
+        if os.path.exists(full_path) and os.name == 'nt':
+            os.remove(full_path)  # Windows rename will not replace
+        os.rename(temp_filename, full_path)  # atomic (on posix), readers never see a partial file
+        with self.lock:
+            old_size = self.entries.pop(filename, None)
+            if old_size is not None:
+                self.total_bytes -= old_size
+            self.entries[filename] = size
+            self.total_bytes += size
+            self._evict(keep=filename)
+        return full_path
+
+    def convert(self, source_filename, ebook_format, timeout=None):
+        """Returns full path to converted version of source_filename, converting only if not already cached
+        timeout - passed on to convert_function
+        """
+        key = self.cache_key(source_filename, ebook_format)
+        cached_filename = self.lookup(key, ebook_format)
+        if cached_filename:
+            log.info('conversion cache hit %r %s', source_filename, ebook_format)
+            return cached_filename
+        return self.convert_uncached(source_filename, ebook_format, key, timeout=timeout)
+
+    def convert_uncached(self, source_filename, ebook_format, key, timeout=None, job=None):
+        """Convert source_filename and store in cache under key (see cache_key()), returns full path of cached file
+        job - optional InFlightConversion, output_filename is set and started signalled once conversion starts
+        """
+        log.info('conversion cache miss %r %s', source_filename, ebook_format)
+        temp_filename = self.temp_filename(key, ebook_format)
+        start_time = time.time()
+        if job is not None:
+            job.output_filename = temp_filename
+            job.started.set()
+        try:
+            self.convert_function(source_filename, temp_filename, timeout=timeout)
+            if not os.path.exists(temp_filename):
+                raise ConversionError('conversion of %r into %s produced no output' % (source_filename, ebook_format))
+            result = self.store(key, ebook_format, temp_filename)
+        finally:
+            self._remove(temp_filename)
+        log.info('conversion took %0.2f secs', time.time() - start_time)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until within byte budget. Caller holds lock
+        """
+        while self.total_bytes > self.max_bytes and self.entries:
+            filename, size = next(iter(self.entries.items()))
+            if filename == keep:
+                if len(self.entries) == 1:
+                    break  # single entry larger than budget, keep it so it can be served
+                # move to most recently used end and carry on
+                del self.entries[filename]
+                self.entries[filename] = size
+                continue
+            del self.entries[filename]
+            self.total_bytes -= size
+            self.evictions += 1
+            log.info('conversion cache evict %r', filename)
+            self._remove(os.path.join(self.cache_dir, filename))
+
+    def _remove(self, full_path):
+        try:
+            os.remove(full_path)
+        except OSError:
+            # missing, or (Windows) still open by a reader
+            pass
+
+
+class InFlightConversion(object):
+    """A conversion in progress, shared by all requests for the same (source, format)
+    """
+    def __init__(self):
+        self.event = threading.Event()  # set once complete, result or error
+        self.started = threading.Event()  # set once output is being written to output_filename (or complete)
+        self.output_filename = None  # temporary, renamed to result on success
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class ConversionScheduler(object):
+    def __init__(self, max_workers=DEFAULT_CONVERSION_WORKERS, max_queue=DEFAULT_CONVERSION_QUEUE_SIZE, timeout=DEFAULT_CONVERSION_TIMEOUT):
+        """max_workers - maximum number of conversions running at once
+        max_queue - maximum number of conversions waiting for a worker, ConversionQueueFull raised when exceeded
+        timeout - seconds, per job. Passed to the conversion function which may kill it
+            (external ebook-convert), in-process conversions can not be killed and keep their
+            worker busy but the requester stops waiting
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.workers = []
+        self.submitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def start(self):
+        with self.lock:
+            while len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self.worker_loop, name='conversion-worker-%d' % len(self.workers))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def worker_loop(self):
+        while True:
+            job, function, args = self.queue.get()
+            try:
+                job.result = function(*args, timeout=self.timeout)
+            except Exception as info:
+                job.error = info
+            job.event.set()
+
+    def submit(self, function, *args):
+        """Queue function(*args, timeout=...) for a worker, returns InFlightConversion.
+        Raises ConversionQueueFull if queue is full
+        """
+        self.start()
+        job = InFlightConversion()
+        try:
+            self.queue.put_nowait((job, function, args))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise ConversionQueueFull('%d conversions already queued' % self.max_queue)
+        with self.lock:
+            self.submitted += 1
+        return job
+
+    def wait_timeout(self):
+        """Returns seconds to wait for a submitted job to complete, None for no limit.
+        Time in queue is not included in job timeout, allow for a full queue ahead of us
+        """
+        if not self.timeout:
+            return None
+        return self.timeout * (1 + (self.max_queue + self.max_workers - 1) // self.max_workers) + 1
+
+    def run(self, function, *args):
+        """Run function(*args, timeout=...) in a worker and wait for the result
+        """
+        job = self.submit(function, *args)
+        wait_timeout = self.wait_timeout()
+        if not job.event.wait(wait_timeout):
+            with self.lock:
+                self.timed_out += 1
+            raise ConversionTimeout('gave up waiting for conversion %r after %r secs' % (args, wait_timeout))
+        if job.error is not None:
+            if isinstance(job.error, ConversionTimeout):
+                with self.lock:
+                    self.timed_out += 1
+            raise job.error
+        return job.result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.max_workers,
+                'queued': self.queue.qsize(),
+                'max_queue': self.max_queue,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
+
+
+class ConversionCoordinator(object):
+    def __init__(self, cache, scheduler=None):
+        """cache - ConversionCache, does the actual conversion (or cache lookup)
+        scheduler - optional ConversionScheduler to run conversions in, if omitted conversion runs in the calling thread
+        """
+        self.cache = cache
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.in_flight = {}  # (source_filename, ebook_format) -> InFlightConversion
+        self.requests = 0
+        self.coalesced = 0
+        self.timed_out = 0  # requests that gave up waiting, conversion carried on
+
+    def convert(self, source_filename, ebook_format):
+        """Returns full path to converted version of source_filename.
+        If the same conversion is already in progress, waits for it rather than starting another.
+        Raises ConversionTimeout if not complete within wait_timeout(), the conversion is left running (and in flight)
+        so later requests wait for it rather than starting a second one alongside
+        """
+        job = self.start(source_filename, ebook_format)
+        wait_timeout = self.wait_timeout()
+        if not job.event.wait(wait_timeout):
+            with self.lock:
+                self.timed_out += 1
+            raise ConversionTimeout('gave up waiting for conversion %r %s after %r secs' % (source_filename, ebook_format, wait_timeout))
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def start(self, source_filename, ebook_format):
+        """Start conversion of source_filename (or join one already in progress) without waiting for it to complete.
+        Returns InFlightConversion, see follow_conversion(). Already cached conversions are returned complete.
+        Raises ConversionQueueFull
+        """
+        key = (os.path.abspath(source_filename), ebook_format.lower())
+        with self.lock:
+            self.requests += 1
+            job = self.in_flight.get(key)
+            if job is not None:
+                job.waiters += 1
+                self.coalesced += 1
+                log.info('conversion already in progress, joining %r %s', source_filename, ebook_format)
+                return job
+            job = InFlightConversion()
+            self.in_flight[key] = job
+
+        try:
+            cache_key = self.cache.cache_key(source_filename, ebook_format)
+            cached_filename = self.cache.lookup(cache_key, ebook_format)
+            if cached_filename:
+                log.info('conversion cache hit %r %s', source_filename, ebook_format)
+                self.finish(key, job, result=cached_filename)
+            elif self.scheduler:
+                self.scheduler.submit(self.run_job, key, job, source_filename, ebook_format, cache_key)
+            else:
+                self.run_job(key, job, source_filename, ebook_format, cache_key)
+        except Exception as info:
+            self.finish(key, job, error=info)
+            raise
+        return job
+
+    def run_job(self, key, job, source_filename, ebook_format, cache_key, timeout=None):
+        """Conversion for start(), errors are recorded in job. job stays in flight until this returns,
+        even if every requester has given up waiting
+        """
+        try:
+            result = self.cache.convert_uncached(source_filename, ebook_format, cache_key, timeout=timeout, job=job)
+        except Exception as info:
+            self.finish(key, job, error=info)
+        else:
+            self.finish(key, job, result=result)
+
+    def finish(self, key, job, result=None, error=None):
+        job.result = result
+        job.error = error
+        with self.lock:
+            del self.in_flight[key]
+        job.started.set()
+        job.event.set()
+        if job.waiters:
+            log.info('conversion %r %s shared with %d waiting requests', key[0], key[1], job.waiters)
+
+    def wait_timeout(self):
+        """Returns seconds to wait for a conversion to complete, None for no limit
+        """
+        if self.scheduler:
+            return self.scheduler.wait_timeout()
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'coalesced': self.coalesced,
+                'timed_out': self.timed_out,
+                'in_flight': len(self.in_flight),
+            }
+
+
+def follow_conversion(job, wait_timeout=None, poll_interval=FOLLOW_POLL_INTERVAL, blksize=FOLLOW_BLOCK_SIZE):
+    """Generator, output of (started, see InFlightConversion.started) conversion job as it is written, until the conversion completes.
+    Only valid for formats the converter writes append-only, see ebook_conversion.supports_streaming().
+    Raises the conversion error (after the output so far), or ConversionTimeout if not complete within wait_timeout seconds
+    """
+    deadline = wait_timeout and time.time() + wait_timeout
+    f = None
+    try:
+        while True:
+            done = job.event.is_set()  # checked before reading, so everything written before completion is read
+            if f is None:
+                filename = job.result if done and job.error is None else job.output_filename
+                if filename is not None:
+                    try:
+                        f = open(filename, 'rb')
+                    except (IOError, OSError):
+                        if done and job.error is None:
+                            raise  # converted file removed (evicted) already
+                        # not created yet, or completed (and renamed) since done was checked
+            if f is not None:
+                data = f.read(blksize)
+                if data:
+                    yield data
+                    continue
+            if done:
+                if job.error is not None:
+                    raise job.error
+                return
+            if deadline and time.time() > deadline:
+                raise ConversionTimeout('gave up following conversion %r after %r secs' % (job.output_filename, wait_timeout))
+            job.event.wait(poll_interval)
+    finally:
+        if f is not None:
+            f.close()
+
+
+class FeedCache(object):
+    def __init__(self, max_bytes=DEFAULT_FEED_CACHE_MAX_BYTES):
+        """max_bytes - byte budget for rendered responses, 0 disables caching
+        """
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (validator, bytes), least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def lookup(self, key, validator):
+        """Returns cached bytes for key, or None if not cached or cached with a different validator (stale)
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            cached_validator, body = entry
+            if cached_validator != validator:
+                self.total_bytes -= len(body)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self.entries[key] = entry  # now most recently used
+            self.hits += 1
+            return body
+
+    def store(self, key, validator, body):
+        if len(body) > self.max_bytes:
+            return  # also covers caching disabled
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.total_bytes -= len(old_entry[1])
+            self.entries[key] = (validator, body)
+            self.total_bytes += len(body)
+            while self.total_bytes > self.max_bytes:
+                old_key, (old_validator, old_body) = self.entries.popitem(last=False)
+                self.total_bytes -= len(old_body)
+                self.evictions += 1
+
+    def tee(self, key, validator, iterable):
+        """Returns iterable of byte strings from iterable, once complete they are stored (joined) in the cache.
+        Nothing is stored if iteration does not complete (e.g. client disconnected) or the response outgrows max_bytes,
+        in which case buffering stops. With caching disabled iterable is returned as-is
+        """
+        if self.max_bytes <= 0:
+            return iterable
+        return self._tee(key, validator, iterable)
+
+    def _tee(self, key, validator, iterable):
+        chunks = []
+        size = 0
+        try:
+            for chunk in iterable:
+                if chunks is not None:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        chunks = None  # too big to cache, stop buffering
+                    else:
+                        chunks.append(chunk)
+                yield chunk
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        if chunks is not None:
+            self.store(key, validator, b''.join(chunks))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,315 @@
+"""HTTP response compression (Content-Encoding gzip / deflate), WSGI middleware
+
+OPDS feeds and html listings are repetitive text that compresses to a
+fraction of its size, much less to send over (slow) e-reader WiFi.
+
+The encoding is negotiated from the request Accept-Encoding (q-values are
+honored, gzip is preferred) and only used for text-like content types, see
+COMPRESSIBLE_TYPES. Responses that are already encoded, partial (range)
+responses and files (served with Accept-Ranges, byte ranges refer to the
+file) are passed through untouched, so sendfile still applies.
+
+  * List (known) bodies are compressed in one go and sent with Content-Length, so persistent connections can be used
+  * Iterable (generator) bodies are compressed as they are produced, each chunk is flushed so clients see progress
+  * Vary: Accept-Encoding is added to compressible responses, so caches keep the variants apart
+  * ETags of compressed responses get an encoding suffix ("etag" -> "etag-gzip"), a different representation needs
+    a different (strong) ETag. Suffixes are removed from If-None-Match before the application sees it, so the
+    application's conditional request (304) handling still matches
+
+PrecompressedDocument - constant documents kept in memory as identity and
+gzip bytes, served without compressing per request (the middleware passes
+them through as they are already encoded).
+"""
+
+import logging
+import zlib
+
+from webook_http import NOT_MODIFIED_HEADERS, header_format_date_time, is_not_modified, make_etag
+
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+COMPRESSIBLE_TYPES = ('text/', 'application/atom+xml', 'application/xml', 'application/opensearchdescription+xml', 'application/xhtml+xml', 'application/json', 'application/javascript')  # lower case prefixes
+ENCODINGS = ('gzip', 'deflate')  # in order of preference
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,  # gzip header and trailer
+    'deflate': zlib.MAX_WBITS,  # HTTP "deflate" is the zlib format (RFC 1950), not raw deflate
+}
+DEFAULT_COMPRESSION_LEVEL = 6  # zlib default, most of the gain for a fraction of the CPU of 9
+PRECOMPRESSED_LEVEL = 9  # compressed once, so smallest
+DEFAULT_MIN_SIZE = 256  # bytes, smaller known bodies are sent as-is, compression overhead outweighs any saving
+
+
+def parse_accept_encoding(header_value):
+    """Returns dict of (lower case) content-coding -> q value, for Accept-Encoding header value
+    """
+    result = {}
+    for item in header_value.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        result[coding] = q
+    return result
+
+def choose_encoding(header_value):
+    """Returns 'gzip', 'deflate' or None (identity) for Accept-Encoding header value
+    """
+    if not header_value:
+        return None
+    accepted = parse_accept_encoding(header_value)
+    if 'x-gzip' in accepted and 'gzip' not in accepted:
+        accepted['gzip'] = accepted['x-gzip']  # HTTP/1.0 era alias
+    default_q = accepted.get('*', 0.0)
+    best_encoding, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = accepted.get(encoding, default_q)
+        if q > best_q:
+            best_encoding, best_q = encoding, q
+    return best_encoding
+
+def is_compressible(content_type):
+    return (content_type or '').strip().lower().startswith(COMPRESSIBLE_TYPES)
+
+def encoded_etag(etag, encoding):
+    """Returns ETag for encoding variant, e.g. '"abc"' -> '"abc-gzip"' (weak prefix is kept)
+    """
+    if etag.endswith('"') and not etag.endswith('-%s"' % encoding):
+        return '%s-%s"' % (etag[:-1], encoding)
+    return etag
+
+def strip_etag_suffixes(header_value):
+    """Returns If-None-Match header_value with encoded_etag() suffixes removed
+    """
+    etags = []
+    for etag in header_value.split(','):
+        etag = etag.strip()
+        for encoding in ENCODINGS:
+            suffix = '-%s"' % encoding
+            if etag.endswith(suffix):
+                etag = etag[:-len(suffix)] + '"'
+                break
+        etags.append(etag)
+    return ', '.join(etags)
+
+def compress(data, encoding, level=DEFAULT_COMPRESSION_LEVEL):
+    """Returns data (bytes) compressed with encoding, 'gzip' or 'deflate'
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+def get_header(headers, name):
+    """Returns value of first header called name (case insensitive) from list of (name, value), or None
+    """
+    name = name.lower()
+    for header_name, value in headers:
+        if header_name.lower() == name:
+            return value
+    return None
+
+def replace_header(headers, name, value=None):
+    """Returns copy of headers without name (case insensitive), with (name, value) appended if value is not None
+    """
+    lowered_name = name.lower()
+    result = [(header_name, header_value) for header_name, header_value in headers if header_name.lower() != lowered_name]
+    if value is not None:
+        result.append((name, value))
+    return result
+
+def add_vary(headers):
+    vary = get_header(headers, 'Vary')
+    if vary is None:
+        return headers + [('Vary', 'Accept-Encoding')]
+    if vary.strip() == '*' or 'accept-encoding' in [value.strip().lower() for value in vary.split(',')]:
+        return headers
+    return replace_header(headers, 'Vary', vary + ', Accept-Encoding')
+
+
+class CompressionMiddleware(object):
+    def __init__(self, application, level=DEFAULT_COMPRESSION_LEVEL, min_size=DEFAULT_MIN_SIZE):
+        """application - WSGI application to compress the responses of
+        level - zlib compression level, 1 (fastest) - 9 (smallest)
+        min_size - known (list) bodies smaller than this (bytes) are not compressed
+        """
+        self.application = application
+        self.level = level
+        self.min_size = min_size
+
+    def __call__(self, environ, start_response):
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        client_has_encoded = False  # client copy is a compressed variant
+        if if_none_match:
+            stripped = strip_etag_suffixes(if_none_match)
+            if stripped != if_none_match:
+                environ = dict(environ)
+                environ['HTTP_IF_NONE_MATCH'] = stripped
+                client_has_encoded = True
+        return CompressedResponse(self, start_response, encoding, client_has_encoded).run(environ)
+
+
+class CompressedResponse(object):
+    """A single request/response for CompressionMiddleware.
+    The application's start_response() call is captured, the real start_response is called once
+    it is known whether (and how) the body is compressed
+    """
+    def __init__(self, middleware, start_response, encoding, client_has_encoded):
+        self.middleware = middleware
+        self.real_start_response = start_response
+        self.encoding = encoding
+        self.client_has_encoded = client_has_encoded
+        self.status = None
+        self.headers = None
+        self.started = False  # real start_response has been called
+
+    def start_response(self, status, headers, exc_info=None):
+        if self.started:
+            return self.real_start_response(status, headers, exc_info)  # re-raises exc_info, headers already sent
+        self.status = status
+        self.headers = list(headers)
+        return self.write
+
+    def write(self, data):
+        raise NotImplementedError('write() callable is not supported by CompressionMiddleware, return an iterable')
+
+    def begin(self, headers):
+        self.started = True
+        self.real_start_response(self.status, headers)
+
+    def response_encoding(self, compress=True):
+        """Returns encoding to compress the response with (or None), adjusts self.headers to match.
+        compress - False to send a compressible response as-is, e.g. too small to be worth it
+        """
+        headers = self.headers
+        if self.status.startswith('304'):
+            if self.encoding and self.client_has_encoded:
+                etag = get_header(headers, 'ETag')
+                if etag:
+                    headers = replace_header(headers, 'ETag', encoded_etag(etag, self.encoding))
+                self.headers = add_vary(headers)
+            return None
+        if not self.status.startswith('200') or not is_compressible(get_header(headers, 'Content-Type')):
+            return None
+        if get_header(headers, 'Content-Encoding') or get_header(headers, 'Accept-Ranges') or get_header(headers, 'Content-Range'):
+            return None
+        self.headers = headers = add_vary(headers)
+        if self.encoding is None or not compress:
+            return None
+        etag = get_header(headers, 'ETag')
+        if etag:
+            headers = replace_header(headers, 'ETag', encoded_etag(etag, self.encoding))
+        self.headers = replace_header(replace_header(headers, 'Content-Length'), 'Content-Encoding', self.encoding)
+        return self.encoding
+
+    def compressor(self, encoding):
+        return zlib.compressobj(self.middleware.level, zlib.DEFLATED, WBITS[encoding])
+
+    def run(self, environ):
+        result = self.middleware.application(environ, self.start_response)
+        if self.status is not None and isinstance(result, (list, tuple)):
+            return self.known_body(b''.join(result))
+
+        first_chunks = []
+        body = result
+        if self.status is None:
+            # start_response not called yet, e.g. generators call it on first iteration
+            body = iter(result)
+            try:
+                for chunk in body:
+                    first_chunks.append(chunk)
+                    if self.status is not None:
+                        break
+            except Exception:
+                close(result)
+                raise
+            if self.status is None:
+                close(result)
+                raise RuntimeError('application did not call start_response')
+
+        encoding = self.response_encoding()
+        self.begin(self.headers)
+        if encoding is None and not first_chunks:
+            return result  # untouched, e.g. file wrappers for sendfile
+        return self.stream(first_chunks, body, result, encoding)
+
+    def known_body(self, body):
+        encoding = self.response_encoding(compress=len(body) >= self.middleware.min_size)
+        if encoding is not None:
+            body = compress(body, encoding, self.middleware.level)
+            self.headers.append(('Content-Length', str(len(body))))
+        self.begin(self.headers)
+        return [body]
+
+    def stream(self, first_chunks, body, result, encoding):
+        """Generator, first_chunks then the rest of body compressed with encoding (None for as-is). Closes result when done
+        """
+        compressor = encoding and self.compressor(encoding)
+        try:
+            for chunks in (first_chunks, body):
+                for chunk in chunks:
+                    if compressor and chunk:
+                        chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)  # flush, so the client gets this chunk now
+                    if chunk:
+                        yield chunk
+            if compressor:
+                yield compressor.flush()
+        finally:
+            close(result)
+
+
+class PrecompressedDocument(object):
+    """Constant response body, with identity and gzip variants (bytes) and ETags computed once
+    """
+    def __init__(self, body, content_type, last_modified=None):
+        """body - bytes
+        last_modified - timestamp, for Last-Modified. E.g. start up time, if body can only change on restart
+        """
+        self.body = body
+        self.content_type = content_type
+        self.last_modified = last_modified
+        self.etag = make_etag(body)
+        self.gzip_body = compress(body, 'gzip', PRECOMPRESSED_LEVEL)
+        if len(self.gzip_body) >= len(body):
+            self.gzip_body = None  # no saving, always send identity
+        self.gzip_etag = encoded_etag(self.etag, 'gzip')
+
+    def serve(self, environ, start_response, headers=None):
+        """Returns WSGI iterable, gzip variant if the client accepts it. Conditional requests are honored with 304s
+        """
+        headers = list(headers or [])
+        headers.append(('Content-Type', self.content_type))
+        headers.append(('Vary', 'Accept-Encoding'))
+        body, etag = self.body, self.etag
+        if self.gzip_body is not None and choose_encoding(environ.get('HTTP_ACCEPT_ENCODING')) == 'gzip':
+            body, etag = self.gzip_body, self.gzip_etag
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('ETag', etag))
+        if self.last_modified is not None:
+            headers.append(('Last-Modified', header_format_date_time(self.last_modified)))
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            environ = dict(environ)
+            environ['HTTP_IF_NONE_MATCH'] = strip_etag_suffixes(if_none_match)  # either variant is current
+        if environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD') and is_not_modified(environ, self.etag, self.last_modified):
+            start_response('304 NOT MODIFIED', [(name, value) for name, value in headers if name.lower() in NOT_MODIFIED_HEADERS])
+            return []
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        return [body]
+
+
+def close(result):
+    if hasattr(result, 'close'):
+        result.close()
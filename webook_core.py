@@ -1,9 +1,27 @@
 
 import bisect
+import errno
+import hashlib
 import json
 import logging
 import os
+import stat
 import tempfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    # py2
+    import Queue as queue
+
+try:
+    scandir = os.scandir  # py3.5+
+except AttributeError:
+    try:
+        from scandir import scandir  # py2 - https://github.com/benhoyt/scandir
+    except ImportError:
+        scandir = None
 
 
 log = logging.getLogger(__name__)
@@ -63,65 +81,130 @@ ebook_only_mimetypes = {
 def guess_mimetype(filename):
     """Guess mimetype based on filename (rather than content). Returns string.
     """
-    # FIXME not sure this is very efficient
-    ebook_format = os.path.splitext(filename)[-1].lower()  # TODO if .zip back trace in case we have .fb2.zip, .rtf.zip, .txt.zip, etc.
-    ebook_format = ebook_format[1:]  # removing leading '.'
+    return mimetype_for_extension(os.path.splitext(filename)[-1])  # TODO if .zip back trace in case we have .fb2.zip, .rtf.zip, .txt.zip, etc.
+
+def mimetype_for_extension(file_extension):
+    """file_extension - including leading '.', any case, e.g. '.epub'. Returns string.
+    """
+    ebook_format = file_extension[1:].lower()  # removing leading '.'
     mimetype_str = ebook_only_mimetypes.get(ebook_format, 'application/octet-stream')  # TODO consider fallback to mimetypes.guess_type(os_path)[0]
     return mimetype_str
 
-class BootMeta:
-    def __init__(self, filename):
-        self.filename = os.path.abspath(filename)  # expected to be absolute (relative would work)
 
-    @property
-    def author(self):
-        """Guess author name based on filename (rather than content). Returns string:
-            Lastname, Firstname
-        Currently assumes single author
-        """
-        # TODO add guess logic based on filename OR dig into metadata if exists
-        return ''  # or None?
+_file_extensions = {}  # extension -> same extension, so BootMeta instances share (rather than each hold a copy of) extension strings
 
-    @property
-    def base_filename(self):
-        """Filename only, no path. Returns string.
-        """
-        filename = os.path.basename(self.filename)
-        return filename
+class BootMeta(object):
+    """Metadata for a book, guessed from the filename (rather than content).
+    Attributes (other than filename) are computed once, on construction. Uses __slots__ so
+    large numbers of instances (e.g. entire catalog) have a small memory footprint,
+    the directory string is shared by all instances from for_directory():
 
-    @property
-    def mimetype(self):
-        """Guess mimetype based on filename (rather than content). Returns string.
-        """
-        # FIXME not sure this is very efficient
-        filename = os.path.basename(self.filename)
-        return guess_mimetype(filename)
+        filename - absolute path (directory + base_filename)
+        directory - absolute path of parent directory
+        base_filename - filename only, no path
+        title - base_filename without file extension, as some clients (KoReader) use this as filename and then add on file type as extension
+        author - Lastname, Firstname (empty, unless set from book content - see webook_metadata)
+        file_extension - including leading '.'
+        mimetype
+        file_octet_size - size in bytes on disk
+        file_mtime - modification time, None if not known
+    """
+    __slots__ = ('directory', 'base_filename', 'title', 'author', 'file_extension', 'mimetype', 'file_octet_size', 'file_mtime')
 
-    @property
-    def title(self):
-        """Guess book title based on filename (rather than content). Returns string.
+    def __init__(self, filename, stat_result=None, file_octet_size=None, directory=None, file_mtime=None):
+        """stat_result - optional os.stat() result for filename, e.g. from DirEntry.stat(), saves a lookup
+        file_octet_size, file_mtime - optional size in bytes and modification time, e.g. from an index, saves a lookup
+        directory - optional absolute directory path, if passed filename is the base filename (no path) in directory
+        If neither stat_result nor file_octet_size is passed in filename is stat-ed
         """
-        filename = os.path.basename(self.filename)
-        title = os.path.splitext(filename)[0]  # ignore file extension, as some clients (KoReader) use this as filename based and then add on file type as extension
-        return title
+        if directory is None:
+            filename = filename if os.path.isabs(filename) else os.path.abspath(filename)  # expected to be absolute (relative would work)
+            directory, base_filename = os.path.split(filename)
+        else:
+            base_filename = filename
+            filename = None
+        self.directory = directory
+        self.base_filename = base_filename
+        title, file_extension = os.path.splitext(base_filename)
+        self.title = title
+        self.file_extension = file_extension = _file_extensions.setdefault(file_extension, file_extension)
+        self.mimetype = mimetype_for_extension(file_extension)
+        self.author = ''  # TODO add guess logic based on filename, see webook_metadata for metadata from book content
+        if file_octet_size is None:
+            if stat_result is None:
+                stat_result = os.stat(filename or self.filename)
+            file_octet_size = stat_result.st_size
+        if file_mtime is None and stat_result is not None:
+            file_mtime = stat_result.st_mtime
+        self.file_octet_size = file_octet_size
+        self.file_mtime = file_mtime
 
     @property
-    def file_extension(self):
-        """Guess book file extension (likely not a guess) based on filename (rather than content). Returns string.
-        """
-        filename = os.path.basename(self.filename)
-        result = os.path.splitext(filename)[1]
-        return result
+    def filename(self):
+        return os.path.join(self.directory, self.base_filename)
 
-    @property
-    def file_octet_size(self):
-        """Lookup size in bytes on disk. Returns integer.
-        NOTE does (uncached) lookup each time, individually (no batch)
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.filename)
+
+    @classmethod
+    def for_directory(cls, directory_path, dir_entries=None):
+        """Batch constructor, returns list of (dir_entry, BootMeta) for directory_path, BootMeta is None for directories
+        (and files that can no longer be stat-ed, e.g. dangling symlinks).
+            dir_entries - optional list of DirEntry from directory_path (e.g. a page of list_directory()), default is entire directory
+        Uses the (cached) DirEntry stat, and directory_path is made absolute once rather than per file
         """
-        result = os.path.getsize(self.filename)
+        directory_path = os.path.abspath(directory_path)
+        if dir_entries is None:
+            dir_entries = list_directory(directory_path)
+        result = []
+        for dir_entry in dir_entries:
+            metadata = None
+            if not dir_entry.is_dir():
+                try:
+                    stat_result = dir_entry.stat()
+                except OSError:
+                    stat_result = None  # e.g. dangling symlink
+                if stat_result is not None:
+                    metadata = cls(dir_entry.name, stat_result=stat_result, directory=directory_path)
+            result.append((dir_entry, metadata))
         return result
 
 
+def default_data_dir():
+    """Per user directory for server state (e.g. search index), rather than a shared temp directory
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'webook_server')
+
+def check_private_path(path):
+    """Raises OSError unless path is owned by the current user and not writable by group/others.
+    No check on platforms without os.getuid() (Windows)
+    """
+    getuid = getattr(os, 'getuid', None)
+    if getuid is None:
+        return
+    stat_result = os.lstat(path)  # not following symlinks, a planted link is refused too
+    if stat_result.st_uid != getuid():
+        raise OSError(errno.EPERM, 'not owned by the current user', path)
+    if stat_result.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError(errno.EPERM, 'writable by other users', path)
+
+def content_digest(values):
+    """Returns 64 bit int digest of tuple values (repr-able), the same in every process. Digests of a set of items are
+    combined with XOR, so the combined digest can be updated as items are added and removed (XOR again) in any order
+    """
+    return int(hashlib.md5(repr(values).encode('utf-8')).hexdigest()[:16], 16)
+
+def make_private_dir(path):
+    """Create directory path (mode 0700) if missing, returns path.
+    Raises OSError if it exists and is not private, see check_private_path()
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    check_private_path(path)
+    return path
+
+
 def load_config(config_filename):
     log.info('Attempt to load config file %r', config_filename)
 
@@ -136,6 +219,9 @@ def load_config(config_filename):
         'debug': False,
         'port': int(os.environ.get('LISTEN_PORT', 8080)),
         'host': os.environ.get('LISTEN_ADDRESS', '0.0.0.0'),  # '127.0.0.1',
+        'server': 'auto',  # auto (first installed of werkzeug, bjoern, cheroot, cherrypy; else wsgiref), or one of those, or asyncio, threaded, prefork
+        'threads': 16,  # threads for request processing; asyncio, threaded, prefork (per worker), cheroot, cherrypy. For asyncio connections are not limited by this
+        'workers': 0,  # prefork server, number of worker processes. 0 is one per CPU
     }
     default_net_config.update(config.get('config', {}))
     config['config'] = default_net_config
@@ -145,32 +231,247 @@ def load_config(config_filename):
     config['ebook_dir'] = os.path.abspath(config['ebook_dir'])
     config['self_url_path'] = os.environ.get('WEBOOK_SELF_URL_PATH', config.get('self_url_path', None))  # if this is not set, OPDS cannot proceed - not safe to default as koreader will silently fail with BAD urls for metadata lookup
     config['temp_dir'] = config.get('temp_dir', os.environ.get('TEMP', tempfile.gettempdir()))
+    config['data_dir'] = config.get('data_dir', default_data_dir())  # private (0700) directory for server state, caches served to clients must not be writable by others
+    config['conversion_cache_dir'] = config.get('conversion_cache_dir', os.path.join(config['data_dir'], 'webook_conversion_cache'))
+    config['conversion_cache_max_bytes'] = int(config.get('conversion_cache_max_bytes', 512 * 1024 * 1024))
+    config['conversion_workers'] = max(1, int(config.get('conversion_workers', 2)))  # at least 1, 0 workers would never convert
+    config['conversion_queue_size'] = max(1, int(config.get('conversion_queue_size', 8)))  # at least 1, a queue size of 0 means unbounded to queue.Queue
+    config['conversion_timeout'] = int(config.get('conversion_timeout', 5 * 60))  # seconds, 0 for no timeout
+    config['streaming_conversion'] = config.get('streaming_conversion', False)  # serve conversions (to append-only formats, see ebook_conversion.streaming_formats) while still in progress
+    config['watch_ebook_dir'] = config.get('watch_ebook_dir', 'auto')  # auto, inotify, poll, or off
+    config['watch_poll_interval'] = int(config.get('watch_poll_interval', 30))  # seconds
+    config['items_per_page'] = max(1, int(config.get('items_per_page', 25)))  # OPDS feeds are paginated, as e-ink readers are slow to parse large feeds
+    config['scan_threads'] = int(config.get('scan_threads', 1))  # more than 1 for network file systems, see parallel_walk_entries()
+    config['feed_cache_max_bytes'] = int(config.get('feed_cache_max_bytes', 16 * 1024 * 1024))  # rendered directory listings, 0 to disable
+    config['extract_metadata'] = config.get('extract_metadata', True)  # title and author from book content, rather than filename
+    config['metadata_db'] = config.get('metadata_db', os.path.join(config['data_dir'], 'webook_metadata.sqlite3'))
+    config['search_index'] = config.get('search_index', os.path.join(config['data_dir'], 'webook_search_index.marshal'))  # empty/null to not persist
+    config['fuzzy_search_threshold'] = float(config.get('fuzzy_search_threshold', 0.5))  # 0.0-1.0, proportion of search trigrams found in a name
+    config['fuzzy_search_limit'] = int(config.get('fuzzy_search_limit', 50))  # maximum fuzzy results, 0 disables fuzzy search
+    config['compress_responses'] = config.get('compress_responses', True)  # gzip/deflate feeds and html, for clients that accept it
+    config['compression_level'] = int(config.get('compression_level', 6))  # 1 (fastest) - 9 (smallest)
+    config['thumbnails'] = config.get('thumbnails', True)  # cover thumbnails in OPDS feeds
+    config['thumbnail_cache_dir'] = config.get('thumbnail_cache_dir', os.path.join(config['data_dir'], 'webook_thumbnail_cache'))
+    config['thumbnail_cache_max_bytes'] = int(config.get('thumbnail_cache_max_bytes', 64 * 1024 * 1024))
+    config['thumbnail_size'] = [int(x) for x in config.get('thumbnail_size', [200, 300])]  # width, height
+    config['thumbnail_workers'] = int(config.get('thumbnail_workers', 1))
 
     return config
 
 # Local file system navigation functions
-def walker(directory_name, process_file_function=None, process_dir_function=None, extra_params_dict=None):
+class ListdirEntry(object):
+    """Minimal os.DirEntry work-a-like for when scandir is not available, stat() result is cached
+    """
+    __slots__ = ('name', 'path', '_stat', '_lstat')
+
+    def __init__(self, directory_name, name):
+        self.name = name
+        self.path = os.path.join(directory_name, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if self._lstat is None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+
+def list_directory(directory_name):
+    """Returns list of os.DirEntry (or ListdirEntry) for directory_name.
+    DirEntry caches stat() results and (on most platforms) is_dir() needs no stat call at all
+    """
+    if scandir is None:
+        return [ListdirEntry(directory_name, name) for name in os.listdir(directory_name)]
+    iterator = scandir(directory_name)
+    try:
+        return list(iterator)
+    finally:
+        if hasattr(iterator, 'close'):
+            iterator.close()  # py3.6+
+
+def walk_entries(directory_name):
+    """Like os.walk() (top down, does not follow directory symlinks) but yields
+    (root, dir_entries, file_entries) where entries are from list_directory()
+    so callers can use the (cached) entry.stat() rather than stat-ing again
+    """
+    pending = [directory_name]
+    while pending:
+        root = pending.pop()
+        try:
+            entries = list_directory(root)
+        except OSError:
+            continue  # e.g. permissions, or removed since listed
+        dir_entries, file_entries = partition_entries(entries)
+        yield root, dir_entries, file_entries
+        for entry in reversed(dir_entries):  # reversed, so popped in listing order
+            if not entry.is_symlink():
+                pending.append(entry.path)
+
+def partition_entries(entries, prefetch_stat=False):
+    """Split list_directory() results into (dir_entries, file_entries).
+    prefetch_stat - also stat() (cached by entry) every file, so the latency is paid in the caller's thread
+    """
+    dir_entries = []
+    file_entries = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            dir_entries.append(entry)
+        else:
+            if prefetch_stat:
+                try:
+                    entry.stat()
+                except OSError:
+                    pass  # e.g. dangling symlink, caller will find out when it calls stat()
+            file_entries.append(entry)
+    return dir_entries, file_entries
+
+def parallel_walk_entries(directory_name, workers=4, ordered=False, prefetch_stat=True):
+    """Same results as walk_entries() but directories are listed (and files stat-ed, see prefetch_stat)
+    by a pool of worker threads. Intended for high latency file systems (e.g. NFS/SMB mounts)
+    where a serial walk is bound by round trips rather than CPU.
+
+    Results are yielded as soon as they are available;
+        ordered=False - in completion order
+        ordered=True - same (top down, listing) order as walk_entries()
+    Directories that cannot be listed (OSError) are skipped, any other exception in a worker is re-raised here
+    """
+    if workers <= 1:
+        for result in walk_entries(directory_name):
+            yield result
+        return
+
+    work_queue = queue.Queue()
+    done_queue = queue.Queue()  # unordered results, (path, result)
+    results = {}  # ordered results, path -> result
+    results_condition = threading.Condition()
+    stop_event = threading.Event()
+    discovered_lock = threading.Lock()
+    discovered = [1]  # number of directories queued so far, including top
+
+    def worker():
+        while not stop_event.is_set():
+            root = work_queue.get()
+            if root is None:
+                break
+            try:
+                dir_entries, file_entries = partition_entries(list_directory(root), prefetch_stat=prefetch_stat)
+                result = (root, dir_entries, file_entries)
+                subdirectories = [entry.path for entry in dir_entries if not entry.is_symlink()]
+                with discovered_lock:
+                    discovered[0] += len(subdirectories)  # before result is handed back, see unordered loop below
+                for path in subdirectories:
+                    work_queue.put(path)  # fan out
+            except OSError:
+                result = None  # e.g. permissions, or removed since listed
+            except Exception as info:
+                result = info  # always report back, re-raised by the consumer rather than leaving it waiting forever
+            if ordered:
+                with results_condition:
+                    results[root] = result
+                    results_condition.notify_all()
+            else:
+                done_queue.put((root, result))
+
+    threads = []
+    for worker_number in range(workers):
+        thread = threading.Thread(target=worker, name='webook-scan-%d' % worker_number)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    work_queue.put(directory_name)
+    try:
+        if ordered:
+            pending = [directory_name]
+            while pending:
+                root = pending.pop()
+                with results_condition:
+                    while root not in results:
+                        results_condition.wait()
+                    result = results.pop(root)
+                if result is None:
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+                for entry in reversed(result[1]):  # reversed, so popped in listing order
+                    if not entry.is_symlink():
+                        pending.append(entry.path)
+        else:
+            received = 0
+            while True:
+                with discovered_lock:
+                    if received >= discovered[0]:
+                        break  # every directory queued has been reported
+                root, result = done_queue.get()
+                received += 1
+                if isinstance(result, Exception):
+                    raise result
+                if result is not None:
+                    yield result
+    finally:
+        stop_event.set()
+        for thread in threads:
+            work_queue.put(None)
+
+def walker(directory_name, process_file_function=None, process_dir_function=None, extra_params_dict=None, workers=1, pass_dir_entry=False):
     """extra_params_dict optional dict to be passed into process_file_function() and process_dir_function()
+    workers - number of threads to scan with, see parallel_walk_entries()
+    pass_dir_entry - also pass dir_entry keyword to process_file_function() and process_dir_function(), opt-in so existing callbacks still work
 
     def process_file_function(full_path, extra_params_dict=None)
         extra_params_dict = extra_params_dict or {}
+
+    def process_file_function(full_path, extra_params_dict=None, dir_entry=None)  # pass_dir_entry=True
+        dir_entry is from walk_entries(), dir_entry.stat() is cached
     """
     extra_params_dict or {}
-    # TODO scandir instead... would be faster - but for py2.7 requires external lib
-    for root, subdirs, files in os.walk(directory_name):
-        if process_file_function:
-            for filepath in files:
-                full_path = os.path.join(root,filepath)
-                process_file_function(full_path, extra_params_dict=extra_params_dict)
-        if process_dir_function:
-            for sub in subdirs:
-                full_path = os.path.join(root, sub)
-                process_dir_function(full_path, extra_params_dict=extra_params_dict)
-
-def recent_files_filter(full_path, extra_params_dict=None):
+    for root, dir_entries, file_entries in parallel_walk_entries(directory_name, workers=workers):
+        for process_function, entries in ((process_file_function, file_entries), (process_dir_function, dir_entries)):
+            if not process_function:
+                continue
+            for entry in entries:
+                if pass_dir_entry:
+                    process_function(entry.path, extra_params_dict=extra_params_dict, dir_entry=entry)
+                else:
+                    process_function(entry.path, extra_params_dict=extra_params_dict)
+
+def recent_files_filter(full_path, extra_params_dict=None, dir_entry=None):
     max_recent_files = extra_params_dict['max_recent_files']
     recent_files = extra_params_dict['recent_files']
-    mtime = int(os.path.getmtime(full_path))
+    try:
+        if dir_entry is not None:
+            mtime = int(dir_entry.stat().st_mtime)
+        else:
+            mtime = int(os.path.getmtime(full_path))
+    except OSError:
+        return  # e.g. dangling symlink
     list_value = (mtime, full_path)
     do_insert = False
     if len(recent_files) < max_recent_files:
@@ -187,7 +488,7 @@ def recent_files_filter(full_path, extra_params_dict=None):
 
 ORDER_ASCENDING = 'ascending'
 ORDER_DESCENDING = 'descending'
-def find_recent_files(test_path, number_of_files=20, order=ORDER_ASCENDING):
+def find_recent_files(test_path, number_of_files=20, order=ORDER_ASCENDING, workers=1):
     extra_params_dict = {
         #'directory_path': directory_path,  # not used
         #'directory_path_len': directory_path_len,
@@ -195,7 +496,7 @@ def find_recent_files(test_path, number_of_files=20, order=ORDER_ASCENDING):
         'recent_files': [],
     }
 
-    walker(test_path, process_file_function=recent_files_filter, extra_params_dict=extra_params_dict)
+    walker(test_path, process_file_function=recent_files_filter, extra_params_dict=extra_params_dict, workers=workers, pass_dir_entry=True)
     recent_files = extra_params_dict['recent_files']
     if ORDER_DESCENDING == order:
         recent_files.reverse()
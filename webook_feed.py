@@ -0,0 +1,134 @@
+"""Rendering of OPDS (Atom) feed entries
+
+Templates are str.format() style strings, compiled once (at import) into
+a single %-format string so rendering an entry is one substitution (in C)
+rather than re-parsing the template for every entry. Entries are rendered,
+joined and encoded to bytes in batches rather than one at a time.
+
+See scripts/bench_feed.py for entries/sec.
+"""
+
+import string
+
+try:
+    # py3
+    from urllib.parse import quote
+except ImportError:
+    # py2
+    from urllib import quote
+
+
+ENTRY_BATCH_SIZE = 64  # entries per yielded (encoded) chunk
+
+def xml_escape(in_str):
+    """Escape for XML text and (double quoted) attribute values, as numeric character references (work with koreader).
+    Chained str.replace() rather than str.translate() with a mapping table, each replace is a (fast) C scan that
+    returns the string unchanged when there is nothing to escape - the common case - translate is many times slower
+    """
+    return in_str.replace('&', '&#38;').replace('<', '&#60;').replace('>', '&#62;').replace('"', '&#34;')
+
+
+class Template(object):
+    def __init__(self, template_string):
+        """template_string - str.format() style, named fields only (no format spec or conversion)
+        """
+        format_parts = []
+        slots = []
+        for literal_text, field_name, format_spec, conversion in string.Formatter().parse(template_string):
+            format_parts.append(literal_text.replace('%', '%%'))
+            if field_name is None:
+                continue
+            if not field_name or format_spec or conversion:
+                raise ValueError('only named fields are supported, got %r in template' % field_name)
+            format_parts.append('%%(%s)s' % field_name)
+            if field_name not in slots:
+                slots.append(field_name)
+        self.format_string = ''.join(format_parts)
+        self.slots = tuple(slots)
+
+    def render(self, values):
+        """values - dict of slot name to (already escaped) string. Returns string
+        """
+        return self.format_string % values
+
+
+BOOK_ENTRY = Template(u'''
+    <entry>
+        <title>{title}</title>
+        <author>
+            <name>{author_name_surname_first}</name>
+        </author>
+        <id>{title}</id>
+        <content type="xhtml">
+            <div xmlns="http://www.w3.org/1999/xhtml">
+                <p>Original filename: {base_filename}</p>
+                <p>file size: {file_size}Mb</p>
+            </div>
+        </content>
+        <link type="application/octet-stream" rel="http://opds-spec.org/acquisition" title="Raw ({file_extension})" href="/file/{href_path}"/><!-- koreader will hide and not display this due to (some) unsupported mime-type - hence "Original" with different type -->
+        <link type="{mime_type}" rel="http://opds-spec.org/acquisition" title="Original ({file_extension})" href="/file/{href_path}"/>
+        <link type="application/epub+zip" rel="http://opds-spec.org/acquisition" title="EPUB convert" href="/epub/{href_path}"/>
+        <link type="application/x-mobipocket-ebook" rel="http://opds-spec.org/acquisition" title="Kindle (mobi) convert" href="/mobi/{href_path}"/>
+        <link type="text/plain" rel="http://opds-spec.org/acquisition" title="Text (txt) convert" href="/txt/{href_path}"/>{thumbnail_links}
+    </entry>
+''')
+
+THUMBNAIL_LINKS = Template(u'''
+        <link{type_attribute} rel="http://opds-spec.org/image/thumbnail" href="{href}"/>
+        <link{type_attribute} rel="http://opds-spec.org/image" href="{href}"/>''')
+
+DIRECTORY_ENTRY = Template(u'''
+      <entry>
+          <title>{title}/</title>
+          <id>{entry_id}</id>
+          <link rel="subsection" href="{href_path}" type="application/atom+xml;profile=opds-catalog;kind=acquisition" title="{link_title}"></link>
+      </entry>
+''')
+
+
+def book_entry_values(metadata, web_path, thumbnail_href=None, thumbnail_type='image/jpeg'):
+    """Returns values for BOOK_ENTRY
+        metadata - webook_core.BootMeta (or anything with the same attributes)
+        web_path - path of the book under /file/, not quoted
+        thumbnail_href - optional (already quoted) href of cover thumbnail, no image links if omitted
+        thumbnail_type - mime type of thumbnail, None if not known (link type attribute is omitted)
+    """
+    if thumbnail_href:
+        type_attribute = ' type="%s"' % xml_escape(thumbnail_type) if thumbnail_type else ''  # omitted if not known
+        thumbnail_links = THUMBNAIL_LINKS.render({'href': xml_escape(thumbnail_href), 'type_attribute': type_attribute})
+    else:
+        thumbnail_links = ''
+    return {
+        'title': xml_escape(metadata.title),  # koreader fails to parse when <> are left unescaped, and shows escaping if quote()'d
+        'author_name_surname_first': xml_escape(metadata.author),  # 'lastname, firstname'
+        'base_filename': xml_escape(metadata.base_filename),
+        'file_size': '%0.1f' % (metadata.file_octet_size / 1048576.0 + 0.1),  # TODO human-readable
+        'file_extension': xml_escape(metadata.file_extension),
+        'mime_type': metadata.mimetype,  # FIXME choosing something koreader does not support results in option being invisible
+        'href_path': quote(web_path),
+        'thumbnail_links': thumbnail_links,
+    }
+
+def directory_entry_values(title, entry_id, href_path, link_title):
+    """Returns values for DIRECTORY_ENTRY, all parameters are escaped here (href_path should already be quoted)
+    """
+    return {
+        'title': xml_escape(title),
+        'entry_id': xml_escape(entry_id),
+        'href_path': xml_escape(href_path),
+        'link_title': xml_escape(link_title),
+    }
+
+
+def render_entries(entries, batch_size=ENTRY_BATCH_SIZE):
+    """Generator, yields utf-8 bytes, one chunk per batch_size entries
+        entries - iterable of (Template, values dict)
+    """
+    batch = []
+    for template, values in entries:
+        batch.append(template.format_string % values)
+        if len(batch) >= batch_size:
+            yield u''.join(batch).encode('utf-8')
+            batch = []
+    if batch:
+        yield u''.join(batch).encode('utf-8')
@@ -0,0 +1,279 @@
+"""HTTP helpers for webook_server WSGI handlers
+
+Serving (static) files, with byte range support (single and multiple
+ranges), RFC 7233
+
+Conditional requests (ETag, If-None-Match, If-Modified-Since, If-Range
+and 304 Not Modified responses), RFC 7232
+"""
+
+import email.utils
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+FILE_BLOCK_SIZE = 256 * 1024  # bytes, read size when iterating files (when sendfile is not available)
+MAX_RANGES = 16  # more ranges than this in a single request is ignored (full file is served), avoids abuse
+NOT_MODIFIED_HEADERS = ('cache-control', 'content-location', 'date', 'etag', 'expires', 'last-modified', 'vary')  # headers to keep for 304 responses, lower case
+
+
+# Weekday and month names for HTTP date/time formatting; always English!
+_weekdayname = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+_monthname = [None, # Dummy so we can use 1-based month numbers
+              "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+              "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+def header_format_date_time(timestamp):
+    year, month, day, hh, mm, ss, wd, y, z = time.gmtime(timestamp)
+    return "%s, %02d %3s %4d %02d:%02d:%02d GMT" % (
+        _weekdayname[wd], day, _monthname[month], year, hh, mm, ss
+    )
+
+def parse_http_date(date_string):
+    """Returns timestamp (int) for HTTP date string, or None if not a valid date
+    """
+    try:
+        date_tuple = email.utils.parsedate_tz(date_string)
+        if date_tuple is None:
+            return None
+        return email.utils.mktime_tz(date_tuple)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def make_etag(*parts):
+    """Returns strong ETag (quoted string) for parts, anything with a stable repr() e.g. path, size, mtime, generation counter
+    """
+    return '"%s"' % hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:32]
+
+def file_etag(filename, stat_result):
+    return make_etag(os.path.abspath(filename), stat_result.st_size, stat_result.st_mtime)
+
+def parse_etags(header_value):
+    """Returns list of entity tags (quoted, weak prefix removed) from If-None-Match/If-Match header value, '*' is returned as-is
+    """
+    result = []
+    for etag in header_value.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if etag:
+            result.append(etag)
+    return result
+
+def etag_matches(header_value, etag):
+    """Weak comparison, as used for If-None-Match
+    """
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    etags = parse_etags(header_value)
+    return '*' in etags or etag in etags
+
+def is_not_modified(environ, etag=None, last_modified=None):
+    """True if the request is conditional and the client copy (etag / last_modified timestamp) is current.
+    If-None-Match takes precedence, If-Modified-Since is only checked when If-None-Match is absent
+    """
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag is not None and etag_matches(if_none_match, etag)
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        since = parse_http_date(if_modified_since)
+        return since is not None and int(last_modified) <= since
+    return False
+
+def not_modified_response(environ, start_response, headers, etag=None, last_modified=None):
+    """Adds ETag and Last-Modified (from timestamp) to headers list, in place.
+    If client copy is current serves 304 and returns (empty) WSGI iterable,
+    otherwise returns None and caller serves the full response with headers
+    """
+    if etag:
+        headers.append(('ETag', etag))
+    if last_modified is not None:
+        headers.append(('Last-Modified', header_format_date_time(last_modified)))
+    if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD') or not is_not_modified(environ, etag, last_modified):
+        return None
+    log.debug('not modified %r', environ.get('PATH_INFO'))
+    start_response('304 NOT MODIFIED', [(name, value) for name, value in headers if name.lower() in NOT_MODIFIED_HEADERS])
+    return []
+
+def if_range_matches(if_range, etag, last_modified):
+    """If-Range uses strong comparison, of either an ETag or an (exact) HTTP date
+    """
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    return parse_http_date(if_range) == int(last_modified)
+
+
+def parse_range_header(range_header, file_size):
+    """Parse http Range header value, e.g. 'bytes=0-499', 'bytes=500-', 'bytes=-500', 'bytes=0-0,-1'
+    Returns:
+        None - no (usable) range, serve the entire file
+        [] - no satisfiable range, serve 416
+        list of (start, end) tuples, end is inclusive
+    """
+    if not range_header:
+        return None
+    units, _, range_set = range_header.partition('=')
+    if units.strip().lower() != 'bytes' or not range_set:
+        return None
+    ranges = []
+    range_specs = range_set.split(',')
+    if len(range_specs) > MAX_RANGES:
+        return None
+    for range_spec in range_specs:
+        start, sep, end = range_spec.strip().partition('-')
+        if not sep:
+            return None  # syntax error, ignore header
+        try:
+            if start:
+                start = int(start)
+                if end:
+                    end = int(end)
+                    if end < start:
+                        return None  # syntax error, ignore header
+                else:
+                    end = file_size - 1
+            else:
+                suffix_length = int(end)  # last n bytes
+                if suffix_length == 0:
+                    continue  # unsatisfiable
+                start = max(0, file_size - suffix_length)
+                end = file_size - 1
+        except ValueError:
+            return None  # syntax error, ignore header
+        if start >= file_size:
+            continue  # unsatisfiable
+        ranges.append((start, min(end, file_size - 1)))
+    return ranges
+
+
+class FileRangeWrapper(object):
+    """Iterable over length bytes of (open, binary) filelike starting at offset, read in blksize chunks.
+    Closes filelike when closed (as per WSGI).
+    Usable as wsgi.file_wrapper, servers that know about it can send the range without reading it, see webook_servers
+    """
+    def __init__(self, filelike, blksize=FILE_BLOCK_SIZE, offset=0, length=None):
+        self.filelike = filelike
+        self.offset = offset
+        self.length = length
+        self.blksize = blksize
+
+    def __iter__(self):
+        self.filelike.seek(self.offset)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            read_size = self.blksize if remaining is None else min(self.blksize, remaining)
+            data = self.filelike.read(read_size)
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.filelike.close()
+
+
+class MultipartRangesWrapper(object):
+    """Iterable multipart/byteranges body for multiple ranges of (open, binary) filelike
+    """
+    def __init__(self, filelike, ranges, file_size, content_type, boundary, blksize=FILE_BLOCK_SIZE):
+        self.filelike = filelike
+        self.ranges = ranges
+        self.file_size = file_size
+        self.content_type = content_type
+        self.boundary = boundary
+        self.blksize = blksize
+
+    def part_header(self, start, end):
+        return ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (self.boundary, self.content_type, start, end, self.file_size)).encode('latin1')
+
+    def closing_boundary(self):
+        return ('\r\n--%s--\r\n' % self.boundary).encode('latin1')
+
+    def content_length(self):
+        result = len(self.closing_boundary())
+        for start, end in self.ranges:
+            result += len(self.part_header(start, end)) + (end - start + 1)
+        return result
+
+    def __iter__(self):
+        for start, end in self.ranges:
+            yield self.part_header(start, end)
+            for data in FileRangeWrapper(self.filelike, self.blksize, offset=start, length=end - start + 1):
+                yield data
+        yield self.closing_boundary()
+
+    def close(self):
+        self.filelike.close()
+
+
+def serve_file(environ, start_response, filename, content_type, headers=None, etag=None, last_modified=None):
+    """Serve filename (entire file, or requested byte range(s)), returns WSGI iterable.
+    Conditional requests are honored with 304s.
+        headers - optional list of additional (name, value) headers, e.g. Content-Disposition
+        etag, last_modified - optional, defaults are generated from the file (path, size, mtime).
+            E.g. for generated files, where the source file is a better validator
+    Raises IOError/OSError if filename can not be opened
+    """
+    f = open(filename, 'rb')
+    stat_result = os.fstat(f.fileno())
+    file_size = stat_result.st_size
+    etag = etag or file_etag(filename, stat_result)
+    if last_modified is None:
+        last_modified = stat_result.st_mtime
+    headers = list(headers or [])
+    result = not_modified_response(environ, start_response, headers, etag, last_modified)
+    if result is not None:
+        f.close()
+        return result
+    headers.append(('Accept-Ranges', 'bytes'))
+
+    ranges = None
+    if environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD'):
+        if_range = environ.get('HTTP_IF_RANGE')
+        if not if_range or if_range_matches(if_range, etag, last_modified):
+            ranges = parse_range_header(environ.get('HTTP_RANGE'), file_size)
+
+    if ranges is None:
+        headers.append(('Content-type', content_type))
+        headers.append(('Content-Length', str(file_size)))
+        start_response('200 OK', headers)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and file_wrapper is not FileRangeWrapper:
+            return file_wrapper(f, FILE_BLOCK_SIZE)  # server specific, may use sendfile
+        return FileRangeWrapper(f, length=file_size)
+
+    if not ranges:
+        f.close()
+        log.info('unsatisfiable range %r for %d bytes', environ.get('HTTP_RANGE'), file_size)
+        headers.append(('Content-type', 'text/plain'))
+        headers.append(('Content-Range', 'bytes */%d' % file_size))
+        headers.append(('Content-Length', '0'))
+        start_response('416 RANGE NOT SATISFIABLE', headers)
+        return []
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers.append(('Content-type', content_type))
+        headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, file_size)))
+        headers.append(('Content-Length', str(end - start + 1)))
+        start_response('206 PARTIAL CONTENT', headers)
+        return FileRangeWrapper(f, offset=start, length=end - start + 1)
+
+    boundary = uuid.uuid4().hex
+    body = MultipartRangesWrapper(f, ranges, file_size, content_type, boundary)
+    headers.append(('Content-type', 'multipart/byteranges; boundary=%s' % boundary))
+    headers.append(('Content-Length', str(body.content_length())))
+    start_response('206 PARTIAL CONTENT', headers)
+    return body
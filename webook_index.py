@@ -0,0 +1,269 @@
+"""In-memory index of ebook_dir
+
+Scans the directory tree once (rather than per request) and keeps a compact
+record per file and directory; relative path, lower cased relative path
+(for case insensitive search), size, mtime and whether it is a directory.
+
+Files are also kept in modification time order (RecentFilesIndex) so the
+most recent n files can be found without a walk, or even a scan of the index.
+
+The index can be updated incrementally (update_path() / remove_path() /
+rename_path()), see webook_watcher for keeping it up to date. Listeners
+are notified of every change, e.g. to keep webook_search up to date.
+"""
+
+import bisect
+import collections
+import logging
+import os
+import stat
+import threading
+import time
+
+from webook_core import content_digest, parallel_walk_entries
+
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+IndexEntry = collections.namedtuple('IndexEntry', 'path lowered_path size mtime is_dir')  # path is relative to index directory_path, native separators
+
+
+def entry_digest(entry):
+    return content_digest((entry.path, entry.size, entry.mtime, entry.is_dir))
+
+
+class RecentFilesIndex(object):
+    """Sorted (by mtime, then path) array of files. Not thread safe, see LibraryIndex.lock
+    """
+    def __init__(self, entries=None):
+        self.keys = sorted((entry.mtime, entry.path) for entry in (entries or []) if not entry.is_dir)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, entry):
+        if not entry.is_dir:
+            bisect.insort(self.keys, (entry.mtime, entry.path))
+
+    def remove(self, entry):
+        if not entry.is_dir:
+            key = (entry.mtime, entry.path)
+            position = bisect.bisect_left(self.keys, key)
+            if position < len(self.keys) and self.keys[position] == key:
+                del self.keys[position]
+
+    def recent(self, number_of_files):
+        """Returns list of relative paths, most recent first
+        """
+        if number_of_files <= 0:
+            return []
+        return [path for mtime, path in reversed(self.keys[-number_of_files:])]
+
+
+class LibraryIndex(object):
+    def __init__(self, directory_path, scan_threads=1):
+        """scan_threads - number of threads to walk directory_path with, see webook_core.parallel_walk_entries()
+        """
+        self.directory_path = os.path.abspath(directory_path)
+        self.scan_threads = scan_threads
+        self.lock = threading.Lock()
+        self.entries = {}  # relative path -> IndexEntry, in directory walk order
+        self.recent_files = RecentFilesIndex()
+        self.generation = 0  # incremented on every change
+        self.last_modified = time.time()  # timestamp of last change (or scan), for HTTP Last-Modified
+        self.scan_state = self.last_modified
+        self.directory_changes = {}  # relative directory -> timestamp of last change to its immediate entries, since scan
+        self.digest = 0  # XOR of entry_digest() of every entry, derived from content only (unlike generation) so the same in every (prefork) process
+        self.directory_digests = {}  # relative directory -> XOR of entry_digest() of its immediate entries
+        self.scan_time = None
+        self.listeners = []  # functions called with (added, removed) lists of IndexEntry on every change
+
+    def __len__(self):
+        return len(self.entries)
+
+    def relative_path(self, full_path):
+        return full_path[len(self.directory_path) + 1:]  # +1 is the directory seperator (assuming Unix or Windows paths)
+
+    def full_path(self, relative_path):
+        return os.path.join(self.directory_path, relative_path)
+
+    def make_entry(self, relative_path, stat_result, is_dir):
+        return IndexEntry(relative_path, relative_path.lower(), stat_result.st_size, stat_result.st_mtime, is_dir)
+
+    def walk(self, top):
+        """Returns dict of relative path -> IndexEntry for everything under (not including) full path top
+        """
+        entries = {}
+        directory_path_len = len(self.directory_path) + 1
+        for root, dir_entries, file_entries in parallel_walk_entries(top, workers=self.scan_threads, ordered=True):
+            for dir_entries_or_file_entries, is_dir in ((dir_entries, True), (file_entries, False)):
+                for dir_entry in dir_entries_or_file_entries:
+                    try:
+                        stat_result = dir_entry.stat()  # single stat per entry, cached by DirEntry
+                    except OSError:
+                        continue  # e.g. dangling symlink, or removed since listing
+                    relative_path = dir_entry.path[directory_path_len:]
+                    entries[relative_path] = self.make_entry(relative_path, stat_result, is_dir)
+        return entries
+
+    def scan(self):
+        """(Re)build index from scratch, walks entire tree
+        """
+        start_time = time.time()
+        entries = self.walk(self.directory_path)
+        recent_files = RecentFilesIndex(entries.values())
+        with self.lock:
+            removed = list(self.entries.values())
+            self.entries = entries
+            self.recent_files = recent_files
+            self.generation += 1
+            self.last_modified = time.time()
+            self.scan_state = self.last_modified
+            self.directory_changes = {}
+            self.digest = 0
+            self.directory_digests = {}
+            for entry in entries.values():
+                self._update_digests(entry)
+            self._notify(list(entries.values()), removed)
+        self.scan_time = time.time() - start_time
+        log.info('indexed %d entries in %r in %0.2f secs', len(entries), self.directory_path, self.scan_time)
+
+    def update_path(self, relative_path):
+        """Add or refresh a single path, new directories are walked so their contents are added too.
+        If relative_path no longer exists it is removed
+        """
+        full_path = self.full_path(relative_path)
+        try:
+            stat_result = os.stat(full_path)
+        except OSError:
+            self.remove_path(relative_path)
+            return
+        is_dir = stat.S_ISDIR(stat_result.st_mode)
+        existing = self.entries.get(relative_path)
+        if existing is not None and existing.is_dir and not is_dir:
+            self.remove_path(relative_path)  # directory replaced with a file
+            existing = None
+        new_entries = {relative_path: self.make_entry(relative_path, stat_result, is_dir)}
+        if is_dir and (existing is None or not existing.is_dir):
+            new_entries.update(self.walk(full_path))
+        with self.lock:
+            removed = []
+            for entry in new_entries.values():
+                old_entry = self._add_entry(entry)
+                if old_entry is not None:
+                    removed.append(old_entry)
+            self._changed(new_entries)
+            self._notify(list(new_entries.values()), removed)
+
+    def remove_path(self, relative_path):
+        """Remove a single path, for directories everything under it is removed too
+        """
+        with self.lock:
+            entry = self._remove_entry(relative_path)
+            if entry is None:
+                return
+            removed = [entry]
+            if entry.is_dir:
+                prefix = relative_path + os.sep
+                for path in [path for path in self.entries if path.startswith(prefix)]:
+                    removed.append(self._remove_entry(path))
+            self._changed(entry.path for entry in removed)
+            self._notify([], removed)
+
+    def _add_entry(self, entry):
+        """Add or replace entry, returns replaced IndexEntry or None. Caller holds lock
+        """
+        old_entry = self._remove_entry(entry.path)
+        self.entries[entry.path] = entry
+        self.recent_files.add(entry)
+        self._update_digests(entry)
+        return old_entry
+
+    def _remove_entry(self, relative_path):
+        """Returns removed IndexEntry, or None. Caller holds lock
+        """
+        entry = self.entries.pop(relative_path, None)
+        if entry is not None:
+            self.recent_files.remove(entry)
+            self._update_digests(entry)  # XOR again removes it
+        return entry
+
+    def _update_digests(self, entry):
+        """Toggle entry in digest and directory_digests (XOR adds, and removes, it). Caller holds lock
+        """
+        digest = entry_digest(entry)
+        self.digest ^= digest
+        directory = os.path.dirname(entry.path)
+        self.directory_digests[directory] = self.directory_digests.get(directory, 0) ^ digest
+
+    def _changed(self, relative_paths):
+        """Record a change to relative_paths (added, replaced or removed). Caller holds lock
+        """
+        self.generation += 1
+        self.last_modified = time.time()
+        for relative_path in relative_paths:
+            self.directory_changes[os.path.dirname(relative_path)] = self.last_modified
+
+    def _notify(self, added, removed):
+        """Caller holds lock, so listeners see changes in order
+        """
+        for listener in self.listeners:
+            try:
+                listener(added, removed)
+            except Exception:
+                log.exception('index listener %r failed', listener)
+
+    def add_listener(self, listener):
+        """listener - function(added, removed), called with lists of IndexEntry after every change (with lock held, should be quick).
+        A replaced entry is in both removed (old) and added (new).
+        Returns snapshot() of the index at the time listener was added, so no change is missed or seen twice
+        """
+        with self.lock:
+            self.listeners.append(listener)
+            return list(self.entries.values())
+
+    def rename_path(self, old_relative_path, new_relative_path):
+        self.remove_path(old_relative_path)
+        self.update_path(new_relative_path)
+
+    def children(self, relative_directory):
+        """Returns list of IndexEntry immediately under relative_directory ('' for top level)
+        """
+        return [entry for entry in self.snapshot() if os.path.dirname(entry.path) == relative_directory]
+
+    def directory_state(self, relative_directory):
+        """Returns (digest, timestamp) for the entries immediately under relative_directory ('' for top level).
+        digest is derived from their (path, size, mtime) so is the same in every process, e.g. for ETags.
+        timestamp is the (local) time of their last change, for Last-Modified.
+        Unlike digest / last_modified, unaffected by changes elsewhere in the tree
+        """
+        with self.lock:
+            return self.directory_digests.get(relative_directory, 0), self.directory_changes.get(relative_directory, self.scan_state)
+
+    def snapshot(self):
+        """Returns list of all IndexEntry, safe to iterate while index is updated
+        """
+        with self.lock:
+            return list(self.entries.values())
+
+    def get(self, relative_path):
+        return self.entries.get(relative_path)
+
+    def search(self, search_term):
+        """Case insensitive partial match of search_term against relative path.
+        Returns generator of IndexEntry in directory walk order
+        """
+        search_term = search_term.lower()
+        for entry in self.snapshot():
+            if search_term in entry.lowered_path:
+                yield entry
+
+    def recent(self, number_of_files=20):
+        """Returns list of (file only) IndexEntry, most recently modified first
+        """
+        with self.lock:
+            entries = self.entries
+            return [entries[path] for path in self.recent_files.recent(number_of_files)]
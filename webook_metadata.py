@@ -0,0 +1,422 @@
+"""Embedded ebook metadata (title and author)
+
+Parsers, stdlib only:
+    EPUB - OPF package document (dc:title, dc:creator)
+    FB2 (and .fb2.zip) - description/title-info (book-title, author)
+    MOBI/AZW/AZW3/PRC - EXTH header (503 updated title, 100 author), falling back to MOBI full name
+
+MetadataStore - persistent (sqlite) store of extracted metadata, keyed by
+path and validated by size and mtime. Held in memory so lookups while
+rendering feeds are a dict lookup. Files that have not been extracted (or
+have changed) are queued and extracted by a background thread, the caller
+falls back to filename based metadata (see webook_core.BootMeta) meanwhile.
+"""
+
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zipfile
+
+try:
+    import queue
+except ImportError:
+    # py2
+    import Queue as queue
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from webook_core import content_digest
+
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+COMMIT_BATCH_SIZE = 100  # rows per sqlite commit during bulk extraction, files are parsed before the (short) write transaction
+SQLITE_BUSY_TIMEOUT = 30  # seconds to wait for another connection (e.g. prefork worker) to release a lock
+RELOAD_INTERVAL = 10  # seconds, how often a read-only store (extract=False) checks for changes committed by another process
+
+CONTAINER_NAMESPACE = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+OPF_NAMESPACE = '{http://www.idpf.org/2007/opf}'
+DC_NAMESPACE = '{http://purl.org/dc/elements/1.1/}'
+FB2_NAMESPACE = '{http://www.gribuser.ru/xml/fictionbook/2.0}'
+
+EXTH_AUTHOR = 100
+EXTH_UPDATED_TITLE = 503
+
+
+def text_or_none(element):
+    if element is None or element.text is None:
+        return None
+    return ' '.join(element.text.split()) or None  # normalize whitespace
+
+
+def join_authors(authors):
+    """Returns single string, "Lastname, Firstname" style where known, multiple authors separated with ' & '
+    """
+    authors = [author for author in authors if author]
+    return ' & '.join(authors) or None
+
+
+def epub_metadata(filename):
+    """Returns (title, author) from EPUB OPF, either may be None
+    """
+    with zipfile.ZipFile(filename) as epub_file:
+        container = ElementTree.fromstring(epub_file.read('META-INF/container.xml'))
+        rootfile = container.find('.//%srootfile' % CONTAINER_NAMESPACE)
+        opf = ElementTree.fromstring(epub_file.read(rootfile.get('full-path')))
+    metadata = opf.find('%smetadata' % OPF_NAMESPACE)
+    if metadata is None:
+        return None, None
+    title = text_or_none(metadata.find('%stitle' % DC_NAMESPACE))
+    # EPUB3 <meta refines="#id" property="file-as">Lastname, Firstname</meta>
+    file_as = {}
+    for meta in metadata.findall('%smeta' % OPF_NAMESPACE):
+        if meta.get('property') == 'file-as' and meta.get('refines', '').startswith('#'):
+            file_as[meta.get('refines')[1:]] = text_or_none(meta)
+    authors = []
+    for creator in metadata.findall('%screator' % DC_NAMESPACE):
+        role = creator.get('%srole' % OPF_NAMESPACE)
+        if role not in (None, 'aut'):
+            continue  # e.g. illustrator, editor
+        # EPUB2 <dc:creator opf:file-as="Lastname, Firstname">Firstname Lastname</dc:creator>
+        authors.append(creator.get('%sfile-as' % OPF_NAMESPACE) or file_as.get(creator.get('id')) or text_or_none(creator))
+    return title, join_authors(authors)
+
+
+def fb2_metadata_from_file(fileobj):
+    """Returns (title, author) from FB2 description, only parses up to the end of the description (not the entire book)
+    """
+    title = None
+    authors = []
+    for event, element in ElementTree.iterparse(fileobj, events=('end',)):
+        tag = element.tag
+        if tag == FB2_NAMESPACE + 'title-info':
+            title = text_or_none(element.find(FB2_NAMESPACE + 'book-title'))
+            for author in element.findall(FB2_NAMESPACE + 'author'):
+                last_name = text_or_none(author.find(FB2_NAMESPACE + 'last-name'))
+                first_name = ' '.join(filter(None, [text_or_none(author.find(FB2_NAMESPACE + 'first-name')), text_or_none(author.find(FB2_NAMESPACE + 'middle-name'))]))
+                if last_name and first_name:
+                    authors.append('%s, %s' % (last_name, first_name))
+                else:
+                    authors.append(last_name or first_name or text_or_none(author.find(FB2_NAMESPACE + 'nickname')))
+        elif tag == FB2_NAMESPACE + 'description':
+            break
+    return title, join_authors(authors)
+
+
+def fb2_metadata(filename):
+    with open(filename, 'rb') as f:
+        return fb2_metadata_from_file(f)
+
+
+def fb2_zip_metadata(filename):
+    with zipfile.ZipFile(filename) as zip_file:
+        for name in zip_file.namelist():
+            if name.lower().endswith('.fb2'):
+                with zip_file.open(name) as f:
+                    return fb2_metadata_from_file(f)
+    return None, None
+
+
+def mobi_metadata(filename):
+    """Returns (title, author) from MOBI header and EXTH records (PalmDB container, MOBI/AZW/AZW3/PRC)
+    """
+    with open(filename, 'rb') as f:
+        palmdb_header = f.read(78)
+        if len(palmdb_header) < 78 or palmdb_header[60:68] not in (b'BOOKMOBI', b'TEXtREAd'):
+            return None, None
+        first_record_offset = struct.unpack('>L', f.read(4))[0]
+        f.seek(first_record_offset)
+        record0 = f.read(64 * 1024)  # header and EXTH, not the book text
+    if record0[16:20] != b'MOBI':
+        return None, None  # PalmDOC without MOBI header, no metadata
+    mobi_header_length, mobi_type, text_encoding = struct.unpack('>LLL', record0[20:32])
+    encoding = 'utf-8' if text_encoding == 65001 else 'cp1252'
+    full_name_offset, full_name_length = struct.unpack('>LL', record0[84:92])
+    title = record0[full_name_offset:full_name_offset + full_name_length].decode(encoding, 'replace') or None
+    exth_flags = struct.unpack('>L', record0[128:132])[0]
+    authors = []
+    exth_offset = 16 + mobi_header_length
+    if exth_flags & 0x40 and record0[exth_offset:exth_offset + 4] == b'EXTH':
+        record_count = struct.unpack('>L', record0[exth_offset + 8:exth_offset + 12])[0]
+        offset = exth_offset + 12
+        for _ in range(record_count):
+            record_type, record_length = struct.unpack('>LL', record0[offset:offset + 8])
+            if record_length < 8:
+                break  # corrupt
+            data = record0[offset + 8:offset + record_length]
+            if record_type == EXTH_AUTHOR:
+                authors.append(data.decode(encoding, 'replace').strip())
+            elif record_type == EXTH_UPDATED_TITLE:
+                title = data.decode(encoding, 'replace').strip() or title
+            offset += record_length
+    return title, join_authors(authors)
+
+
+extractors = {
+    '.epub': epub_metadata,
+    '.epub3': epub_metadata,
+    '.fb2': fb2_metadata,
+    '.mobi': mobi_metadata,
+    '.azw': mobi_metadata,
+    '.azw3': mobi_metadata,
+    '.prc': mobi_metadata,
+}
+
+def get_extractor(filename):
+    """Returns extractor function for filename (based on extension), or None if not supported
+    """
+    lowered_filename = filename.lower()
+    if lowered_filename.endswith('.fb2.zip'):
+        return fb2_zip_metadata
+    return extractors.get(os.path.splitext(lowered_filename)[1])
+
+
+def extract_metadata(filename):
+    """Returns (title, author) from book content, either may be None (e.g. unsupported format or corrupt file)
+    """
+    extractor = get_extractor(filename)
+    if extractor is None:
+        return None, None
+    try:
+        return extractor(filename)
+    except Exception as info:
+        # zipfile.BadZipfile, ElementTree.ParseError, struct.error, KeyError (missing zip member), IOError, ...
+        log.debug('metadata extraction failed for %r: %r', filename, info)
+        return None, None
+
+
+def entry_digest(path, entry):
+    """entry - (size, mtime, title, author)
+    """
+    return content_digest((path,) + tuple(entry))
+
+
+class MetadataStore(object):
+    def __init__(self, db_filename, extract=True):
+        """db_filename - sqlite database, created if missing
+        extract - False for read-only use, e.g. prefork workers that share db_filename with the one that extracts.
+            lookup() never queues extraction and entries are reloaded when another process commits changes
+        """
+        self.db_filename = db_filename
+        self.extract_enabled = extract
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_filename, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)  # all use is under self.lock
+        try:
+            self.connection.execute('PRAGMA journal_mode=WAL')  # readers do not block the writer (or each other)
+        except sqlite3.DatabaseError as info:
+            log.warning('metadata store %r WAL mode not available %r', db_filename, info)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, title TEXT, author TEXT)')
+        self.connection.commit()
+        self.entries = {}  # path -> (size, mtime, title, author)
+        self.queue = queue.Queue()
+        self.pending = set()  # paths queued for extraction
+        self.thread = None
+        self.listeners = []  # functions called with (path, title, author) after each extraction (or reload change), from the store thread
+        self.generation = 0  # incremented on every (batch) of changes, rendered feeds that used lookup() are stale
+        self.data_version = None  # sqlite PRAGMA data_version at last load(), changes when another connection commits
+        self.digest = 0  # XOR of entry_digest() of every entry, derived from content only (unlike generation) so the same in every (prefork) process
+        self.hits = 0
+        self.misses = 0
+        self.extracted = 0
+        self.errors = 0
+
+    def load(self):
+        """Load entire store into memory
+        """
+        with self.lock:
+            self.data_version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+            rows = self.connection.execute('SELECT path, size, mtime, title, author FROM metadata').fetchall()
+            self.entries = dict((path, (size, mtime, title, author)) for path, size, mtime, title, author in rows)
+            self.digest = 0
+            for path, entry in self.entries.items():
+                self.digest ^= entry_digest(path, entry)
+        log.info('metadata store %r %d entries', self.db_filename, len(self.entries))
+
+    def reload_if_changed(self):
+        """Reload entries if another connection committed changes since load(), listeners are called for changed entries.
+        Returns True if reloaded
+        """
+        with self.lock:
+            data_version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self.data_version:
+            return False
+        old_entries = self.entries
+        self.load()
+        changed = [(path, entry) for path, entry in self.entries.items() if old_entries.get(path) != entry]
+        self.generation += 1
+        for path, (size, mtime, title, author) in changed:
+            self.notify(path, title, author)
+        return True
+
+    def lookup(self, path, size, mtime):
+        """Returns (title, author), either may be None if not known.
+        If path has not been extracted (or has changed since) it is queued for extraction and (None, None) is returned
+        """
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == size and entry[1] == mtime:
+            self.hits += 1
+            return entry[2], entry[3]
+        if get_extractor(path) is None:
+            return None, None  # unsupported format
+        self.misses += 1
+        if self.extract_enabled:
+            self.request(path)
+        return None, None
+
+    def apply(self, metadata):
+        """Update BootMeta metadata with extracted title and author, if known. Returns metadata
+        """
+        if metadata.file_mtime is None:
+            return metadata  # can not validate
+        title, author = self.lookup(metadata.filename, metadata.file_octet_size, metadata.file_mtime)
+        if title:
+            metadata.title = title
+        if author:
+            metadata.author = author
+        return metadata
+
+    def request(self, path):
+        """Queue path for (background) extraction
+        """
+        with self.lock:
+            if path in self.pending:
+                return
+            self.pending.add(path)
+        self.queue.put(path)
+
+    def bulk_extract(self, files):
+        """Queue everything in files (iterable of (full path, size, mtime)) that is not already in the store, or has changed since extracted.
+        Store entries for paths not in files are removed
+        """
+        files = dict((path, (size, mtime)) for path, size, mtime in files)
+        with self.lock:
+            stale = [path for path in self.entries if path not in files]
+            for path in stale:
+                self._set_entry(path, None)
+            if stale:
+                self.connection.executemany('DELETE FROM metadata WHERE path = ?', [(path,) for path in stale])
+                self.connection.commit()
+            entries = dict(self.entries)
+        count = 0
+        for path, (size, mtime) in files.items():
+            entry = entries.get(path)
+            if entry is not None and entry[0] == size and entry[1] == mtime:
+                continue  # up to date
+            if get_extractor(path) is not None:
+                self.request(path)
+                count += 1
+        log.info('metadata queued %d files for extraction, removed %d', count, len(stale))
+
+    def extract(self, path):
+        """Returns (size, mtime, title, author) for path, or None if it no longer exists. Reads the file, no database access
+        """
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return None  # removed since queued
+        title, author = extract_metadata(path)
+        return stat_result.st_size, stat_result.st_mtime, title, author
+
+    def store(self, results):
+        """Write (and commit) results, list of (path, (size, mtime, title, author)), in a single short transaction.
+        Failures are stored too, so they are not retried until the file changes
+        """
+        with self.lock:
+            try:
+                self.connection.executemany('INSERT OR REPLACE INTO metadata (path, size, mtime, title, author) VALUES (?, ?, ?, ?, ?)',
+                                            [(path,) + tuple(entry) for path, entry in results])
+                self.connection.commit()
+            except sqlite3.Error:
+                self.connection.rollback()
+                raise
+            finally:
+                # in memory entries are used even if the write failed, re-extracted on next start
+                for path, entry in results:
+                    self._set_entry(path, entry)
+                self.generation += 1
+        self.extracted += len(results)
+        for path, (size, mtime, title, author) in results:
+            self.notify(path, title, author)
+
+    def _set_entry(self, path, entry):
+        """Add, replace or (entry None) remove entry for path, keeping digest up to date. Caller holds lock
+        """
+        old_entry = self.entries.pop(path, None)
+        if old_entry is not None:
+            self.digest ^= entry_digest(path, old_entry)
+        if entry is not None:
+            self.entries[path] = entry
+            self.digest ^= entry_digest(path, entry)
+
+    def notify(self, path, title, author):
+        for listener in self.listeners:
+            try:
+                listener(path, title, author)
+            except Exception:
+                log.exception('metadata listener %r failed', listener)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker_loop if self.extract_enabled else self.reload_loop, name='webook-metadata')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def worker_loop(self):
+        while True:
+            path = self.queue.get()
+            start_time = time.time()
+            results = []
+            while True:
+                try:
+                    result = self.extract(path)
+                    if result is not None:
+                        results.append((path, result))
+                except Exception:
+                    self.errors += 1
+                    log.exception('metadata extraction failed %r', path)
+                finally:
+                    with self.lock:
+                        self.pending.discard(path)  # may be queued again, e.g. removed and re-added
+                if len(results) >= COMMIT_BATCH_SIZE:
+                    break
+                try:
+                    path = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if not results:
+                continue
+            try:
+                self.store(results)
+            except Exception:
+                self.errors += 1
+                log.exception('metadata store %r write of %d entries failed', self.db_filename, len(results))
+            log.debug('metadata extracted %d files in %0.2f secs', len(results), time.time() - start_time)
+
+    def reload_loop(self):
+        while True:
+            time.sleep(RELOAD_INTERVAL)
+            try:
+                self.reload_if_changed()
+            except Exception:
+                self.errors += 1
+                log.exception('metadata store %r reload failed', self.db_filename)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'pending': len(self.pending),
+            'hits': self.hits,
+            'misses': self.misses,
+            'extracted': self.extracted,
+            'errors': self.errors,
+            'generation': self.generation,
+        }
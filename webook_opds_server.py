@@ -8,13 +8,16 @@
 Python 2 or Python 3
 """
 
+import atexit
 import logging
 from optparse import OptionParser
 import os
 import mimetypes
+from multiprocessing import cpu_count
 import socket
 import struct
 import sys
+import threading
 import time
 
 try:
@@ -56,8 +59,23 @@ try:
 except ImportError:
     werkzeug = None
 
+try:
+    import webook_asyncio_server
+except (ImportError, SyntaxError):
+    webook_asyncio_server = None  # py2 (or py3 < 3.7), no asyncio server
+
 import ebook_conversion
-from webook_core import BootMeta, ebook_only_mimetypes, guess_mimetype, find_recent_files, load_config, ORDER_DESCENDING
+from webook_compress import CompressionMiddleware, PrecompressedDocument
+from webook_cache import ConversionCache, ConversionCoordinator, ConversionError, ConversionQueueFull, ConversionScheduler, ConversionTimeout, FeedCache, follow_conversion, remove_stale_temp_files
+from webook_core import BootMeta, ebook_only_mimetypes, guess_mimetype, list_directory, load_config, make_private_dir, ORDER_DESCENDING
+from webook_feed import BOOK_ENTRY, DIRECTORY_ENTRY, book_entry_values, directory_entry_values, render_entries
+from webook_index import LibraryIndex
+from webook_metadata import MetadataStore
+from webook_search import TokenIndex
+from webook_http import make_etag, not_modified_response, serve_file
+from webook_thumbnail import THUMBNAIL_CONTENT_TYPE, ThumbnailGenerator, get_cover_extractor, image_content_type
+from webook_watcher import start_watcher
+import webook_servers
 
 is_py3 = sys.version_info >= (3,)
 
@@ -147,32 +165,39 @@ def determine_local_ipaddr():
     return local_address
 
 
-# FIXME use ISO Z instead
-# Weekday and month names for HTTP date/time formatting; always English!
-_weekdayname = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-_monthname = [None, # Dummy so we can use 1-based month numbers
-              "Jan", "Feb", "Mar", "Apr", "May", "Jun",
-              "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-
-def header_format_date_time(timestamp):
-    year, month, day, hh, mm, ss, wd, y, z = time.gmtime(timestamp)
-    return "%s, %02d %3s %4d %02d:%02d:%02d GMT" % (
-        _weekdayname[wd], day, _monthname[month], year, hh, mm, ss
-    )
+def to_bytes(in_str):
+    # could choose to only encode for Python 3+
+    return in_str.encode('utf-8')
 
-def current_timestamp_for_header():
-    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    #return header_format_date_time(time.time())
+STARTUP_TIME = time.time()  # Last-Modified for static documents, they can only change on restart
 
+def catalog_etag(environ, client_type, index, *parts):
+    """ETag for catalog responses generated from the library index, changes whenever the index (or extracted metadata) changes.
+    Only content derived values, no local clocks or counters, so every prefork worker gives the same ETag for the same content
+    """
+    return make_etag(client_type, environ.get('PATH_INFO'), environ.get('QUERY_STRING', ''), len(index), index.digest, metadata_digest(), *parts)
 
-def xml_escape(in_str):
-	#return in_str
-	return in_str.replace('<', '&#60;').replace('>', '&#62;')  # works with koreader
-	#return in_str.replace('<', '&lt;').replace('>', '&gt;')  # untested
+STREAM_BUFFER_SIZE = 16 * 1024  # bytes, target size for chunks of streamed (generator) responses
 
-def to_bytes(in_str):
-    # could choose to only encode for Python 3+
-    return in_str.encode('utf-8')
+def coalesce_chunks(iterable, buffer_size=STREAM_BUFFER_SIZE):
+    """Generator, joins the (many small) byte strings from iterable into chunks of at least buffer_size bytes (apart from the last).
+    Fewer, larger, writes for the WSGI server while memory use stays bounded by buffer_size (plus one chunk)
+    """
+    buffer = []
+    buffered_size = 0
+    try:
+        for chunk in iterable:
+            buffer.append(chunk)
+            buffered_size += len(chunk)
+            if buffered_size >= buffer_size:
+                yield b''.join(buffer)
+                buffer = []
+                buffered_size = 0
+        if buffer:
+            yield b''.join(buffer)
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
 
 def filename_sanitize(filename):
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Disposition
@@ -206,6 +231,35 @@ def not_found(environ, start_response):
 <p>The requested URL /??????? was not found on this server.</p>
 </body></html>''')]
 
+def service_unavailable(environ, start_response, retry_after=None):
+    """serves 503s, retry_after is optional number of seconds"""
+    headers = [('Content-Type', 'text/html')]
+    if retry_after:
+        headers.append(('Retry-After', str(retry_after)))
+    start_response('503 SERVICE UNAVAILABLE', headers)
+    return [to_bytes('''<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">
+<html><head>
+    <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>503 Service Unavailable</title>
+</head><body>
+<h1>Service Unavailable</h1>
+<p>The server is busy converting other books, try again later.</p>
+</body></html>''')]
+
+def gateway_timeout(environ, start_response):
+    """serves 504s, for conversions that took too long"""
+    start_response('504 GATEWAY TIMEOUT', [('Content-Type', 'text/html')])
+    return [to_bytes('''<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">
+<html><head>
+    <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>504 Gateway Timeout</title>
+</head><body>
+<h1>Gateway Timeout</h1>
+<p>The conversion took too long and was abandoned.</p>
+</body></html>''')]
+
 
 CLIENT_OPDS = 'OPDS'
 CLIENT_BROWSER = 'browser'
@@ -294,10 +348,265 @@ def determine_client(environ):
     log.debug('client_type %r', client_type)
     return client_type
 
+def get_query_dict(environ):
+    """Returns a dictionary in which the values are lists, of query string parameters"""
+    if environ.get('QUERY_STRING'):
+        return parse_qs(environ['QUERY_STRING'])
+    return {}
+
+def get_page_number(get_dict):
+    """Returns (1-based) page number requested, via either ?page= or (OpenSearch) ?startIndex= (also 1-based)
+    """
+    items_per_page = config['items_per_page']
+    try:
+        if 'page' in get_dict:
+            return max(1, int(get_dict['page'][0]))
+        if 'startIndex' in get_dict:
+            return max(1, (int(get_dict['startIndex'][0]) - 1) // items_per_page + 1)
+    except ValueError:
+        pass
+    return 1
+
+def paginate(items, page_number):
+    """Returns (page_number, page_count, items for page_number) where page_number is clamped to available pages
+    """
+    items_per_page = config['items_per_page']
+    page_count = max(1, (len(items) + items_per_page - 1) // items_per_page)
+    page_number = min(page_number, page_count)
+    start = (page_number - 1) * items_per_page
+    return page_number, page_count, items[start:start + items_per_page]
+
+def opds_pagination_xml(href_path, query_params, page_number, page_count, total_results):
+    """Returns string, OpenSearch counts and first/previous/next/last navigation links for an OPDS feed
+        href_path - path (already quoted) for links, e.g. /file/some/dir/
+        query_params - list of (name, value) tuples to include in link query strings (other than page)
+    """
+    items_per_page = config['items_per_page']
+    def page_href(number):
+        params = ['%s=%s' % (name, quote(value, safe='')) for name, value in query_params]
+        params.append('page=%d' % number)
+        return href_path + '?' + '&amp;'.join(params)  # href_path and values already quoted, only separator needs xml escaping
+    links = [('first', 1), ('last', page_count)]
+    if page_number > 1:
+        links.append(('previous', page_number - 1))
+    if page_number < page_count:
+        links.append(('next', page_number + 1))
+    result = '''    <opensearch:totalResults>%d</opensearch:totalResults>
+    <opensearch:itemsPerPage>%d</opensearch:itemsPerPage>
+    <opensearch:startIndex>%d</opensearch:startIndex>
+''' % (total_results, items_per_page, (page_number - 1) * items_per_page + 1)
+    for rel, number in links:
+        result += '''    <link rel="%s" href="%s" type="application/atom+xml;profile=opds-catalog;kind=acquisition"/>
+''' % (rel, page_href(number))
+    return result
+
 # NOTE global config - see webook_core.load_config()
 global config
 config = {}
 
+singleton_lock = threading.RLock()  # guards creation of the get_*() globals (double checked), re-entrant as they call each other
+
+conversion_cache = None
+cache_remove_stale = True  # False in prefork workers, the parent removes stale temp files once before forking
+conversion_scheduler = None
+conversion_coordinator = None
+
+def get_conversion_cache():
+    """Returns ConversionCache for config, created on first use
+    """
+    global conversion_cache
+    if conversion_cache is None:
+        with singleton_lock:
+            if conversion_cache is None:
+                make_private_dir(config['conversion_cache_dir'])  # cached files are served as-is, nobody else may plant them
+                conversion_cache = ConversionCache(config['conversion_cache_dir'], max_bytes=config['conversion_cache_max_bytes'], remove_stale=cache_remove_stale)
+    return conversion_cache
+
+def get_conversion_scheduler():
+    """Returns ConversionScheduler for config, created on first use
+    """
+    global conversion_scheduler
+    if conversion_scheduler is None:
+        with singleton_lock:
+            if conversion_scheduler is None:
+                conversion_scheduler = ConversionScheduler(max_workers=config['conversion_workers'], max_queue=config['conversion_queue_size'], timeout=config['conversion_timeout'])
+    return conversion_scheduler
+
+def get_conversion_coordinator():
+    """Returns ConversionCoordinator (wrapping get_conversion_cache() and get_conversion_scheduler()), created on first use
+    """
+    global conversion_coordinator
+    if conversion_coordinator is None:
+        with singleton_lock:
+            if conversion_coordinator is None:
+                conversion_coordinator = ConversionCoordinator(get_conversion_cache(), scheduler=get_conversion_scheduler())
+    return conversion_coordinator
+
+library_index = None
+
+def get_library_index():
+    """Returns LibraryIndex of config['ebook_dir'], scanned on first use
+    """
+    global library_index
+    if library_index is None:
+        with singleton_lock:
+            if library_index is None:
+                new_index = LibraryIndex(config['ebook_dir'], scan_threads=config['scan_threads'])
+                new_index.scan()
+                library_index = new_index
+    return library_index
+
+metadata_store = None
+metadata_extract = True  # False in prefork workers other than the primary, they share (and reload) the primary's metadata_db
+
+def get_metadata_store():
+    """Returns MetadataStore (loaded), created on first use. None if config extract_metadata is disabled
+    """
+    global metadata_store
+    if metadata_store is None and config['extract_metadata']:
+        with singleton_lock:
+            if metadata_store is None and config['extract_metadata']:
+                try:
+                    make_private_dir(os.path.dirname(os.path.abspath(config['metadata_db'])))
+                except OSError as info:
+                    log.error('metadata extraction disabled, directory is not private: %r', info)
+                    config['extract_metadata'] = False
+                    return None
+                new_store = MetadataStore(config['metadata_db'], extract=metadata_extract)
+                new_store.load()
+                new_store.start()
+                metadata_store = new_store
+    return metadata_store
+
+def apply_metadata(metadata):
+    """Returns BootMeta metadata, with title and author from the book content (see get_metadata_store()) if available
+    """
+    store = get_metadata_store()
+    if store is not None:
+        store.apply(metadata)
+    return metadata
+
+def metadata_digest():
+    """Returns digest of extracted metadata (see MetadataStore.digest), None if metadata extraction is disabled
+    """
+    store = get_metadata_store()
+    if store is None:
+        return None
+    return store.digest
+
+search_index = None
+
+def get_search_index(save=True):
+    """Returns TokenIndex of get_library_index() (loaded and brought up to date), created on first use.
+    Kept up to date with library and metadata changes.
+    save - write index to config['search_index'] when changed (periodically), only applies on first use
+    """
+    global search_index
+    if search_index is None:
+        with singleton_lock:
+            if search_index is None:
+                index = get_library_index()
+                filename = config['search_index'] or None
+                if filename:
+                    try:
+                        make_private_dir(os.path.dirname(os.path.abspath(filename)))
+                    except OSError as info:
+                        log.error('search index will not be persisted, directory is not private: %r', info)
+                        filename = None
+                new_index = TokenIndex(filename, metadata_function=indexed_metadata, fuzzy=config['fuzzy_search_limit'] > 0)
+                new_index.load()
+                store = get_metadata_store()
+                if store is not None:
+                    store.listeners.append(lambda path, title, author: metadata_extracted(new_index, path, title, author))  # before sync(), so no extraction is missed meanwhile
+                new_index.sync(index.add_listener(new_index.index_changed))
+                if save:
+                    new_index.save_if_dirty()
+                    new_index.start_autosave()
+                search_index = new_index
+    return search_index
+
+def indexed_metadata(entry):
+    """Returns (title, author) for library IndexEntry from get_metadata_store(), (None, None) if not (yet) known.
+    Does not queue extraction, see metadata_extracted()
+    """
+    store = get_metadata_store()
+    if store is not None:
+        found = store.entries.get(get_library_index().full_path(entry.path))
+        if found is not None and found[0] == entry.size and found[1] == entry.mtime:
+            return found[2], found[3]
+    return None, None
+
+def metadata_extracted(token_index, path, title, author):
+    """MetadataStore listener (for token_index), re-index book with new title/author
+    """
+    index = get_library_index()
+    entry = index.get(index.relative_path(path))
+    if entry is not None:
+        token_index.update(entry)
+
+def search_library(search_term):
+    """Returns list of IndexEntry for search_term, best match first.
+    Word (and word prefix) search with get_search_index(), falls back to (case insensitive) substring match of path,
+    in path order, when there are no word matches e.g. "book" for "mybook.txt". Then to fuzzy (misspelling) search of names
+    """
+    index = get_library_index()
+    search_index = get_search_index()
+    entries = [entry for entry in (index.get(path) for path in search_index.search(search_term)) if entry is not None]
+    if not entries:
+        entries = sorted(index.search(search_term), key=lambda entry: entry.lowered_path)
+    if not entries and config['fuzzy_search_limit'] > 0:
+        log.info('no matches for %r, fuzzy search', search_term)
+        entries = [entry for entry in (index.get(path) for path in search_index.fuzzy_search(search_term, threshold=config['fuzzy_search_threshold'], limit=config['fuzzy_search_limit'])) if entry is not None]
+    return entries
+
+feed_cache = None
+
+def get_feed_cache():
+    """Returns FeedCache, for rendered directory listings, created on first use
+    """
+    global feed_cache
+    if feed_cache is None:
+        with singleton_lock:
+            if feed_cache is None:
+                feed_cache = FeedCache(max_bytes=config['feed_cache_max_bytes'])
+    return feed_cache
+
+thumbnail_generator = None
+
+def get_thumbnail_generator():
+    """Returns ThumbnailGenerator for config, created on first use. None if config thumbnails is disabled
+    """
+    global thumbnail_generator
+    if thumbnail_generator is None and config['thumbnails']:
+        with singleton_lock:
+            if thumbnail_generator is None and config['thumbnails']:
+                try:
+                    make_private_dir(config['thumbnail_cache_dir'])  # cached files are served as-is, nobody else may plant them
+                except OSError as info:
+                    log.error('thumbnails disabled, directory is not private: %r', info)
+                    config['thumbnails'] = False
+                    return None
+                thumbnail_generator = ThumbnailGenerator(config['thumbnail_cache_dir'], max_bytes=config['thumbnail_cache_max_bytes'], size=config['thumbnail_size'], max_workers=config['thumbnail_workers'], remove_stale=cache_remove_stale)
+    return thumbnail_generator
+
+def book_entry(metadata, web_path):
+    """Returns (BOOK_ENTRY, values) for render_entries(), with title/author from book content (see apply_metadata())
+    and thumbnail links for books that may have a cover. Thumbnails are generated in the background (not waited for)
+        metadata - BootMeta
+        web_path - path of the book under /file/, not quoted
+    """
+    apply_metadata(metadata)
+    thumbnail_href = None
+    generator = get_thumbnail_generator()
+    if generator is not None and get_cover_extractor(metadata.base_filename) is not None:
+        thumbnail_href = '/thumb/' + quote(web_path)
+        if metadata.file_mtime is not None:
+            thumbnail_href += '?v=%d' % metadata.file_mtime  # new URL when the book changes, thumbnails are served with long-lived cache headers
+        generator.prefetch(metadata.filename)
+    return BOOK_ENTRY, book_entry_values(metadata, web_path, thumbnail_href=thumbnail_href, thumbnail_type=THUMBNAIL_CONTENT_TYPE)
+
+CONVERSION_RETRY_AFTER = 30  # seconds, Retry-After for 503 when conversion queue is full
+
 def get_template(template_filename):
     f = open(os.path.join(os.path.dirname(__file__), 'templates', template_filename), 'rb')
     template_string = f.read()
@@ -305,13 +614,14 @@ def get_template(template_filename):
     template_string = template_string.decode('utf-8')
     return template_string
 
-def opds_book_entry(full_file_path_and_name_to_book, web_directory_path=None, web_full_file_path_and_name_to_book=None, filename=None):
+def opds_book_entry(full_file_path_and_name_to_book, web_directory_path=None, web_full_file_path_and_name_to_book=None, filename=None, stat_result=None):
     """Refactored and extracted out of opds_browse()
     return a single OPDS book/file entry in bytes (revisit, should it be string?)
     Parameters:
         full_file_path_and_name_to_book - full local path on local/native filesystem to the file
         web_directory_path - web path of file (i.e. the parent URL of the file) which if not empty needs to include trailing slash?
         filename - optional filename, derived from full_file_path_and_name_to_book if omitted
+        stat_result - optional os.stat() result for the file, looked up if omitted
     """
     #log.debug('full_file_path_and_name_to_book %r', full_file_path_and_name_to_book)  # A little too verbose for debug
     #print('opds_book_entry params %r' % ((full_file_path_and_name_to_book, web_directory_path, filename),))
@@ -322,38 +632,9 @@ def opds_book_entry(full_file_path_and_name_to_book, web_directory_path=None, we
     web_full_file_path_and_name_to_book = web_full_file_path_and_name_to_book or (directory_path + filename)
 
     # Needs to be a file (maybe an slink) - not a directory
-    metadata = BootMeta(full_file_path_and_name_to_book)
-    # TODO try and guess title and author name
+    template, values = book_entry(BootMeta(full_file_path_and_name_to_book, stat_result=stat_result), web_full_file_path_and_name_to_book)
     # TODO is there a way to get "book information" link to work?
-    result = to_bytes('''
-    <entry>
-        <title>{title}</title>
-        <author>
-            <name>{author_name_surname_first}</name>
-        </author>
-        <id>{title}</id>
-        <content type="xhtml">
-            <div xmlns="http://www.w3.org/1999/xhtml">
-                <p>Original filename: {base_filename}</p>
-                <p>file size: {file_size}Mb</p>
-            </div>
-        </content>
-        <link type="application/octet-stream" rel="http://opds-spec.org/acquisition" title="Raw ({file_extension})" href="/file/{href_path}"/><!-- koreader will hide and not display this due to (some) unsupported mime-type - hence "Original" with different type -->
-        <link type="{mime_type}" rel="http://opds-spec.org/acquisition" title="Original ({file_extension})" href="/file/{href_path}"/>
-        <link type="application/epub+zip" rel="http://opds-spec.org/acquisition" title="EPUB convert" href="/epub/{href_path}"/>
-        <link type="application/x-mobipocket-ebook" rel="http://opds-spec.org/acquisition" title="Kindle (mobi) convert" href="/mobi/{href_path}"/>
-        <link type="text/plain" rel="http://opds-spec.org/acquisition" title="Text (txt) convert" href="/txt/{href_path}"/>
-    </entry>
-'''.format(
-        author_name_surname_first=metadata.author,  # 'lastname, firstname',
-        href_path=quote(web_full_file_path_and_name_to_book),
-        mime_type=metadata.mimetype,  #"application/epub+zip",  #'application/octet-stream'  # FIXME choosing something koreader does not support results in option being invisible
-        # unclear on text koreader charset encoding. content-type for utf-8 = "text/plain; charset=utf-8"
-        title=xml_escape(metadata.title),  # quote(metadata.title),   # ends up with escaping showing  in koreader # koreader fails to parse when filename contains single quotes if using: escape(file_name, quote=True), - HOWEVER koreader will fail if <> are left unescaped.
-        base_filename=xml_escape(metadata.base_filename),
-        file_size='%0.1f' % (metadata.file_octet_size / 1024 / 1024 + 0.1,),  #  TODO human-readable
-        file_extension=metadata.file_extension  # no need to escape?
-        ))
+    result = to_bytes(template.render(values))
     return result
 
 
@@ -371,16 +652,17 @@ def search_recent(environ, start_response):
                     ('Content-Type', 'text/html'),  # "application/atom+xml; charset=UTF-8"
                     ('Cache-Control', 'no-cache, must-revalidate'),
                     ('Pragma', 'no-cache'),
-                    ('Last-Modified', current_timestamp_for_header()),
                 ]
     else:  # CLIENT_OPDS
         headers = [
                     ('Content-type', 'application/xml'),  # "application/atom+xml; charset=UTF-8"
                     ('Cache-Control', 'no-cache, must-revalidate'),
                     ('Pragma', 'no-cache'),
-                    ('Last-Modified', current_timestamp_for_header()),
                     ]
 
+    index = get_library_index()
+    if not_modified_response(environ, start_response, headers, catalog_etag(environ, client_type, index), index.last_modified) is not None:
+        return  # 304
     start_response(status, headers)
 
     # Returns a dictionary in which the values are lists
@@ -429,7 +711,7 @@ def search_recent(environ, start_response):
         # <opensearch:itemsPerPage>25</opensearch:itemsPerPage> seems to work well an be easy to page between results on my devices with minimal scrolling
         yield to_bytes(
         '''<?xml version="1.0" encoding="UTF-8"?>
-          <feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" xmlns:opds="http://opds-spec.org/2010/catalog">
+          <feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" xmlns:opds="http://opds-spec.org/2010/catalog" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">
               <title>Recently added</title>
               <id>/</id>
               <link rel="start" href="/" type="application/atom+xml;profile=opds-catalog;kind=navigation"></link>
@@ -445,22 +727,18 @@ def search_recent(environ, start_response):
 
     log.debug('pre recent search')
     # find all recent files before returning any results
-    directory_path = config['ebook_dir']
-    directory_path_len = len(directory_path) + 1  # +1 is the directory seperator (assuming Unix or Windows paths)
-    recent_file_list = find_recent_files(directory_path, number_of_files=number_of_files, order=sort_order)
+    recent_file_list = index.recent(number_of_files)  # newest first
+    if ORDER_DESCENDING != sort_order:
+        recent_file_list.reverse()
 
     log.debug('pre recent for loop')
-    for file_name in recent_file_list:
-        tmp_path_sans_prefix = file_name[directory_path_len:]
-        #results.append(tmp_path_sans_prefix)
-        # TODO include file size?
-        url = tmp_path_sans_prefix
-        if client_type == CLIENT_BROWSER:
-            yield to_bytes(search_hit_template.format(url=escape(url)))
-        else:  # CLIENT_OPDS
-            #print('search_recent() params %r' % ((file_name, tmp_path_sans_prefix, ),))
-            single_book_entry = opds_book_entry(file_name, web_full_file_path_and_name_to_book=tmp_path_sans_prefix)
-            yield single_book_entry
+    if client_type == CLIENT_BROWSER:
+        for entry in recent_file_list:
+            # TODO include file size?
+            yield to_bytes(search_hit_template.format(url=escape(entry.path)))
+    else:  # CLIENT_OPDS
+        for chunk in render_entries(book_entry(BootMeta(index.full_path(entry.path), file_octet_size=entry.size, file_mtime=entry.mtime), entry.path) for entry in recent_file_list):
+            yield chunk
 
 
     if not recent_file_list:
@@ -490,9 +768,6 @@ def browser_search(environ, start_response):
     TODO GET and POST support
     """
     log.info('browser_search')
-    template_filename = 'browser_search.html'
-    template_string = get_template(template_filename)
-
     # Returns a dictionary in which the values are lists
     if environ.get('QUERY_STRING'):
         get_dict = parse_qs(environ['QUERY_STRING'])
@@ -506,18 +781,10 @@ def browser_search(environ, start_response):
     log.info('search search_term %s', search_term)
 
     status = '200 OK'
-    headers = [('Content-Type', 'text/html')]
-    result = []
-
 
     if not search_term:
-        result.append(to_bytes(template_string))  # TODO replace with template (with replacement markers/variables)
-        headers.append(('Content-Length', str(len(result[0]))))  # in case WSGI server does not implement this
-        headers.append(('Last-Modified', current_timestamp_for_header()))  # many clients will cache
-
-        start_response(status, headers)
-        #return result
-        yield result[0]
+        for chunk in get_static_document('browser-search').serve(environ, start_response):
+            yield chunk
         return
         #return render_template('search.html')  # TODO
     #raise NotImplementedError()
@@ -527,15 +794,13 @@ def browser_search(environ, start_response):
                 ('Content-Type', 'text/html'),  # "application/atom+xml; charset=UTF-8"
                 ('Cache-Control', 'no-cache, must-revalidate'),
                 ('Pragma', 'no-cache'),
-                ('Last-Modified', current_timestamp_for_header()),
             ]
+    index = get_library_index()
+    if not_modified_response(environ, start_response, headers, catalog_etag(environ, CLIENT_BROWSER, index), index.last_modified) is not None:
+        return  # 304
     start_response(status, headers)
 
     # TODO regex?
-    search_term = search_term.lower()  # for now single search term, case insensitive compare
-    directory_path = config['ebook_dir']
-    directory_path_len = len(directory_path) + 1  # +1 is the directory seperator (assuming Unix or Windows paths)
-    join = os.path.join  # for performance, rather than reduced typing
 
     log.debug('yield head')
     yield to_bytes('''<html>
@@ -557,23 +822,13 @@ def browser_search(environ, start_response):
     search_hit_template = '''<a href="/file/{filename_url}">{filename}</a><br>'''
 
     log.debug('pre for')
-    #results = []  # TODO yield results?
-    for root, dirs, files in os.walk(directory_path):
-        for dir_name in dirs:
-            tmp_path = join(root, dir_name)
-            tmp_path_sans_prefix = tmp_path[directory_path_len:]
-            if search_term in tmp_path_sans_prefix.lower():
-                #results.append(tmp_path_sans_prefix + '/')  # when appended add trailing slash for directories, avoid Flask oddness
-                filename = tmp_path_sans_prefix + '/'  # make clear a dir with trailing slash
-                yield to_bytes(search_hit_template.format(filename_url=quote(filename), filename=escape(filename)))
-        for file_name in files:
-            tmp_path = join(root, file_name)
-            tmp_path_sans_prefix = tmp_path[directory_path_len:]
-            if search_term in tmp_path_sans_prefix.lower():
-                #results.append(tmp_path_sans_prefix)
-                # TODO include file size?
-                filename = tmp_path_sans_prefix
-                yield to_bytes(search_hit_template.format(filename_url=quote(filename), filename=escape(filename)))
+    for entry in search_library(search_term):
+        if entry.is_dir:
+            filename = entry.path + '/'  # make clear a dir with trailing slash
+        else:
+            # TODO include file size?
+            filename = entry.path
+        yield to_bytes(search_hit_template.format(filename_url=quote(filename), filename=escape(filename)))
 
     yield to_bytes('''
         </pre>
@@ -602,109 +857,77 @@ def opds_search(environ, start_response):
     For OPDS clients. Similar to browser_search()
     """
     log.info('opds_search')
-    # Returns a dictionary in which the values are lists
-    if environ.get('QUERY_STRING'):
-        get_dict = parse_qs(environ['QUERY_STRING'])
-    else:
-        get_dict = {}
+    get_dict = get_query_dict(environ)
     q = get_dict.get('q')  # same as most search engines
     #print('get_dict=%r'% get_dict)
     if not q:
         return not_found(environ, start_response)
     log.info('search term q=%r', q)
 
-    result = [to_bytes(
-'''<?xml version="1.0" encoding="UTF-8"?>
-  <feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" xmlns:opds="http://opds-spec.org/2010/catalog">
-      <title>webook server - Search Results</title>
-      <id>/</id>
-      <link rel="start" href="/" type="application/atom+xml;profile=opds-catalog;kind=navigation"></link>
-      <updated></updated><!-- TODO FIXME implement UTC ISO timestamp string for now -->
-
-      <!-- koreader does NOT need an icon -->
-
-      <link rel="search" type="application/opensearchdescription+xml" title="webook Catalog Search" href="{WEBOOK_SELF_URL_PATH}/search-metadata.xml"/>
-    <opensearch:itemsPerPage>25</opensearch:itemsPerPage>
-    <opensearch:startIndex>1</opensearch:startIndex>
-
-'''.format(WEBOOK_SELF_URL_PATH=config['self_url_path']))]
-
     search_term = q[0]  # TODO think this is correct, rather than concat all
-    search_term = search_term.lower()  # for now single search term, case insensitive compare
-    directory_path = config['ebook_dir']
-    directory_path_len = len(directory_path) + 1  # +1 is the directory seperator (assuming Unix or Windows paths)
-    join = os.path.join  # for performance, rather than reduced typing
-    file_counter = 0
-    log.info('searching file system')
-    #log.debug('directory_path %r', directory_path)
-    #log.debug('directory_path_len %r', directory_path_len)
-    #log.debug('test path  %r', os.path.join(directory_path, '1234567.890')[directory_path_len:])
-    for root, dirs, files in os.walk(directory_path):
-        for dir_name in dirs:
-            # any directory names that hit
-            tmp_path = join(root, dir_name)
-            tmp_path_sans_prefix = tmp_path[directory_path_len:]
-            if search_term in tmp_path_sans_prefix.lower():
-                file_counter += 1
-                # FIXME escaping missing - template and/or xml API usage
-                result.append(to_bytes('''
-      <entry>
-          <title>{title}/</title>
-          <id>{tmp_path_sans_prefix}</id>
-          <link rel="subsection" href="/file/{tmp_path_sans_prefix}" type="application/atom+xml;profile=opds-catalog;kind=acquisition" title="{tmp_path_sans_prefix}"></link>
-      </entry>
-'''.format(
-        title=escape(dir_name, quote=True),
-        tmp_path_sans_prefix=quote(tmp_path_sans_prefix))))
-
-        for file_name in files:
-            # any file names that hit
-            tmp_path = join(root, file_name)  # fully qualified, native path / filename
-            tmp_path_sans_prefix = tmp_path[directory_path_len:]
-            if search_term in tmp_path_sans_prefix.lower():
-                #print('opds_search() params %r' % ((file_name, tmp_path_sans_prefix, ),))
-                single_book_entry = opds_book_entry(tmp_path, web_full_file_path_and_name_to_book=tmp_path_sans_prefix, filename=file_name)
-                result.append(single_book_entry)
-
-                #print('DEBUG file_name: %r' % file_name)
-                #print('DEBUG tmp_path_sans_prefix: %r' % tmp_path_sans_prefix)
-                #print('DEBUG %r' % )
-    log.info('search of file system complete')
-
-    #log.error('NotImplemented search support')
-    #return not_found(environ, start_response)
+    index = get_library_index()
+    log.info('searching library index')
+    hits = search_library(search_term)
+    total_results = len(hits)
+    page_number, page_count, hits = paginate(hits, get_page_number(get_dict))
+    log.info('search of library index complete, %d hits, page %d of %d', total_results, page_number, page_count)
 
     status = '200 OK'
     headers = [
                 ('Content-type', 'application/xml'),  # "application/atom+xml; charset=UTF-8"
                 ('Cache-Control', 'no-cache, must-revalidate'),
                 ('Pragma', 'no-cache'),
-                ('Last-Modified', current_timestamp_for_header()),
                 ]
+    result = not_modified_response(environ, start_response, headers, catalog_etag(environ, CLIENT_OPDS, index), index.last_modified)
+    if result is not None:
+        return result
+    start_response(status, headers)
+    return coalesce_chunks(opds_search_feed(index, search_term, hits, page_number, page_count, total_results))
+
+def opds_search_feed(index, search_term, hits, page_number, page_count, total_results):
+    """Generator for opds_search() feed, hits is list of IndexEntry for the page
+    """
+    yield to_bytes(
+'''<?xml version="1.0" encoding="UTF-8"?>
+  <feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" xmlns:opds="http://opds-spec.org/2010/catalog" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">
+      <title>webook server - Search Results</title>
+      <id>/</id>
+      <link rel="start" href="/" type="application/atom+xml;profile=opds-catalog;kind=navigation"></link>
+      <updated></updated><!-- TODO FIXME implement UTC ISO timestamp string for now -->
 
-    if file_counter == 0:
-        result.append(to_bytes('''
+      <!-- koreader does NOT need an icon -->
+
+      <link rel="search" type="application/opensearchdescription+xml" title="webook Catalog Search" href="{WEBOOK_SELF_URL_PATH}/search-metadata.xml"/>
+{pagination}
+'''.format(WEBOOK_SELF_URL_PATH=config['self_url_path'], pagination=opds_pagination_xml('/opds/search', [('q', search_term)], page_number, page_count, total_results)))
+
+    def entries():
+        for entry in hits:
+            if entry.is_dir:
+                # any directory names that hit
+                quoted_path = quote(entry.path)
+                yield DIRECTORY_ENTRY, directory_entry_values(os.path.basename(entry.path), quoted_path, '/file/' + quoted_path, quoted_path)
+            else:
+                # any file names that hit
+                yield book_entry(BootMeta(index.full_path(entry.path), file_octet_size=entry.size, file_mtime=entry.mtime), entry.path)
+
+    for chunk in render_entries(entries()):
+        yield chunk
+
+    if total_results == 0:
+        yield to_bytes('''
     <entry>
         <title>No records found.</title>
     </entry>
-'''))
-
-    result.append(to_bytes('''  </feed>
-'''))
-    start_response(status, headers)
-    return result
+''')
 
-def opds_search_meta(environ, start_response):
-    """Handles/serves
+    yield to_bytes('''  </feed>
+''')
 
-        /search-metadata.xml
+def render_search_meta():
+    """Returns OpenSearch description document (bytes), constant for config, see static_documents
     """
-    log.info('opds_search_meta')
-    status = '200 OK'
-    headers = [('Content-type', 'application/xml')]
-    result = []
-
-    result.append(to_bytes(
+    return to_bytes(
 '''<?xml version="1.0" encoding="UTF-8"?>
 
 <OpenSearchDescription xmlns="http://a9.com/-/spec/opensearch/1.1/">
@@ -732,13 +955,15 @@ def opds_search_meta(environ, start_response):
 </OpenSearchDescription>
 
 '''.format(WEBOOK_SELF_URL_PATH=config['self_url_path'])  # NOTE searchTerms is escaped so as to preserve {searchTerms}
-    ))
+    )
 
-    headers.append(('Content-Length', str(len(result[0]))))  # in case WSGI server does not implement this
-    headers.append(('Last-Modified', current_timestamp_for_header()))  # many clients will cache
+def opds_search_meta(environ, start_response):
+    """Handles/serves
 
-    start_response(status, headers)
-    return result
+        /search-metadata.xml
+    """
+    log.info('opds_search_meta')
+    return get_static_document('search-metadata').serve(environ, start_response)
 
 
 def opds_browse(environ, start_response):
@@ -756,7 +981,6 @@ def opds_browse(environ, start_response):
     log.info('opds_browse')
     status = '200 OK'
     headers = [('Content-type', 'application/atom+xml;profile=opds-catalog;kind=acquisition')]
-    result = []
 
     directory_path_split = environ['PATH_INFO'].split('/', 2)  # /file/some/path
     log.info('directory_path_split  %s', directory_path_split)
@@ -792,6 +1016,7 @@ def opds_browse(environ, start_response):
         existing_ebook_format = existing_ebook_format[1:]  # removing leading '.'
         log.info('serve existing_ebook_format %r', existing_ebook_format)
         do_conversion = True
+        streaming_job = None  # conversion in progress, followed rather than waited for
         if existing_ebook_format == operation_requested or operation_requested in ('file'):
             do_conversion = False
             operation_requested = existing_ebook_format
@@ -799,79 +1024,142 @@ def opds_browse(environ, start_response):
         result_ebook_filename =  os.path.basename(os_path)
 
         if do_conversion:
-            # do conversion
-            # TODO consider file caching (see note below about deleting/cleanup of temp files)
+            # do conversion, or serve previous conversion from cache
             log.info('convert ebook from %s into %s', os_path, operation_requested)
-            # TODO if same format, do not convert
             # TODO use meta data in file to generate filename
-            #result_ebook_filename = 'fixme_generate_filename.' + operation_requested
             result_ebook_filename = os.path.splitext(result_ebook_filename)[0] + '.' + operation_requested  # NOTE unsure if koreader will pay attention to this filename
-            tmp_ebook_filename = 'fixme_generate_filename.' + operation_requested
-            tmp_ebook_filename = os.path.join(config['temp_dir'], tmp_ebook_filename)
-
-            # could delete if already exists
-            if os.path.exists(tmp_ebook_filename):
-                os.remove(tmp_ebook_filename)
-
-            # simple caching support
-            if not os.path.exists(tmp_ebook_filename):
-                ebook_conversion.convert(os_path, tmp_ebook_filename)
-            book_to_serve = tmp_ebook_filename
-            # now serve content of tmp_ebook_filename, then potentially delete tmp_ebook_filename
+            # validators (ETag, Last-Modified) come from the cached output file in serve_file(), they describe the converted bytes
+            coordinator = get_conversion_coordinator()
+            try:
+                if config['streaming_conversion'] and ebook_conversion.supports_streaming(operation_requested):
+                    # serve output as it is written, rather than the client waiting (and maybe timing out) for the whole conversion
+                    streaming_job = coordinator.start(os_path, operation_requested)
+                    if not streaming_job.started.wait(coordinator.wait_timeout()):
+                        raise ConversionTimeout('gave up waiting for conversion %r to start' % os_path)
+                    if streaming_job.event.is_set():
+                        # already converted (cached), or failed. Serve as usual
+                        if streaming_job.error is not None:
+                            raise streaming_job.error
+                        book_to_serve = streaming_job.result
+                        streaming_job = None
+                else:
+                    book_to_serve = coordinator.convert(os_path, operation_requested)
+            except ConversionQueueFull as info:
+                log.error('conversion rejected %r', info)
+                return service_unavailable(environ, start_response, retry_after=CONVERSION_RETRY_AFTER)
+            except ConversionTimeout as info:
+                log.error('conversion timeout %r', info)
+                return gateway_timeout(environ, start_response)
+            except ConversionError as info:
+                log.error('conversion failed %r', info)
+                return not_found(environ, start_response)  # FIXME return a better error for internal server error
 
         #check actual extension with operation_requested
-        try:
-            f = open(book_to_serve, 'rb')
-        except IOError:
-            return not_found(environ, start_response)  # FIXME return a better error for internal server error
         content_type = guess_mimetype(result_ebook_filename)
         content_disposition = 'attachment; filename="%s"; filename*=utf-8\'\'%s' % (filename_sanitize(result_ebook_filename), filename_rfc6266(result_ebook_filename))  # FIXME TODO rfc-6266
         if not is_py3:
             # if py2 - avoid wsgiref AssertionError: Header values must be strings
             content_disposition = content_disposition.encode('utf-8')  # TODO use to_bytes() instead without if check?
         headers = [
-                                ('Content-type', content_type),
                                 ('Content-Disposition', content_disposition),
                             ]
-        headers.append(('Last-Modified', current_timestamp_for_header()))  # TODO headers, date could be from filesystem
         #log.debug('headers %r', headers)
-        start_response(status, headers)
-        return f
+        if streaming_job is not None:
+            # no Content-Length, ranges or validators until complete; chunked (or connection close) delimited
+            log.info('streaming conversion in progress %r', streaming_job.output_filename)
+            headers.append(('Content-type', content_type))
+            start_response(status, headers)
+            return follow_conversion(streaming_job, wait_timeout=coordinator.wait_timeout())
+        try:
+            return serve_file(environ, start_response, book_to_serve, content_type, headers)  # handles Range and conditional requests
+        except (IOError, OSError):
+            return not_found(environ, start_response)  # FIXME return a better error for internal server error
 
     log.info('browsing directory')
     client_type = determine_client(environ)
+    # directory mtime changes when entries are added/removed/renamed, index directory_state() for changes to the files themselves.
+    # Only changes to this directory's entries count, changes elsewhere in the library leave the listing (and cached copy) valid
+    try:
+        directory_mtime = os.stat(os_path).st_mtime
+    except OSError:
+        return not_found(environ, start_response)
+    index = get_library_index()
+    directory_digest, directory_modified = index.directory_state(index.relative_path(os.path.abspath(os_path)))
+    etag = make_etag(client_type, environ.get('PATH_INFO'), environ.get('QUERY_STRING', ''), directory_mtime, directory_digest, metadata_digest())  # content derived, same in every prefork worker
+    last_modified = max(directory_mtime, directory_modified)
+    validator = (directory_mtime, directory_digest, metadata_digest())  # for get_feed_cache()
 
     if client_type == CLIENT_BROWSER:
         # FIXME TODO if missing trailing '/' end up with parent directory...
         log.debug('browse os_path %r', os_path)
         log.info('browse %s', directory_path)
-        # format vaugely like Apache and Nginx file browse / auto-index mode
-        # TODO use a template
-        HTML_HEADER = """<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>Index of {path_title}</title></head><body bgcolor="white"><h1>Index of {path_title}</h1><hr><pre><a href="../">../</a>\n"""
-        HTML_FOOTER = '</pre><hr><a href="https://github.com/clach04/webook_server/">&#x1F4A9;&#x1f4d6; webook_server - light weight OPDS and web server that converts ebook formats on the fly</a></body></html>'
-        path_title = environ['PATH_INFO']
-        html = HTML_HEADER.format(path_title=path_title)
-        files = os.listdir(os_path)
-        for filename in files:  # TODO duplicated code, see OPDS loop below
-            file_path = os_path+'/'+filename
-            size = str(os.path.getsize(file_path))
-            date = os.path.getmtime(file_path)
-            date = time.gmtime(date)
-            date = time.strftime('%d-%b-%Y %H:%M',date)  # match Apache/Nginix date format (todo option for ISO)
-            spaces1 = ' '*(50-len(filename))
-            spaces2 = ' '*(20-len(size))
-            # FIXME cgi escape needed!
-            if os.path.isdir(file_path): html += '<a href="' + quote(filename) + '/">' + escape(filename) + '/</a>'+spaces1+date+spaces2+'   -\n'
-            else: html += '<a href="' + quote(filename) + '">' + escape(filename) + '</a>'+spaces1+' '+date+spaces2+size+'\n'
-        html += HTML_FOOTER
-        headers = [('Content-Type', 'text/html'), ('Content-Length', str(len(html)))]
-        headers.append(('Last-Modified', current_timestamp_for_header()))  # many clients will cache - koreader will show old directory info
-        start_response(status, headers)
-        return [to_bytes(html)]
+        headers = [('Content-Type', 'text/html')]
+        result = not_modified_response(environ, start_response, headers, etag, last_modified)
+        if result is not None:
+            return result
+        cache_key = (environ['PATH_INFO'], client_type, None)  # PATH_INFO is used as the title
+        return cached_feed(start_response, status, headers, cache_key, validator, lambda: browser_directory_listing(os_path, environ['PATH_INFO']))
 
     # else client_type == CLIENT_OPDS
-    result.append(to_bytes('''<?xml version="1.0" encoding="UTF-8"?>
-  <feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" xmlns:opds="http://opds-spec.org/2010/catalog">
+    result = not_modified_response(environ, start_response, headers, etag, last_modified)  # many clients will cache - koreader used to show old directory info
+    if result is not None:
+        return result
+    requested_page_number = get_page_number(get_query_dict(environ))
+
+    def render_feed():
+        # directories first, then files - sort before formatting so only entries on requested page are formatted (and stat-ed)
+        dir_entries = sorted(list_directory(os_path), key=lambda dir_entry: (not dir_entry.is_dir(), dir_entry.name.lower(), dir_entry.name))
+        total_results = len(dir_entries)
+        page_number, page_count, dir_entries = paginate(dir_entries, requested_page_number)
+        log.info('browse page %d of %d', page_number, page_count)
+        return opds_directory_feed(directory_path, os_path, dir_entries, page_number, page_count, total_results)
+
+    return cached_feed(start_response, status, headers, (directory_path, client_type, requested_page_number), validator, render_feed)
+
+def cached_feed(start_response, status, headers, cache_key, validator, render_function):
+    """Serve rendered response from get_feed_cache(), render_function() (returns iterable of bytes) is only called on a cache miss.
+    The rendered response is streamed and stored in the cache once complete
+    """
+    feed_cache = get_feed_cache()
+    body = feed_cache.lookup(cache_key, validator)
+    if body is not None:
+        log.info('feed cache hit %r', cache_key)
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [body]
+    start_response(status, headers)
+    return feed_cache.tee(cache_key, validator, coalesce_chunks(render_function()))
+
+def browser_directory_listing(os_path, path_title):
+    """Generator for opds_browse() web browser directory listing
+    format vaugely like Apache and Nginx file browse / auto-index mode
+    """
+    # TODO use a template
+    HTML_HEADER = """<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>Index of {path_title}</title></head><body bgcolor="white"><h1>Index of {path_title}</h1><hr><pre><a href="../">../</a>\n"""
+    HTML_FOOTER = '</pre><hr><a href="https://github.com/clach04/webook_server/">&#x1F4A9;&#x1f4d6; webook_server - light weight OPDS and web server that converts ebook formats on the fly</a></body></html>'
+    yield to_bytes(HTML_HEADER.format(path_title=path_title))
+    for dir_entry in list_directory(os_path):  # TODO duplicated code, see opds_directory_feed()
+        filename = dir_entry.name
+        try:
+            stat_result = dir_entry.stat()  # single (cached) stat for size, date, and directory check
+        except OSError:
+            continue  # e.g. dangling symlink
+        size = str(stat_result.st_size)
+        date = stat_result.st_mtime
+        date = time.gmtime(date)
+        date = time.strftime('%d-%b-%Y %H:%M',date)  # match Apache/Nginix date format (todo option for ISO)
+        spaces1 = ' '*(50-len(filename))
+        spaces2 = ' '*(20-len(size))
+        # FIXME cgi escape needed!
+        if dir_entry.is_dir(): yield to_bytes('<a href="' + quote(filename) + '/">' + escape(filename) + '/</a>'+spaces1+date+spaces2+'   -\n')
+        else: yield to_bytes('<a href="' + quote(filename) + '">' + escape(filename) + '</a>'+spaces1+' '+date+spaces2+size+'\n')
+    yield to_bytes(HTML_FOOTER)
+
+def opds_directory_feed(directory_path, os_path, dir_entries, page_number, page_count, total_results):
+    """Generator for opds_browse() OPDS directory feed, dir_entries is the list of DirEntry (in os_path) for the page
+    """
+    yield to_bytes('''<?xml version="1.0" encoding="UTF-8"?>
+  <feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" xmlns:opds="http://opds-spec.org/2010/catalog" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">
       <title>webook server - Catalog in /</title>  <!-- FIXME only true for root directory -->
       <id>/</id>
       <link rel="start" href="/" type="application/atom+xml;profile=opds-catalog;kind=navigation"></link>
@@ -880,114 +1168,88 @@ def opds_browse(environ, start_response):
       <!-- koreader does NOT need an icon -->
 
       <link rel="search" type="application/opensearchdescription+xml" title="webook Catalog Search" href="{WEBOOK_SELF_URL_PATH}/search-metadata.xml"/>
-    <opensearch:itemsPerPage>25</opensearch:itemsPerPage>
-    <opensearch:startIndex>1</opensearch:startIndex>
-
+{pagination}
       <entry>
           <title>BROWSE Root</title>
           <id>BROWSE</id>
           <link rel="subsection" href="/file/" type="application/atom+xml;profile=opds-catalog;kind=acquisition" title="BROWSE"></link>
       </entry>
 
-'''.format(WEBOOK_SELF_URL_PATH=config['self_url_path'])
-            ))
-
-    files = os.listdir(os_path)
-    for filename in files:  # TODO duplicated code, see browser loop code above
-        file_path = os.path.join(os_path, filename)
-        """
-        size = str(os.path.getsize(file_path))
-        date = os.path.getmtime(file_path)
-        date = time.gmtime(date)
-        date = time.strftime('%d-%b-%Y %H:%M', date)  # match Apache/Nginix date format (todo option for ISO)
-        spaces1 = ' '*(50-len(filename))
-        spaces2 = ' '*(20-len(size))
-        """
-        # FIXME cgi escape needed!
-        if os.path.isdir(file_path):
+'''.format(WEBOOK_SELF_URL_PATH=config['self_url_path'], pagination=opds_pagination_xml(quote('/file/' + directory_path), [], page_number, page_count, total_results))
+            )
+
+    def entries():
+        for dir_entry, metadata in BootMeta.for_directory(os_path, dir_entries):  # TODO duplicated code, see browser_directory_listing()
+            filename = dir_entry.name
+            if dir_entry.is_dir():
                 # Directory result
-                result.append(to_bytes('''
-      <entry>
-          <title>{filename}/</title>
-          <id>{filename}</id>
-          <link rel="subsection" href="{href_path}" type="application/atom+xml;profile=opds-catalog;kind=acquisition" title="{filename}"></link>
-      </entry>
-'''.format(filename=xml_escape(filename), href_path=quote('/file/' + directory_path  + filename))))  # href need full path (/file/.....) not relative...
+                # href need full path (/file/.....) not relative...
                 # FIXME TODO /file should be take from directory_path_split in case of /epub, etc.
-                #print(result[-1])
-        else:
-            # got a file (maybe an slink)
-            single_book_entry = opds_book_entry(file_path, web_directory_path=directory_path, filename=filename)
-            result.append(single_book_entry)
+                yield DIRECTORY_ENTRY, directory_entry_values(filename, filename, quote('/file/' + directory_path + filename), filename)
+            elif metadata is not None:
+                # got a file (maybe an slink), None if it could not be stat-ed e.g. dangling symlink
+                yield book_entry(metadata, directory_path + filename)
 
-    result.append(to_bytes('''  </feed>
-'''))
+    for chunk in render_entries(entries()):
+        yield chunk
 
-    headers.append(('Last-Modified', current_timestamp_for_header()))  # many clients will cache - koreader will show old directory info
-    start_response(status, headers)
-    return result
+    yield to_bytes('''  </feed>
+''')
 
 
-KOREADER_USER_AGENT_PREFIX = 'KOReader'
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60  # seconds, feeds link to thumbnails with the book mtime in the URL
 
-def opds_root(environ, start_response):
+def thumbnail(environ, start_response):
     """Handles/serves
 
-        /
-        i.e. the root, and also handles routing
-    """
-    log.info('opds_root')
-    if not config.get('self_url_path'):
-        raise KeyError('self_url_path (or OS variable WEBOOK_SELF_URL_PATH) missing')
-
-    status = '200 OK'
-    headers = [('Content-type', 'application/atom+xml;profile=opds-catalog;kind=acquisition')]
-    result = []
-    client_type = CLIENT_OPDS
-
-    if environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
-        log.error('SERVER_PROTOCOL check for HTTP_USER_AGENT = %r' % environ['HTTP_USER_AGENT'])
-        log.error('SERVER_PROTOCOL is too old, koreader needs at least "HTTP/1.1"')
-        if environ['HTTP_USER_AGENT'].startswith(KOREADER_USER_AGENT_PREFIX):
-            raise NotImplementedError('SERVER_PROTOCOL is too old')
-        # else try our luck.... so far seen with Lynx
-
-    path_info = environ['PATH_INFO']
-    print(repr(path_info))
-
-    if path_info == '/search-metadata.xml':
-        return opds_search_meta(environ, start_response)
-    if path_info.startswith('/opds/search'):
-        return opds_search(environ, start_response)
-    if path_info.startswith('/search'):
-        return browser_search(environ, start_response)
+        /thumb/some/path/book.epub
 
-    # below handle any client type
-    if path_info.startswith('/recent'):
-        return search_recent(environ, start_response)
-    if path_info.startswith('/file'):
-        return opds_browse(environ, start_response)
-    if path_info.startswith('/epub'):
-        return opds_browse(environ, start_response)
-    if path_info.startswith('/fb2'):
-        return opds_browse(environ, start_response)
-    if path_info.startswith('/fb2.zip'):
-        return opds_browse(environ, start_response)
-    if path_info.startswith('/mobi'):
-        return opds_browse(environ, start_response)
-    if path_info.startswith('/txt'):
-        return opds_browse(environ, start_response)
-    if path_info != '/':
-        log.info('Returning ERROR 404 %r', path_info)
+    Cover thumbnail of a book, 404 if the book has no (usable) cover
+    """
+    log.info('thumbnail')
+    generator = get_thumbnail_generator()
+    book_path = environ['PATH_INFO'][len('/thumb/'):]
+    if generator is None or not book_path or get_cover_extractor(book_path) is None:
+        return not_found(environ, start_response)
+    ebook_dir = config['ebook_dir']
+    os_path = os.path.join(ebook_dir, os.path.normpath(book_path))
+    if not os.path.abspath(os_path).startswith(os.path.join(ebook_dir, '')):
+        return not_found(environ, start_response)  # outside of ebook_dir, e.g. ../
+    try:
+        stat_result = os.stat(os_path)
+    except OSError:
+        return not_found(environ, start_response)
+    # validators from the book, cached thumbnail mtime changes on each (LRU) use. Checked before generation, revalidation never generates
+    etag = make_etag(os.path.abspath(os_path), stat_result.st_size, stat_result.st_mtime, generator.version())
+    last_modified = stat_result.st_mtime
+    headers = [('Cache-Control', 'public, max-age=%d' % THUMBNAIL_MAX_AGE)]
+    result = not_modified_response(environ, start_response, list(headers), etag, last_modified)  # copy, serve_file() adds the validators itself
+    if result is not None:
+        return result
+    try:
+        thumbnail_filename = generator.thumbnail(os_path)
+        with open(thumbnail_filename, 'rb') as f:
+            image_header = f.read(16)
+    except (IOError, OSError, ConversionError) as info:
+        log.error('thumbnail failed %r', info)
+        return not_found(environ, start_response)
+    if not image_header:
+        return not_found(environ, start_response)  # no cover
+    try:
+        return serve_file(environ, start_response, thumbnail_filename, image_content_type(image_header), headers, etag=etag, last_modified=last_modified)
+    except (IOError, OSError):
         return not_found(environ, start_response)
 
-    client_type = determine_client(environ)
 
-    if client_type == CLIENT_OPDS:
-        # FIXME <updated> tag is static and could cause caching in smart clients
-        result.append(to_bytes(
+KOREADER_USER_AGENT_PREFIX = 'KOReader'
+
+def render_opds_root():
+    """Returns root OPDS navigation feed (bytes), constant for config, see static_documents
+    """
+    # FIXME <updated> tag is static and could cause caching in smart clients
+    return to_bytes(
 '''<?xml version="1.0" encoding="UTF-8"?>
-  <feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" xmlns:opds="http://opds-spec.org/2010/catalog">
+  <feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" xmlns:opds="http://opds-spec.org/2010/catalog" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">
       <title>webook server</title>
       <id>/</id>
       <link rel="start" href="/" type="application/atom+xml;profile=opds-catalog;kind=navigation"></link>
@@ -1055,10 +1317,12 @@ def opds_root(environ, start_response):
 
   </feed>
 '''.format(WEBOOK_SELF_URL_PATH=config['self_url_path'])
-            ))
-    elif client_type == CLIENT_BROWSER:
-        headers = [('Content-Type', 'text/html')]
-        result.append(to_bytes('''
+    )
+
+def render_browser_root():
+    """Returns web browser landing page (bytes), see static_documents
+    """
+    return to_bytes('''
 <html><head>
     <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
@@ -1089,13 +1353,129 @@ def opds_root(environ, start_response):
 
 </body></html>
 
-'''))# TODO loop through ebook_only_mimetypes and list links
+''')  # TODO loop through ebook_only_mimetypes and list links
 
-    headers.append(('Content-Length', str(len(result[0]))))  # in case WSGI server does not implement this
-    headers.append(('Last-Modified', current_timestamp_for_header()))  # many clients will cache
+def render_browser_search():
+    return to_bytes(get_template('browser_search.html'))  # TODO replace with template (with replacement markers/variables)
 
-    start_response(status, headers)
-    return result
+STATIC_DOCUMENTS = {
+    # name: (content type, render function)
+    'search-metadata': ('application/xml', render_search_meta),
+    'opds-root': ('application/atom+xml;profile=opds-catalog;kind=acquisition', render_opds_root),
+    'browser-root': ('text/html', render_browser_root),
+    'browser-search': ('text/html', render_browser_search),
+}
+static_documents = {}  # name -> PrecompressedDocument
+
+def precompute_static_documents():
+    """Render the STATIC_DOCUMENTS (and compress them) once, they are constant for config.
+    Served from memory by get_static_document() rather than rebuilt (and re-read from disk) per request
+    """
+    for name, (content_type, render_function) in STATIC_DOCUMENTS.items():
+        static_documents[name] = PrecompressedDocument(render_function(), content_type, last_modified=STARTUP_TIME)
+
+def get_static_document(name):
+    """Returns PrecompressedDocument, rendered on first use if precompute_static_documents() has not been called
+    """
+    document = static_documents.get(name)
+    if document is None:
+        with singleton_lock:
+            document = static_documents.get(name)
+            if document is None:
+                content_type, render_function = STATIC_DOCUMENTS[name]
+                document = static_documents[name] = PrecompressedDocument(render_function(), content_type, last_modified=STARTUP_TIME)
+    return document
+
+
+def opds_root(environ, start_response):
+    """Handles/serves
+
+        /
+        i.e. the root, and also handles routing
+    """
+    log.info('opds_root')
+    if not config.get('self_url_path'):
+        raise KeyError('self_url_path (or OS variable WEBOOK_SELF_URL_PATH) missing')
+
+    if environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+        log.error('SERVER_PROTOCOL check for HTTP_USER_AGENT = %r' % environ['HTTP_USER_AGENT'])
+        log.error('SERVER_PROTOCOL is too old, koreader needs at least "HTTP/1.1"')
+        if environ['HTTP_USER_AGENT'].startswith(KOREADER_USER_AGENT_PREFIX):
+            raise NotImplementedError('SERVER_PROTOCOL is too old')
+        # else try our luck.... so far seen with Lynx
+
+    path_info = environ['PATH_INFO']
+    print(repr(path_info))
+
+    if path_info == '/search-metadata.xml':
+        return opds_search_meta(environ, start_response)
+    if path_info.startswith('/opds/search'):
+        return opds_search(environ, start_response)
+    if path_info.startswith('/search'):
+        return coalesce_chunks(browser_search(environ, start_response))
+
+    # below handle any client type
+    if path_info.startswith('/recent'):
+        return coalesce_chunks(search_recent(environ, start_response))
+    if path_info.startswith('/thumb/'):
+        return thumbnail(environ, start_response)
+    if path_info.startswith('/file'):
+        return opds_browse(environ, start_response)
+    if path_info.startswith('/epub'):
+        return opds_browse(environ, start_response)
+    if path_info.startswith('/fb2'):
+        return opds_browse(environ, start_response)
+    if path_info.startswith('/fb2.zip'):
+        return opds_browse(environ, start_response)
+    if path_info.startswith('/mobi'):
+        return opds_browse(environ, start_response)
+    if path_info.startswith('/txt'):
+        return opds_browse(environ, start_response)
+    if path_info != '/':
+        log.info('Returning ERROR 404 %r', path_info)
+        return not_found(environ, start_response)
+
+    client_type = determine_client(environ)
+
+    if client_type == CLIENT_OPDS:
+        return get_static_document('opds-root').serve(environ, start_response)
+    else:
+        return get_static_document('browser-root').serve(environ, start_response)
+
+
+library_watcher = None  # from start_background()
+
+def log_stats():
+    """Log stats() of the caches, indexes and background workers created so far, e.g. on shutdown
+    """
+    for name, component in (
+            ('conversion cache', conversion_cache),
+            ('conversion scheduler', conversion_scheduler),
+            ('conversion coordinator', conversion_coordinator),
+            ('feed cache', feed_cache),
+            ('metadata store', metadata_store),
+            ('search index', search_index),
+            ('thumbnails', thumbnail_generator),
+            ('watcher', library_watcher),
+        ):
+        if component is not None:
+            log.info('stats %s: %r', name, component.stats())
+
+def start_background(primary=True):
+    """Load remaining library state and start background threads; metadata extraction, search index autosave and the ebook_dir watcher.
+    primary - False for all but one prefork worker process, those never extract metadata or write the search index (the primary worker does),
+        they reload metadata extracted by the primary
+    """
+    global metadata_extract, library_watcher
+    metadata_extract = primary  # before get_metadata_store() creates the store
+    get_thumbnail_generator()  # scan existing thumbnails before first request
+    store = get_metadata_store()
+    if store is not None and primary:
+        index = get_library_index()
+        store.bulk_extract((index.full_path(entry.path), entry.size, entry.mtime) for entry in index.snapshot() if not entry.is_dir)  # background, title/author for feeds
+    get_search_index(save=primary)  # load (or build) word index before first search
+    library_watcher = start_watcher(get_library_index(), mode=config['watch_ebook_dir'], poll_interval=config['watch_poll_interval'])  # keep index up to date
+    return library_watcher
 
 
 def main(argv=None):
@@ -1127,7 +1507,7 @@ def main(argv=None):
         config_filename = 'config.json'
     log.info('Using config file %r', config_filename)
 
-    global config
+    global config, cache_remove_stale
     config = load_config(config_filename)
 
     listen_port = config['config']['port']
@@ -1147,26 +1527,54 @@ def main(argv=None):
     log.info('OPDS metadata publish URL: %r', (config['self_url_path']))
     log.info('Starting server: http://%s:%d', local_ip, listen_port)
     log.info('using temporary directory temp_dir: %s', config['temp_dir'])
+    log.info('using conversion cache: %s (max %d bytes)', config['conversion_cache_dir'], config['conversion_cache_max_bytes'])
+    log.info('feed cache: max %d bytes', config['feed_cache_max_bytes'])
+    log.info('metadata extraction: %r, store: %s', config['extract_metadata'], config['metadata_db'])
+    log.info('search index: %s, fuzzy search threshold: %r limit: %d', config['search_index'] or 'memory only', config['fuzzy_search_threshold'], config['fuzzy_search_limit'])
+    log.info('thumbnails: %r, cache: %s (max %d bytes), size: %r', config['thumbnails'], config['thumbnail_cache_dir'], config['thumbnail_cache_max_bytes'], config['thumbnail_size'])
+    log.info('conversion workers: %d, queue size: %d, timeout: %d secs', config['conversion_workers'], config['conversion_queue_size'], config['conversion_timeout'])
     log.info('Serving from ebook_dir: %s', config['ebook_dir'])
 
-    safe_mkdir(config['temp_dir'])  # if not done, silent errors can occur from tools like Calibre
+    server_name = config['config']['server']
+    if server_name == 'auto':
+        for server_name, module in (('werkzeug', werkzeug), ('bjoern', bjoern), ('cheroot', cheroot), ('cherrypy', cherrypy), ('wsgiref', wsgiref)):
+            if module:
+                break
+    if server_name == 'prefork' and webook_servers.fork is None:
+        log.warning('prefork server not available on this platform (no os.fork), using threaded')
+        server_name = 'threaded'
+    available_servers = {'werkzeug': werkzeug, 'bjoern': bjoern, 'cheroot': cheroot, 'cherrypy': cherrypy, 'wsgiref': wsgiref, 'asyncio': webook_asyncio_server, 'threaded': webook_servers, 'prefork': webook_servers}
+    if not available_servers.get(server_name):
+        raise KeyError('server %r not available (not installed, or unknown). Options: %s' % (server_name, ', '.join(sorted(name for name, module in available_servers.items() if module))))
+    threads = config['config']['threads']
+    application = opds_root
+    if config['compress_responses']:
+        application = CompressionMiddleware(opds_root, level=config['compression_level'])  # gzip/deflate feeds and pages
 
-    if werkzeug:
+    safe_mkdir(config['temp_dir'])  # if not done, silent errors can occur from tools like Calibre
+    get_conversion_coordinator()  # scan existing cache entries before first request
+    get_library_index()  # scan ebook_dir once, before first request rather than per search
+    precompute_static_documents()
+    if server_name != 'prefork':
+        start_background()  # prefork workers start their own, threads are not inherited by forked processes
+        atexit.register(log_stats)  # e.g. Ctrl-C. prefork workers log their own, see serve_prefork(worker_stopped)
+
+    if server_name == 'werkzeug':
         log.info('Using: werkzeug %s', werkzeug.__version__)
-        #werkzeug.serving.run_simple(listen_address, listen_port, opds_root, use_debugger=True, use_reloader=True)
-        werkzeug.serving.run_simple(listen_address, listen_port, opds_root, use_debugger=False, use_reloader=False)
-    elif bjoern:
+        #werkzeug.serving.run_simple(listen_address, listen_port, application, use_debugger=True, use_reloader=True)
+        werkzeug.serving.run_simple(listen_address, listen_port, application, use_debugger=False, use_reloader=False, threaded=threads > 1)
+    elif server_name == 'bjoern':
         log.info('Using: bjoern %r', bjoern._bjoern.version)
-        bjoern.run(opds_root, listen_address, listen_port)
-    elif cheroot:
+        bjoern.run(application, listen_address, listen_port)
+    elif server_name == 'cheroot':
         log.info('Using: cheroot %s', cheroot.__version__)
-        server = cheroot.wsgi.Server((listen_address, listen_port), opds_root)
+        server = cheroot.wsgi.Server((listen_address, listen_port), application, numthreads=threads)
         server.start()
-    elif cherrypy:
+    elif server_name == 'cherrypy':
         log.info('Using: cherrypy %s', cherrypy.__version__)
         # tested with cherrypy-18.8.0 and cheroot-9.0.0
         # Mount the application
-        cherrypy.tree.graft(opds_root, "/")
+        cherrypy.tree.graft(application, "/")
 
         # Unsubscribe the default server
         cherrypy.server.unsubscribe()
@@ -1177,7 +1585,7 @@ def main(argv=None):
         # Configure the server object
         server.socket_host = listen_address
         server.socket_port = listen_port
-        #server.thread_pool = 30
+        server.thread_pool = threads
 
         # For SSL Support
         # server.ssl_module            = 'pyopenssl'
@@ -1191,9 +1599,30 @@ def main(argv=None):
         # Start the server engine (Option 1 *and* 2)
         cherrypy.engine.start()
         cherrypy.engine.block()
+    elif server_name == 'asyncio':
+        log.info('Using: asyncio (webook_asyncio_server), %d threads', threads)
+        httpd = webook_asyncio_server.make_server(listen_address, listen_port, application, threads=threads)
+        httpd.serve_forever()
+    elif server_name == 'threaded':
+        log.info('Using: threaded wsgiref (webook_servers, sendfile %s), %d threads', webook_servers.sendfile is not None, threads)
+        httpd = webook_servers.make_server(listen_address, listen_port, application, server_class=webook_servers.ThreadedWSGIServer, threads=threads)
+        httpd.serve_forever()
+    elif server_name == 'prefork':
+        workers = config['config']['workers'] or cpu_count()
+        log.info('Using: pre-fork wsgiref (webook_servers, sendfile %s), %d workers, %d threads each', webook_servers.sendfile is not None, workers, threads)
+        httpd = webook_servers.make_server(listen_address, listen_port, application, server_class=webook_servers.ThreadedWSGIServer, threads=threads)
+        # workers share the cache directories, a (re)started worker must not remove the temp files of conversions in progress in other workers
+        remove_stale_temp_files(config['conversion_cache_dir'])  # checked private by get_conversion_coordinator() above
+        if config['thumbnails']:
+            try:
+                remove_stale_temp_files(make_private_dir(config['thumbnail_cache_dir']))
+            except OSError:
+                pass  # not private, workers log it and disable thumbnails
+        cache_remove_stale = False
+        webook_servers.serve_prefork(httpd, workers, worker_started=lambda worker_number: start_background(primary=worker_number == 0), worker_stopped=lambda worker_number: log_stats())
     else:
-        log.info('Using: wsgiref.simple_server %s', wsgiref.simple_server.__version__)
-        httpd = wsgiref.simple_server.make_server(listen_address, listen_port, opds_root)
+        log.info('Using: wsgiref.simple_server %s (webook_servers, sendfile %s)', wsgiref.simple_server.__version__, webook_servers.sendfile is not None)
+        httpd = webook_servers.make_server(listen_address, listen_port, application)
         httpd.serve_forever()
 
 
@@ -0,0 +1,452 @@
+"""Token (word) search of ebook_dir, see webook_index.LibraryIndex
+
+TokenIndex - inverted index of words in relative paths (directory names,
+filename and extension) and, where extracted, book title and author (see
+webook_metadata). Queries are one or more words, all of which must match
+(AND), each word also matches as a prefix ("sherl" matches "Sherlock").
+Results are ranked by where words matched (title and author over directory
+names, whole words over prefixes).
+
+Fuzzy search, for misspellings, is by trigram (three letter sequence)
+similarity of names (filename, directory name, or title); the proportion
+of the query's trigrams found in the name, so "cervnates" finds
+"Cervantes". Only used when there are no word matches.
+
+Words and trigrams are Unicode normalized with accents removed and case
+folded, so "cervantes" matches "Cervantes" and "Cerv\u00e1ntes".
+
+Vocabulary is kept sorted so prefix lookups are a bisect rather than a scan.
+Kept up to date from LibraryIndex (and MetadataStore) change notifications
+and persisted to disk, on startup only files that changed since the index
+was saved are (re-)tokenized.
+"""
+
+import array
+import bisect
+import collections
+import heapq
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+import marshal
+
+from webook_core import check_private_path
+
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+SEARCH_INDEX_VERSION = 3  # persisted format, older files are ignored (rebuilt). marshal of plain containers, unlike pickle loading can not run code
+AUTOSAVE_INTERVAL = 60  # seconds, between saves of a changed index
+
+# field weights, per token the highest applies
+TITLE_WEIGHT = 4  # metadata title, or filename without extension
+AUTHOR_WEIGHT = 3
+DIRECTORY_WEIGHT = 2  # directory names in the path, often author or series
+EXTENSION_WEIGHT = 1
+EXACT_MATCH_MULTIPLIER = 2  # whole word matches rank above prefix matches
+
+DEFAULT_FUZZY_THRESHOLD = 0.5  # minimum proportion of query trigrams in a name
+DEFAULT_FUZZY_LIMIT = 50  # maximum number of fuzzy results
+
+TOKEN_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+try:
+    _casefold = type(u'').casefold  # py3.3+
+except AttributeError:
+    _casefold = type(u'').lower
+_isascii = getattr(type(u''), 'isascii', None)  # py3.7+
+
+if hasattr(array.array, 'tobytes'):
+    array_tobytes = array.array.tobytes
+    array_frombytes = array.array.frombytes
+else:
+    # py2
+    array_tobytes = array.array.tostring
+    array_frombytes = array.array.fromstring
+
+try:
+    intern = sys.intern  # py3
+except AttributeError:
+    intern = lambda text: text  # py2 intern() does not support unicode
+
+
+def fold(text):
+    """Returns text with accents removed (NFKD, combining characters dropped) and case folded, e.g. u'Cerv\u00e1ntes' -> u'cervantes'
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')  # py2 str
+    if _isascii is not None and _isascii(text):
+        return text.lower()  # nothing to decompose, and lower() is casefold() for ascii
+    decomposed = unicodedata.normalize('NFKD', text)
+    return _casefold(u''.join(character for character in decomposed if not unicodedata.combining(character)))
+
+
+def tokenize(text):
+    """Returns list of (folded, see fold()) words in text, punctuation and underscores are separators
+    """
+    return TOKEN_RE.findall(fold(text))
+
+
+def trigrams(text):
+    """Returns set of trigrams of words in text, words are padded so starts (and ends) of words count, e.g. 'ab' -> '  a', ' ab', 'ab '
+    """
+    result = set()
+    for word in tokenize(text):
+        padded = u'  ' + word + u' '
+        for position in range(len(padded) - 2):
+            result.add(padded[position:position + 3])
+    return result
+
+
+def document_trigrams(path, is_dir, title=None):
+    """Returns tuple of trigrams for the name (not the full path) of relative path, and optional metadata title
+    """
+    filename = os.path.basename(path)
+    if not is_dir:
+        filename = os.path.splitext(filename)[0]
+    result = trigrams(filename)
+    if title:
+        result.update(trigrams(title))
+    return tuple(intern(trigram) for trigram in result)
+
+
+def document_tokens(path, is_dir, title=None, author=None):
+    """Returns dict of token -> weight for relative path (and optional metadata)
+    """
+    result = {}
+
+    def add(text, weight):
+        for token in tokenize(text):
+            if result.get(token, 0) < weight:
+                result[token] = weight
+
+    directory, filename = os.path.split(path)
+    add(directory, DIRECTORY_WEIGHT)
+    if is_dir:
+        add(filename, TITLE_WEIGHT)
+    else:
+        stem, extension = os.path.splitext(filename)
+        add(extension, EXTENSION_WEIGHT)
+        add(stem, TITLE_WEIGHT)
+    if title:
+        add(title, TITLE_WEIGHT)
+    if author:
+        add(author, AUTHOR_WEIGHT)
+    return result
+
+
+class TokenIndex(object):
+    def __init__(self, filename=None, metadata_function=None, fuzzy=True):
+        """filename - optional file to persist index in, see load() and save()
+        metadata_function - optional function(IndexEntry) returning (title, author), either may be None
+        fuzzy - maintain trigram index for fuzzy_search()
+        """
+        self.filename = filename
+        self.metadata_function = metadata_function
+        self.lock = threading.Lock()
+        self.documents = {}  # relative path -> (size, mtime, is_dir, title, author, (token, ...), (trigram, ...), document id), tokens and trigrams are interned (shared by all documents)
+        self.postings = {}  # token -> {relative path: weight}
+        self.vocabulary = []  # sorted tokens, for prefix lookup
+        self.fuzzy = fuzzy
+        self.trigrams = {}  # trigram -> array of document ids, compact (4 bytes per entry) as there are many trigrams per name
+        self.document_paths = []  # document id -> relative path, None for free ids
+        self.free_ids = []  # ids of removed documents, for reuse
+        self.dirty = False  # changed since last save
+        self.thread = None
+        self.searches = 0
+        self.fuzzy_searches = 0
+
+    def __len__(self):
+        return len(self.documents)
+
+    def load(self):
+        """Load persisted index, if any. A missing, unreadable, old format, or not private (see webook_core.check_private_path()) file leaves the index empty
+        """
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        start_time = time.time()
+        try:
+            check_private_path(self.filename)
+            with open(self.filename, 'rb') as f:
+                data = marshal.load(f)
+            if not isinstance(data, dict) or data.get('version') != SEARCH_INDEX_VERSION or data.get('fuzzy') != self.fuzzy:
+                log.info('search index %r is an old format, ignoring', self.filename)
+                return
+            documents, postings, trigram_data, document_paths, free_ids = data['documents'], data['postings'], data['trigrams'], data['document_paths'], data['free_ids']
+            if not (isinstance(documents, dict) and isinstance(postings, dict) and isinstance(trigram_data, dict) and isinstance(document_paths, list) and isinstance(free_ids, list)):
+                raise ValueError('unexpected content')
+            trigram_postings = {}
+            for trigram, ids in trigram_data.items():
+                posting = trigram_postings[trigram] = array.array('i')
+                array_frombytes(posting, ids)
+        except Exception as info:
+            # IOError, EOFError, ValueError (bad marshal data), OSError (not private), ... e.g. killed while writing, or written by a different Python version
+            log.warning('search index %r could not be loaded: %r', self.filename, info)
+            return
+        with self.lock:
+            self.documents = documents
+            self.postings = postings
+            self.trigrams = trigram_postings
+            self.document_paths = document_paths
+            self.free_ids = free_ids
+            self.vocabulary = sorted(postings)
+            self.dirty = False
+        log.info('search index %r %d documents, %d tokens, loaded in %0.2f secs', self.filename, len(documents), len(postings), time.time() - start_time)
+
+    def save(self):
+        """Write index to filename (if set), atomically. File is only readable/writable by the current user
+        """
+        if not self.filename:
+            return
+        start_time = time.time()
+        with self.lock:
+            trigram_data = dict((trigram, array_tobytes(posting)) for trigram, posting in self.trigrams.items())
+            data = marshal.dumps({'version': SEARCH_INDEX_VERSION, 'fuzzy': self.fuzzy, 'documents': self.documents, 'postings': self.postings, 'trigrams': trigram_data, 'document_paths': self.document_paths, 'free_ids': self.free_ids})
+            self.dirty = False
+        temp_filename = self.filename + '.tmp'
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)  # left over from a crash, recreated with private mode
+        f = os.fdopen(os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o600), 'wb')
+        with f:
+            f.write(data)
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.remove(self.filename)  # Windows rename will not replace
+        os.rename(temp_filename, self.filename)
+        log.info('search index saved %r %d bytes in %0.2f secs', self.filename, len(data), time.time() - start_time)
+
+    def save_if_dirty(self):
+        if self.dirty:
+            self.save()
+
+    def start_autosave(self, interval=AUTOSAVE_INTERVAL):
+        """Save changes every interval seconds in a background thread
+        """
+        if self.thread is None and self.filename:
+            self.thread = threading.Thread(target=self.autosave_loop, args=(interval,), name='webook-search-autosave')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def autosave_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save_if_dirty()
+            except (IOError, OSError) as info:
+                log.error('search index save failed: %r', info)
+
+    def sync(self, entries):
+        """Bring index in line with entries (list of IndexEntry, e.g. LibraryIndex.snapshot()), only new and changed
+        documents are tokenized. Documents not in entries are removed
+        """
+        start_time = time.time()
+        paths = set()
+        added = 0
+        with self.lock:
+            for entry in entries:
+                paths.add(entry.path)
+                if self._add(entry):
+                    added += 1
+            stale = [path for path in self.documents if path not in paths]
+            for path in stale:
+                self._remove(path)
+        log.info('search index sync %d added/updated, %d removed in %0.2f secs', added, len(stale), time.time() - start_time)
+
+    def update(self, entry):
+        """Add or refresh (e.g. new metadata) a single IndexEntry
+        """
+        with self.lock:
+            self._add(entry)
+
+    def index_changed(self, added, removed):
+        """LibraryIndex listener, see LibraryIndex.add_listener()
+        """
+        with self.lock:
+            for entry in removed:
+                self._remove(entry.path)
+            for entry in added:
+                self._add(entry)
+
+    def _add(self, entry):
+        """Add or replace IndexEntry, returns False if already indexed and unchanged. Caller holds lock
+        """
+        title, author = None, None
+        if self.metadata_function is not None and not entry.is_dir:
+            title, author = self.metadata_function(entry)
+        document = self.documents.get(entry.path)
+        if document is not None:
+            if document[:5] == (entry.size, entry.mtime, entry.is_dir, title, author):
+                return False
+            self._remove(entry.path)
+        tokens = document_tokens(entry.path, entry.is_dir, title, author)
+        name_trigrams = ()
+        document_id = None
+        if self.fuzzy:
+            name_trigrams = document_trigrams(entry.path, entry.is_dir, title)
+            if self.free_ids:
+                document_id = self.free_ids.pop()
+                self.document_paths[document_id] = entry.path
+            else:
+                document_id = len(self.document_paths)
+                self.document_paths.append(entry.path)
+        self.documents[entry.path] = (entry.size, entry.mtime, entry.is_dir, title, author, tuple(intern(token) for token in tokens), name_trigrams, document_id)
+        postings = self.postings
+        for token, weight in tokens.items():
+            posting = postings.get(token)
+            if posting is None:
+                posting = postings[token] = {}
+                bisect.insort(self.vocabulary, token)
+            posting[entry.path] = weight
+        trigram_postings = self.trigrams
+        for trigram in name_trigrams:
+            posting = trigram_postings.get(trigram)
+            if posting is None:
+                posting = trigram_postings[trigram] = array.array('i')
+            posting.append(document_id)
+        self.dirty = True
+        return True
+
+    def _remove(self, path):
+        """Caller holds lock
+        """
+        document = self.documents.pop(path, None)
+        if document is None:
+            return
+        postings = self.postings
+        for token in document[5]:
+            posting = postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(path, None)
+            if not posting:
+                del postings[token]
+                position = bisect.bisect_left(self.vocabulary, token)
+                if position < len(self.vocabulary) and self.vocabulary[position] == token:
+                    del self.vocabulary[position]
+        document_id = document[7]
+        if document_id is not None:
+            trigram_postings = self.trigrams
+            for trigram in document[6]:
+                posting = trigram_postings.get(trigram)
+                if posting is None:
+                    continue
+                try:
+                    posting.remove(document_id)  # linear, but a scan of 4 byte ints in C
+                except ValueError:
+                    pass
+                if not posting:
+                    del trigram_postings[trigram]
+            self.document_paths[document_id] = None
+            self.free_ids.append(document_id)
+        self.dirty = True
+
+    def term_tokens(self, term):
+        """Returns list of tokens that term is a prefix of (including term itself). Caller holds lock
+        """
+        vocabulary = self.vocabulary
+        position = bisect.bisect_left(vocabulary, term)
+        end = position
+        while end < len(vocabulary) and vocabulary[end].startswith(term):
+            end += 1
+        return vocabulary[position:end]
+
+    def term_scores(self, term, tokens, candidates=None):
+        """Returns dict of relative path -> score for documents containing any of tokens (see term_tokens()).
+        If candidates (dict of path -> score so far) is given, only those documents are scored and score is added to theirs.
+        Caller holds lock
+        """
+        postings = self.postings
+        if candidates is not None and len(candidates) * len(tokens) < sum(len(postings[token]) for token in tokens):
+            # few candidates left, look them up rather than walk (long) posting lists
+            scores = {}
+            for path, score_so_far in candidates.items():
+                best = 0
+                for token in tokens:
+                    weight = postings[token].get(path)
+                    if weight is not None:
+                        weight *= EXACT_MATCH_MULTIPLIER if token == term else 1
+                        if weight > best:
+                            best = weight
+                if best:
+                    scores[path] = score_so_far + best
+            return scores
+        scores = {}
+        for token in tokens:
+            multiplier = EXACT_MATCH_MULTIPLIER if token == term else 1
+            for path, weight in postings[token].items():
+                score = weight * multiplier
+                if scores.get(path, 0) < score:
+                    scores[path] = score
+        if candidates is not None:
+            scores = dict((path, score + scores[path]) for path, score in candidates.items() if path in scores)
+        return scores
+
+    def search(self, query, limit=None):
+        """Returns list of relative paths matching all words in query, best match first (ties in path order)
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self.lock:
+            self.searches += 1
+            postings = self.postings
+            term_tokens = []
+            for term in terms:
+                tokens = self.term_tokens(term)
+                if not tokens:
+                    return []  # AND, one term with no hits means no results
+                term_tokens.append((sum(len(postings[token]) for token in tokens), term, tokens))
+            term_tokens.sort()  # start from the rarest term, the candidate set only shrinks
+            results = None
+            for size, term, tokens in term_tokens:
+                results = self.term_scores(term, tokens, results)
+                if not results:
+                    return []
+        ranked = sorted(results.items(), key=lambda item: (-item[1], item[0].lower(), item[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [path for path, score in ranked]
+
+    def fuzzy_search(self, query, threshold=DEFAULT_FUZZY_THRESHOLD, limit=DEFAULT_FUZZY_LIMIT):
+        """Returns list of relative paths with names similar to query, most similar first, at most limit.
+        Similarity is the proportion of query trigrams in the name (0.0-1.0), at least threshold.
+        Ties are ordered by the proportion of the name's trigrams in the query (closer length), then path
+        """
+        query_trigrams = trigrams(query)
+        if not query_trigrams or limit <= 0:
+            return []
+        with self.lock:
+            self.fuzzy_searches += 1
+            counts = collections.Counter()
+            trigram_postings = self.trigrams
+            for trigram in query_trigrams:
+                posting = trigram_postings.get(trigram)
+                if posting:
+                    counts.update(posting)
+            minimum = threshold * len(query_trigrams)
+            documents = self.documents
+            document_paths = self.document_paths
+            scored = []
+            for document_id, count in counts.items():
+                if count >= minimum:
+                    path = document_paths[document_id]
+                    scored.append((-float(count) / len(query_trigrams), -float(count) / max(1, len(documents[path][6])), path.lower(), path))
+        return [item[3] for item in heapq.nsmallest(limit, scored)]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'documents': len(self.documents),
+                'tokens': len(self.postings),
+                'trigrams': len(self.trigrams),
+                'fuzzy_searches': self.fuzzy_searches,
+                'searches': self.searches,
+                'dirty': self.dirty,
+            }
@@ -0,0 +1,318 @@
+"""Python stdlib (wsgiref) based WSGI servers for webook_server
+
+Same as wsgiref.simple_server, with zero-copy file serving; file responses
+(webook_http.FileRangeWrapper, also used as wsgi.file_wrapper) are sent with
+os.sendfile(), from the kernel page cache directly to the socket rather than
+read into (and copied through) Python.
+
+Persistent (keep-alive) connections, for threaded servers; responses with a
+Content-Length (or no body) leave the connection open for the next request,
+for at most KEEPALIVE_TIMEOUT seconds of idle time.
+
+Server modes:
+    make_server() - one request at a time (wsgiref.simple_server.WSGIServer)
+    make_server(server_class=ThreadedWSGIServer) - requests handled by a fixed size pool of threads
+    serve_prefork() - pre-fork, a number of worker processes (each a
+        ThreadedWSGIServer) accept from the same listen socket, so request
+        processing scales across all cores. Unix only (os.fork)
+"""
+
+import logging
+import os
+import select
+import signal
+import threading
+import time
+import wsgiref.simple_server
+
+try:
+    # py3
+    import queue
+    import socketserver
+except ImportError:
+    # py2
+    import Queue as queue
+    import SocketServer as socketserver
+
+from webook_http import FileRangeWrapper
+
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+sendfile = getattr(os, 'sendfile', None)  # Python 3.3+, Unix only
+fork = getattr(os, 'fork', None)  # Unix only
+
+DEFAULT_THREADS = 16
+KEEPALIVE_TIMEOUT = 5  # seconds, idle persistent connections are closed after this (an idle connection holds a thread)
+WORKER_RESTART_DELAY = 1.0  # seconds, before replacing a worker process that died, avoids a tight fork loop if workers fail on start up
+
+
+class WebookServerHandler(wsgiref.simple_server.ServerHandler):
+    wsgi_file_wrapper = FileRangeWrapper  # environ['wsgi.file_wrapper']
+    keep_alive = False  # set by WebookRequestHandler, if the client asked for a persistent connection
+    head_request = False  # body is not sent
+    chunked = False  # Transfer-Encoding chunked, HTTP/1.1 responses of unknown length on persistent connections
+
+    def cleanup_headers(self):
+        """Connection header; persistent connections need the end of the response to be known (Content-Length)
+        """
+        wsgiref.simple_server.ServerHandler.cleanup_headers(self)  # Content-Length for single block responses
+        if 'Content-Length' not in self.headers and not self.status[:3] in ('204', '304'):
+            if self.keep_alive and self.http_version == '1.1' and not self.head_request:
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = True
+            else:
+                self.keep_alive = False  # end of body is end of connection
+        if self.http_version == '1.1':
+            if not self.keep_alive:
+                self.headers['Connection'] = 'close'
+        elif self.keep_alive:
+            self.headers['Connection'] = 'keep-alive'  # HTTP/1.0 keep-alive
+
+    def handle_error(self):
+        self.keep_alive = False  # response may be incomplete, client can not tell where it ends
+        wsgiref.simple_server.ServerHandler.handle_error(self)
+
+    def finish_response(self):
+        """HEAD requests, the body is only iterated until the headers are sent (e.g. not an entire file)
+        """
+        if not self.head_request:
+            return wsgiref.simple_server.ServerHandler.finish_response(self)
+        try:
+            for data in self.result:
+                self.write(data)  # headers only
+                if self.headers_sent:
+                    break
+            self.finish_content()
+        except:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+            raise
+        else:
+            self.close()
+
+    def write(self, data):
+        if self.head_request:
+            if not self.headers_sent:
+                self.bytes_sent = len(data)  # for Content-Length
+                self.send_headers()
+                self._flush()
+            return
+        if not self.chunked and self.headers_sent:
+            wsgiref.simple_server.ServerHandler.write(self, data)
+            return
+        if not self.headers_sent:
+            self.bytes_sent = len(data)  # for Content-Length
+            self.send_headers()  # decides on chunked
+        else:
+            self.bytes_sent += len(data)
+        if not self.chunked:
+            self._write(data)
+        elif data:
+            self._write(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+        self._flush()
+
+    def finish_content(self):
+        wsgiref.simple_server.ServerHandler.finish_content(self)
+        if self.chunked:
+            self._write(b'0\r\n\r\n')  # last chunk
+            self._flush()
+
+    def sendfile(self):
+        """Send (FileRangeWrapper) result with os.sendfile().
+        Returns False, so result is iterated as usual, if sendfile is not available for this file/socket
+        """
+        if sendfile is None or 'Content-Length' not in self.headers:
+            return False  # e.g. chunked, file size unknown
+        result = self.result
+        try:
+            in_fd = result.filelike.fileno()
+            out_fd = self.stdout.fileno()
+        except (AttributeError, IOError, OSError, ValueError):  # io.UnsupportedOperation is a subclass of both OSError and ValueError
+            return False
+        offset = result.offset
+        if result.length is None:
+            remaining = os.fstat(in_fd).st_size - offset
+        else:
+            remaining = result.length
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()  # headers (buffered writes) must be on the wire before the file
+        while remaining > 0:
+            sent = sendfile(out_fd, in_fd, offset, remaining)
+            if sent == 0:
+                break  # file truncated since Content-Length was calculated, client will see short response
+            offset += sent
+            remaining -= sent
+            self.bytes_sent += sent
+        return True
+
+
+class WebookRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'  # persistent connections, if the server has a keepalive_timeout
+
+    def handle(self):
+        """Handle HTTP requests on the connection, more than one if both client and server allow persistent connections
+        """
+        keepalive_timeout = getattr(self.server, 'keepalive_timeout', None)
+        self.handle_one_request()
+        while keepalive_timeout and not self.close_connection:
+            # NOTE pipelined requests already read into rfile (rather than waiting in the socket) are not seen here, clients rarely pipeline
+            readable, _, _ = select.select([self.connection], [], [], keepalive_timeout)
+            if not readable:
+                break  # idle
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        """Handle a single HTTP request, same as WSGIRequestHandler.handle() with WebookServerHandler"""
+
+        self.close_connection = True
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            return  # client closed connection
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request(): # An error code has been sent, just exit
+            return
+        if not getattr(self.server, 'keepalive_timeout', None):
+            self.close_connection = True
+
+        handler = WebookServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=getattr(self.server, 'multithread', False),
+            multiprocess=getattr(self.server, 'multiprocess', False),
+        )
+        handler.request_handler = self      # backpointer for logging
+        handler.http_version = '1.1' if self.request_version == 'HTTP/1.1' else '1.0'
+        handler.keep_alive = not self.close_connection
+        handler.head_request = self.command == 'HEAD'
+        handler.run(self.server.get_app())
+        if not handler.keep_alive:
+            self.close_connection = True
+        self.wfile.flush()
+
+
+class ThreadPoolMixIn(socketserver.ThreadingMixIn):
+    """ThreadingMixIn with a fixed number of threads, rather than a new thread per request.
+    Accepted connections wait in a short queue for a free thread, once that is full
+    further connections wait (unaccepted) in the listen backlog.
+    Threads are started on first use, so the server can be created before os.fork()
+    """
+    threads = DEFAULT_THREADS
+    keepalive_timeout = KEEPALIVE_TIMEOUT
+    daemon_threads = True
+    request_queue = None
+    multithread = True
+
+    def start_threads(self):
+        if self.request_queue is None:
+            self.request_queue = queue.Queue(maxsize=self.threads)
+            for _ in range(self.threads):
+                thread = threading.Thread(target=self.process_request_queue)
+                thread.daemon = self.daemon_threads
+                thread.start()
+
+    def process_request_queue(self):
+        while True:
+            request, client_address = self.request_queue.get()
+            self.process_request_thread(request, client_address)  # ThreadingMixIn, handles errors and closes request
+
+    def process_request(self, request, client_address):
+        self.start_threads()
+        self.request_queue.put((request, client_address))
+
+
+class ThreadedWSGIServer(ThreadPoolMixIn, wsgiref.simple_server.WSGIServer):
+    pass
+
+
+def make_server(host, port, app, server_class=wsgiref.simple_server.WSGIServer, handler_class=WebookRequestHandler, threads=None):
+    """Create a new WSGI server listening on `host` and `port` for `app`, see wsgiref.simple_server.make_server()
+    threads - size of thread pool, for ThreadPoolMixIn server_class (e.g. ThreadedWSGIServer)
+    """
+    server = wsgiref.simple_server.make_server(host, port, app, server_class=server_class, handler_class=handler_class)
+    if threads is not None:
+        server.threads = threads
+    return server
+
+
+def serve_prefork(server, workers, worker_started=None, worker_stopped=None):
+    """Fork `workers` processes that each run server.serve_forever() on the (already listening) socket of server,
+    the kernel hands each new connection to one of them. Does not return until all workers have exited
+    (SIGTERM or SIGINT to this, parent, process stops all workers). Workers that die are replaced.
+
+    server - e.g. from make_server(), with server_class ThreadedWSGIServer for threads within each worker
+    worker_started - optional function(worker_number) called in each new worker process (worker_number 0 to workers - 1) before serving,
+        e.g. to start background threads, threads in this process are not copied into the workers
+    worker_stopped - optional function(worker_number) called in a worker process once it stops serving (SIGTERM or SIGINT), e.g. to log stats
+    """
+    if fork is None:
+        raise RuntimeError('pre-fork server requires os.fork() (Unix)')
+    server.multiprocess = True
+    children = {}  # pid -> worker number
+    stopping = []  # non-empty once asked to stop, list as it is set in the signal handler
+
+    def start_worker(worker_number):
+        pid = fork()
+        if pid:
+            children[pid] = worker_number
+            return
+        # worker process, must never return into caller
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)  # stop as for SIGINT, so worker_stopped is called
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            if worker_started is not None:
+                worker_started(worker_number)
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            log.exception('worker %d failed', worker_number)
+            exit_code = 1
+        finally:
+            try:
+                if worker_stopped is not None:
+                    worker_stopped(worker_number)
+            except BaseException:
+                log.exception('worker %d worker_stopped failed', worker_number)
+            os._exit(exit_code)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass  # already exited
+
+    previous_handlers = dict((signum, signal.signal(signum, stop)) for signum in (signal.SIGTERM, signal.SIGINT))
+    try:
+        for worker_number in range(workers):
+            start_worker(worker_number)
+        log.info('started %d worker processes, pids %r', workers, sorted(children))
+        while children:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                continue  # EINTR (py2), signal handler already run
+            worker_number = children.pop(pid, None)
+            if worker_number is None or stopping:
+                continue
+            log.error('worker %d (pid %d) exited with status %r, restarting', worker_number, pid, status)
+            time.sleep(WORKER_RESTART_DELAY)
+            if not stopping:
+                start_worker(worker_number)
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        server.server_close()
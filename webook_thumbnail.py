@@ -0,0 +1,295 @@
+"""Cover thumbnails for OPDS feeds
+
+Cover extraction, stdlib only:
+    EPUB - OPF manifest cover-image (EPUB3) or <meta name="cover"> (EPUB2)
+    CBZ - first image in the archive (by name)
+    FB2 (and .fb2.zip) - description/title-info/coverpage, base64 <binary>
+
+Covers are downsized to a fixed thumbnail size (JPEG) if PIL (Pillow) is
+available, otherwise the original cover image is used as-is.
+
+ThumbnailGenerator - thumbnails are kept on disk in a size-bounded cache
+(a webook_cache.ConversionCache, with thumbnail generation as the
+"conversion"). Books without a (usable) cover are cached as empty files so
+they are not retried until the book changes. Feeds only queue thumbnails
+(prefetch) for a background pool, they never wait for generation.
+"""
+
+import base64
+import logging
+import os
+import posixpath
+import threading
+import zipfile
+
+from io import BytesIO
+
+try:
+    # py3
+    from urllib.parse import unquote
+except ImportError:
+    # py2
+    from urllib import unquote
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from webook_cache import ConversionCache, ConversionCoordinator, ConversionQueueFull, ConversionScheduler
+from webook_metadata import CONTAINER_NAMESPACE, FB2_NAMESPACE, OPF_NAMESPACE
+
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+DEFAULT_THUMBNAIL_SIZE = (200, 300)  # width, height - maximum, aspect ratio is preserved
+DEFAULT_THUMBNAIL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_THUMBNAIL_WORKERS = 1
+THUMBNAIL_QUEUE_SIZE = 256  # pending prefetches, more than a few pages of feed entries. Once full further prefetches are dropped
+THUMBNAIL_FORMAT = 'thumb'  # "format" (file extension) in the ConversionCache
+JPEG_QUALITY = 80
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+if Image is None:
+    THUMBNAIL_CONTENT_TYPE = None  # original cover, could be any image type (sniffed when served). Not a valid link type, so omitted
+else:
+    THUMBNAIL_CONTENT_TYPE = 'image/jpeg'
+
+
+def epub_cover(filename):
+    """Returns cover image (bytes) from EPUB, or None
+    """
+    with zipfile.ZipFile(filename) as epub_file:
+        container = ElementTree.fromstring(epub_file.read('META-INF/container.xml'))
+        opf_path = container.find('.//%srootfile' % CONTAINER_NAMESPACE).get('full-path')
+        opf = ElementTree.fromstring(epub_file.read(opf_path))
+        manifest = opf.find('%smanifest' % OPF_NAMESPACE)
+        if manifest is None:
+            return None
+        items = manifest.findall('%sitem' % OPF_NAMESPACE)
+        cover_href = None
+        # EPUB3 <item properties="cover-image" href="cover.jpg" .../>
+        for item in items:
+            if 'cover-image' in item.get('properties', '').split():
+                cover_href = item.get('href')
+                break
+        if cover_href is None:
+            # EPUB2 <meta name="cover" content="item-id"/>
+            cover_id = None
+            metadata = opf.find('%smetadata' % OPF_NAMESPACE)
+            if metadata is not None:
+                for meta in metadata.findall('%smeta' % OPF_NAMESPACE):
+                    if meta.get('name') == 'cover':
+                        cover_id = meta.get('content')
+                        break
+            for item in items:
+                if cover_id and cover_id in (item.get('id'), item.get('href')):
+                    cover_href = item.get('href')
+                    break
+        if cover_href is None:
+            # no declared cover, guess from name
+            for item in items:
+                if item.get('media-type', '').startswith('image/') and 'cover' in (item.get('id', '') + item.get('href', '')).lower():
+                    cover_href = item.get('href')
+                    break
+        if cover_href is None:
+            return None
+        # href is relative to the OPF
+        return epub_file.read(posixpath.normpath(posixpath.join(posixpath.dirname(opf_path), unquote(cover_href))))
+
+
+def cbz_cover(filename):
+    """Returns first image (by name) from comic book zip, or None
+    """
+    with zipfile.ZipFile(filename) as zip_file:
+        names = sorted((name for name in zip_file.namelist() if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('__MACOSX/')), key=lambda name: (name.lower(), name))
+        if not names:
+            return None
+        return zip_file.read(names[0])
+
+
+def fb2_cover_from_file(fileobj):
+    """Returns cover image (bytes) from FB2 coverpage, or None.
+    The <binary> elements are at the end of the document, the book body is discarded as it is parsed
+    """
+    cover_id = None
+    for event, element in ElementTree.iterparse(fileobj, events=('end',)):
+        tag = element.tag
+        if tag == FB2_NAMESPACE + 'coverpage':
+            for image in element.iter(FB2_NAMESPACE + 'image'):
+                for name, value in image.attrib.items():
+                    if name.endswith('href') and value.startswith('#'):  # xlink:href / l:href
+                        cover_id = value[1:]
+                        break
+                if cover_id:
+                    break
+            if cover_id is None:
+                return None
+        elif tag == FB2_NAMESPACE + 'binary':
+            if cover_id is not None and element.get('id') == cover_id:
+                return base64.b64decode(element.text or '')
+            element.clear()
+        elif tag == FB2_NAMESPACE + 'body':
+            if cover_id is None:
+                return None  # no coverpage in description
+            element.clear()
+    return None
+
+
+def fb2_cover(filename):
+    with open(filename, 'rb') as f:
+        return fb2_cover_from_file(f)
+
+
+def fb2_zip_cover(filename):
+    with zipfile.ZipFile(filename) as zip_file:
+        for name in zip_file.namelist():
+            if name.lower().endswith('.fb2'):
+                with zip_file.open(name) as f:
+                    return fb2_cover_from_file(f)
+    return None
+
+
+cover_extractors = {
+    '.epub': epub_cover,
+    '.epub3': epub_cover,
+    '.cbz': cbz_cover,
+    '.fb2': fb2_cover,
+}
+
+def get_cover_extractor(filename):
+    """Returns cover extractor function for filename (based on extension), or None if not supported
+    """
+    lowered_filename = filename.lower()
+    if lowered_filename.endswith('.fb2.zip'):
+        return fb2_zip_cover
+    return cover_extractors.get(os.path.splitext(lowered_filename)[1])
+
+
+def extract_cover(filename):
+    """Returns cover image (bytes) from book content, None if there is no cover (e.g. unsupported format or corrupt file)
+    """
+    extractor = get_cover_extractor(filename)
+    if extractor is None:
+        return None
+    try:
+        return extractor(filename)
+    except Exception as info:
+        # zipfile.BadZipfile, ElementTree.ParseError, KeyError (missing zip member), binascii.Error, IOError, ...
+        log.debug('cover extraction failed for %r: %r', filename, info)
+        return None
+
+
+def resize_image(image_data, size=DEFAULT_THUMBNAIL_SIZE):
+    """Returns image_data (bytes) downsized to fit within size as JPEG.
+    Returns image_data unchanged if PIL is not available
+    """
+    if Image is None:
+        return image_data
+    image = Image.open(BytesIO(image_data))
+    image.thumbnail(size)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')  # JPEG has no alpha or palette
+    out = BytesIO()
+    image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def image_content_type(image_data):
+    """Returns mime type for (start of) image_data, from magic numbers
+    """
+    if image_data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if image_data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if image_data.startswith(b'GIF8'):
+        return 'image/gif'
+    if image_data.startswith(b'RIFF') and image_data[8:12] == b'WEBP':
+        return 'image/webp'
+    if image_data.startswith(b'BM'):
+        return 'image/bmp'
+    return 'application/octet-stream'
+
+
+class ThumbnailGenerator(object):
+    def __init__(self, cache_dir, max_bytes=DEFAULT_THUMBNAIL_CACHE_MAX_BYTES, size=DEFAULT_THUMBNAIL_SIZE, max_workers=DEFAULT_THUMBNAIL_WORKERS, remove_stale=True):
+        """cache_dir - directory to store thumbnails in, created if missing
+        max_bytes - byte budget for cache_dir, least recently used thumbnails are removed once exceeded
+        size - (width, height) thumbnails are downsized to fit within
+        max_workers - background threads for prefetch()
+        remove_stale - see ConversionCache
+        """
+        self.size = tuple(size)
+        self.cache = ConversionCache(cache_dir, max_bytes=max_bytes, convert_function=self.write_thumbnail, version_function=self.version, remove_stale=remove_stale)
+        self.coordinator = ConversionCoordinator(self.cache)  # single-flight, a request and a prefetch for the same book share the work
+        self.scheduler = ConversionScheduler(max_workers=max_workers, max_queue=THUMBNAIL_QUEUE_SIZE, timeout=0)
+        self.lock = threading.Lock()
+        self.pending = set()  # source filenames queued for prefetch
+        self.prefetched = 0
+        self.dropped = 0
+
+    def version(self):
+        """Part of cache key, changing thumbnail size (or installing PIL) invalidates old thumbnails
+        """
+        return 'thumbnail %dx%d %s' % (self.size[0], self.size[1], 'jpeg' if Image else 'original')
+
+    def write_thumbnail(self, source_filename, thumbnail_filename, timeout=None):
+        """ConversionCache convert function, writes thumbnail for source_filename. Empty file if no cover
+        """
+        image_data = extract_cover(source_filename)
+        if image_data:
+            try:
+                image_data = resize_image(image_data, self.size)
+            except Exception as info:
+                # IOError (unrecognized image), MemoryError, DecompressionBombError, ...
+                log.info('cover for %r could not be resized: %r', source_filename, info)
+                image_data = None
+        with open(thumbnail_filename, 'wb') as f:
+            f.write(image_data or b'')
+
+    def thumbnail(self, source_filename):
+        """Returns full path of thumbnail for source_filename (generated in the calling thread if not already cached), file is empty if the book has no cover
+        """
+        return self.coordinator.convert(source_filename, THUMBNAIL_FORMAT)
+
+    def prefetch(self, source_filename):
+        """Queue thumbnail generation for source_filename in the background, does not wait.
+        Dropped if the queue is full, generated on request instead
+        """
+        with self.lock:
+            if source_filename in self.pending:
+                return
+            self.pending.add(source_filename)
+        try:
+            self.scheduler.submit(self._prefetch, source_filename)
+        except ConversionQueueFull:
+            with self.lock:
+                self.pending.discard(source_filename)
+                self.dropped += 1
+
+    def _prefetch(self, source_filename, timeout=None):
+        try:
+            self.thumbnail(source_filename)
+        except Exception as info:
+            log.info('thumbnail prefetch failed for %r: %r', source_filename, info)
+        finally:
+            with self.lock:
+                self.pending.discard(source_filename)
+                self.prefetched += 1
+
+    def stats(self):
+        result = self.cache.stats()
+        with self.lock:
+            result['pending'] = len(self.pending)
+            result['prefetched'] = self.prefetched
+            result['dropped'] = self.dropped
+        return result
@@ -0,0 +1,351 @@
+"""Keep a webook_index.LibraryIndex up to date as files change
+
+InotifyWatcher - Linux only, uses inotify via ctypes (no external dependencies)
+PollingWatcher - everywhere else, periodically stats directories (not files)
+    and only re-lists directories whose mtime changed. Files modified in
+    place do not change their directory mtime, so every indexed file is
+    stat-ed on a slower cadence (every file_check_polls polls)
+
+Both apply changes to the index incrementally rather than rescanning the
+entire tree.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+from webook_core import list_directory, walk_entries
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(level=logging.INFO)
+
+
+WATCH_AUTO = 'auto'
+WATCH_INOTIFY = 'inotify'
+WATCH_POLL = 'poll'
+WATCH_OFF = 'off'
+
+DEFAULT_POLL_INTERVAL = 30  # seconds
+DEFAULT_FILE_CHECK_POLLS = 10  # polls between stat-ing every indexed file, for in place modifications
+
+# from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+INOTIFY_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')  # struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+
+if hasattr(os, 'fsencode'):
+    fsencode, fsdecode = os.fsencode, os.fsdecode
+else:
+    # py2, native str paths are already bytes
+    fsencode = fsdecode = lambda x: x
+
+
+def load_libc():
+    """Returns ctypes libc with inotify functions, or None if not available
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+class Watcher(object):
+    """Base class, runs check_for_changes() style loop in a daemon thread
+    """
+    name = 'watcher'
+
+    def __init__(self, index):
+        self.index = index
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.events_applied = 0
+        self.rescans_avoided = 0
+        self.full_rescans = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='webook-' + self.name)
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('%s watching %r', self.name, self.index.directory_path)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        raise NotImplementedError()
+
+    def rescan(self):
+        self.full_rescans += 1
+        self.index.scan()
+
+    def stats(self):
+        return {
+            'watcher': self.name,
+            'events_applied': self.events_applied,
+            'rescans_avoided': self.rescans_avoided,
+            'full_rescans': self.full_rescans,
+        }
+
+
+class InotifyWatcher(Watcher):
+    name = WATCH_INOTIFY
+
+    def __init__(self, index, libc=None):
+        Watcher.__init__(self, index)
+        self.libc = libc or load_libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.watches = {}  # watch descriptor -> relative directory path ('' for top)
+        self.pending_moves = {}  # cookie -> (relative path, is_dir), IN_MOVED_FROM waiting for a IN_MOVED_TO
+        self.add_watch_tree('')
+
+    def add_watch(self, relative_directory):
+        full_path = self.index.full_path(relative_directory) if relative_directory else self.index.directory_path
+        wd = self.libc.inotify_add_watch(self.fd, fsencode(full_path), INOTIFY_MASK)
+        if wd < 0:
+            log.warning('inotify_add_watch %r failed errno %d (see /proc/sys/fs/inotify/max_user_watches)', full_path, ctypes.get_errno())
+            return
+        self.watches[wd] = relative_directory
+
+    def add_watch_tree(self, relative_directory):
+        """Watch relative_directory and every directory under it
+        """
+        self.add_watch(relative_directory)
+        top = self.index.full_path(relative_directory) if relative_directory else self.index.directory_path
+        for root, dir_entries, file_entries in walk_entries(top):
+            for dir_entry in dir_entries:
+                if not dir_entry.is_symlink():
+                    self.add_watch(self.index.relative_path(dir_entry.path))
+
+    def forget_watch_tree(self, relative_directory, new_relative_directory=None):
+        """relative_directory was moved (to new_relative_directory) or moved out of the tree (None).
+        Kernel keeps watching the same inodes, update (or remove) our wd -> path mapping
+        """
+        prefix = relative_directory + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == relative_directory or path.startswith(prefix):
+                if new_relative_directory is None:
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                    del self.watches[wd]
+                else:
+                    self.watches[wd] = new_relative_directory + path[len(relative_directory):]
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                readable, _, _ = select.select([self.fd], [], [], 1.0)
+                if not readable:
+                    self.flush_pending_moves()
+                    continue
+                data = os.read(self.fd, 64 * 1024)
+                self.process_events(data)
+        finally:
+            os.close(self.fd)
+
+    def process_events(self, data):
+        offset = 0
+        header_size = INOTIFY_EVENT_HEADER.size
+        changes = 0
+        while offset + header_size <= len(data):
+            wd, mask, cookie, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + header_size:offset + header_size + name_len].rstrip(b'\0')
+            offset += header_size + name_len
+
+            if mask & IN_Q_OVERFLOW:
+                log.warning('inotify queue overflow, full rescan')
+                self.pending_moves.clear()
+                self.rescan()
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue  # IN_DELETE_SELF/IN_MOVE_SELF are handled via the parent directory events
+            name = fsdecode(name)
+            relative_path = os.path.join(directory, name) if directory else name
+            is_dir = bool(mask & IN_ISDIR)
+
+            if mask & IN_MOVED_FROM:
+                self.pending_moves[cookie] = (relative_path, is_dir)
+            elif mask & IN_MOVED_TO:
+                old = self.pending_moves.pop(cookie, None)
+                if old:
+                    old_relative_path, old_is_dir = old
+                    if old_is_dir:
+                        self.forget_watch_tree(old_relative_path, relative_path)
+                    self.index.rename_path(old_relative_path, relative_path)
+                else:
+                    # moved in from outside the tree
+                    self.index.update_path(relative_path)
+                    if is_dir:
+                        self.add_watch_tree(relative_path)
+            elif mask & IN_CREATE:
+                if is_dir:
+                    self.add_watch_tree(relative_path)  # before walk, so nothing created meanwhile is missed
+                self.index.update_path(relative_path)
+            elif mask & IN_DELETE:
+                self.index.remove_path(relative_path)
+            elif mask & (IN_CLOSE_WRITE | IN_ATTRIB):
+                self.index.update_path(relative_path)
+            else:
+                continue
+            changes += 1
+        if changes:
+            self.events_applied += changes
+            self.rescans_avoided += 1
+
+    def flush_pending_moves(self):
+        """IN_MOVED_FROM without a matching IN_MOVED_TO (once events go quiet), moved out of the tree
+        """
+        for cookie, (relative_path, is_dir) in list(self.pending_moves.items()):
+            if is_dir:
+                self.forget_watch_tree(relative_path)
+            self.index.remove_path(relative_path)
+            self.events_applied += 1
+        self.pending_moves.clear()
+
+
+class PollingWatcher(Watcher):
+    name = WATCH_POLL
+
+    def __init__(self, index, interval=DEFAULT_POLL_INTERVAL, file_check_polls=DEFAULT_FILE_CHECK_POLLS):
+        """file_check_polls - stat every indexed file once per this many polls (0 to never), as in place modifications do not change directory mtimes
+        """
+        Watcher.__init__(self, index)
+        self.interval = interval
+        self.file_check_polls = file_check_polls
+        self.polls = 0
+        self.directory_mtimes = self.current_directory_mtimes()
+
+    def current_directory_mtimes(self):
+        """Returns dict of relative directory path -> mtime, for every directory in the index (and the top level as '').
+        Costs one stat per directory, no listing
+        """
+        result = {}
+        directories = [''] + [entry.path for entry in self.index.snapshot() if entry.is_dir]
+        for relative_directory in directories:
+            try:
+                result[relative_directory] = os.stat(self.index.full_path(relative_directory) if relative_directory else self.index.directory_path).st_mtime
+            except OSError:
+                pass  # gone, parent mtime will have changed
+        return result
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.check_for_changes()
+
+    def check_for_changes(self):
+        current = self.current_directory_mtimes()
+        changed = [path for path, mtime in current.items() if self.directory_mtimes.get(path) != mtime]
+        changes = 0
+        for relative_directory in changed:
+            changes += self.diff_directory(relative_directory)
+        self.polls += 1
+        if self.file_check_polls and self.polls % self.file_check_polls == 0:
+            changes += self.check_files()
+        self.directory_mtimes = self.current_directory_mtimes() if changes else current
+        if changes:
+            self.events_applied += changes
+            self.rescans_avoided += 1
+        return changes
+
+    def check_files(self):
+        """Stat every file in the index, refresh those whose size or mtime changed. Returns number of changes.
+        Files that are gone are left to diff_directory(), their directory mtime changed
+        """
+        changes = 0
+        for entry in self.index.snapshot():
+            if entry.is_dir:
+                continue
+            try:
+                stat_result = os.stat(self.index.full_path(entry.path))
+            except OSError:
+                continue
+            if stat_result.st_mtime != entry.mtime or stat_result.st_size != entry.size:
+                self.index.update_path(entry.path)
+                changes += 1
+        return changes
+
+    def diff_directory(self, relative_directory):
+        """Compare listing of a (changed) directory with the index, apply differences. Returns number of changes
+        """
+        full_path = self.index.full_path(relative_directory) if relative_directory else self.index.directory_path
+        try:
+            dir_entries = list_directory(full_path)
+        except OSError:
+            return 0
+        names = set(dir_entry.name for dir_entry in dir_entries)
+        known = dict((os.path.basename(entry.path), entry) for entry in self.index.children(relative_directory))
+        changes = 0
+        for name in set(known) - names:
+            self.index.remove_path(known[name].path)
+            changes += 1
+        for dir_entry in dir_entries:
+            name = dir_entry.name
+            relative_path = os.path.join(relative_directory, name) if relative_directory else name
+            entry = known.get(name)
+            if entry is not None and not entry.is_dir:
+                try:
+                    stat_result = dir_entry.stat()
+                except OSError:
+                    continue
+                if stat_result.st_mtime == entry.mtime and stat_result.st_size == entry.size:
+                    continue
+            elif entry is not None:
+                continue  # existing directory, has its own mtime check
+            self.index.update_path(relative_path)
+            changes += 1
+        return changes
+
+
+def start_watcher(index, mode=WATCH_AUTO, poll_interval=DEFAULT_POLL_INTERVAL):
+    """Returns started watcher for index, or None if mode is WATCH_OFF.
+    WATCH_AUTO uses inotify where available, with polling fallback
+    """
+    if mode == WATCH_OFF:
+        return None
+    watcher = None
+    if mode in (WATCH_AUTO, WATCH_INOTIFY):
+        try:
+            watcher = InotifyWatcher(index)
+        except OSError as info:
+            if mode == WATCH_INOTIFY:
+                raise
+            log.info('inotify not available (%r), using polling', info)
+    if watcher is None:
+        watcher = PollingWatcher(index, interval=poll_interval)
+    watcher.start()
+    return watcher